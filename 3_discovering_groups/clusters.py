@@ -128,38 +128,44 @@ def hcluster(rows,distance=pearson):
   return clust[0]
 
 def printclust(clust,labels=None,n=0):
-  # indent to make a hierarchy layout
-  for i in range(n): print ' ',
-  if clust.id<0:
-    # negative id means that this is branch
-    print '-'
-  else:
-    # positive id means that this is an endpoint
-    if labels==None: print clust.id
-    else: print labels[clust.id]
-  # now print the right and left branches
-  if clust.left!=None: printclust(clust.left,labels=labels,n=n+1)
-  if clust.right!=None: printclust(clust.right,labels=labels,n=n+1)
+  # Walk the tree with an explicit stack so that long chains don't
+  # hit the recursion limit
+  stack=[(clust,n)]
+  while stack:
+    clust,n=stack.pop()
+    # indent to make a hierarchy layout
+    for i in range(n): print ' ',
+    if clust.id<0:
+      # negative id means that this is branch
+      print '-'
+    else:
+      # positive id means that this is an endpoint
+      if labels==None: print clust.id
+      else: print labels[clust.id]
+    # now print the left and right branches (right is pushed first
+    # so the left one comes off the stack first)
+    if clust.right!=None: stack.append((clust.right,n+1))
+    if clust.left!=None: stack.append((clust.left,n+1))
 
 def getheight(clust):
-  # Is this an endpoint? Then the height is just 1
-  if clust.left==None and clust.right==None: return 1
-  # Otherwise the height is the same of the heights of
-  # each branch
-  return getheight(clust.left)+getheight(clust.right)
+  # The height is the number of endpoints under this cluster
+  tree=toarraytree(clust)
+  return tree.getheights()[tree.root]
 
 def getdepth(clust):
-  # The distance of an endpoint is 0.0
-  if clust.left==None and clust.right==None: return 0
-  # The distance of a branch is the greater of its two sides
-  # plus its own distance
-  return max(getdepth(clust.left),getdepth(clust.right))+clust.distance
+  # The depth is the longest total distance from this cluster
+  # down to an endpoint
+  tree=toarraytree(clust)
+  return tree.getdepths()[tree.root]
 
 def drawdendrogram(clust,labels,jpeg='clusters.jpg'):
+  tree=toarraytree(clust)
+  heights=tree.getheights()
+
   # height and width
-  h=getheight(clust)*20
+  h=heights[tree.root]*20
   w=1200
-  depth=getdepth(clust)
+  depth=tree.getdepths()[tree.root]
 
   # width is fixed, so scale distances accordingly
   scaling=float(w-150)/depth
@@ -171,34 +177,178 @@ def drawdendrogram(clust,labels,jpeg='clusters.jpg'):
   draw.line((0,h/2,10,h/2),fill=(255,0,0))
 
   # Draw the first node
-  drawnode(draw,clust,10,(h/2),scaling,labels)
+  drawtree(draw,tree,tree.root,10,(h/2),scaling,labels,heights)
   img.save(jpeg,'JPEG')
 
 def drawnode(draw,clust,x,y,scaling,labels):
-  if clust.id<0:
-    h1=getheight(clust.left)*20
-    h2=getheight(clust.right)*20
-    top=y-(h1+h2)/2
-    bottom=y+(h1+h2)/2
-
-    # Line length
-    ll=clust.distance*scaling
-
-    # Vertical line from this cluster to children
-    draw.line((x,top+h1/2,x,bottom-h2/2),fill=(255,0,0))
-
-    # Horizontal line to left item
-    draw.line((x,top+h1/2,x+ll,top+h1/2),fill=(255,0,0))
-
-    # Horizontal line to right item
-    draw.line((x,bottom-h2/2,x+ll,bottom-h2/2),fill=(255,0,0))
-
-    # Call the function to draw the left and right nodes
-    drawnode(draw,clust.left,x+ll,top+h1/2,scaling,labels)
-    drawnode(draw,clust.right,x+ll,bottom-h2/2,scaling,labels)
-  else:
-    # If this is an endpoint, draw the item label
-    draw.text((x+5,y-7),labels[clust.id],(0,0,0))
+  tree=toarraytree(clust)
+  drawtree(draw,tree,tree.root,x,y,scaling,labels)
+
+def drawtree(draw,tree,node,x,y,scaling,labels,heights=None):
+  if heights==None: heights=tree.getheights()
+  stack=[(node,x,y)]
+  while stack:
+    node,x,y=stack.pop()
+    if node>=tree.n:
+      left,right=tree.left[node],tree.right[node]
+      h1=heights[left]*20
+      h2=heights[right]*20
+      top=y-(h1+h2)/2
+      bottom=y+(h1+h2)/2
+
+      # Line length
+      ll=tree.distance[node]*scaling
+
+      # Vertical line from this cluster to children
+      draw.line((x,top+h1/2,x,bottom-h2/2),fill=(255,0,0))
+
+      # Horizontal line to left item
+      draw.line((x,top+h1/2,x+ll,top+h1/2),fill=(255,0,0))
+
+      # Horizontal line to right item
+      draw.line((x,bottom-h2/2,x+ll,bottom-h2/2),fill=(255,0,0))
+
+      # Queue up the left and right nodes
+      stack.append((right,x+ll,bottom-h2/2))
+      stack.append((left,x+ll,top+h1/2))
+    else:
+      # If this is an endpoint, draw the item label
+      draw.text((x+5,y-7),labels[tree.ids[node]],(0,0,0))
+
+#### Array-backed trees
+
+# The bicluster tree is fine for small data sets, but very lopsided trees
+# (one big cluster swallowing one row at a time) are as deep as there
+# are rows. An arraytree keeps the same tree in flat lists instead, laid
+# out the same way as a scipy linkage matrix:
+#   nodes 0..n-1 are the endpoints (the original row ids)
+#   node n+i is the cluster created by the i-th merge (bicluster id -(i+1))
+# Because a merge always comes after the merges of its children, every
+# child has a lower number than its parent, so a single pass up or down
+# the node numbers visits the tree in order without any recursion.
+
+# To run:
+# 1. import clusters
+# 2. blognames,words,data=clusters.readfile('blogdata.txt')
+# 3. clust=clusters.hcluster(data)
+# 4. tree=clusters.toarraytree(clust)
+# 5. groups=tree.cut(10)
+# 6. To get the names of the blogs in the first group:
+#      [blognames[r] for r in range(len(groups)) if groups[r]==0]
+# 7. tree.tolinkage() gives rows of [left,right,distance,count]
+
+class arraytree:
+  def __init__(self,n):
+    self.n=n
+    size=max(2*n-1,0)
+    self.root=size-1
+    self.parent=[-1]*size
+    self.left=[-1]*size
+    self.right=[-1]*size
+    self.distance=[0.0]*size
+    # The original row id of each endpoint
+    self.ids=range(n)
+
+  def setmerge(self,node,left,right,distance):
+    self.left[node]=left
+    self.right[node]=right
+    self.distance[node]=distance
+    self.parent[left]=node
+    self.parent[right]=node
+
+  def isleaf(self,node):
+    return node<self.n
+
+  # Number of endpoints under each node
+  def getheights(self):
+    heights=[1]*len(self.left)
+    for node in range(self.n,len(self.left)):
+      heights[node]=heights[self.left[node]]+heights[self.right[node]]
+    return heights
+
+  # Greatest total distance from each node down to an endpoint
+  def getdepths(self):
+    depths=[0.0]*len(self.left)
+    for node in range(self.n,len(self.left)):
+      depths[node]=max(depths[self.left[node]],
+                       depths[self.right[node]])+self.distance[node]
+    return depths
+
+  # Yields (node,level) pairs top-down, left branch first
+  def preorder(self,node=None):
+    if node==None: node=self.root
+    stack=[(node,0)]
+    while stack:
+      node,level=stack.pop()
+      yield node,level
+      if node>=self.n:
+        stack.append((self.right[node],level+1))
+        stack.append((self.left[node],level+1))
+
+  # The row ids of the endpoints under a node, left to right
+  def leaves(self,node=None):
+    return [self.ids[i] for (i,level) in self.preorder(node) if i<self.n]
+
+  # Undo the last k-1 merges, leaving k flat clusters. Returns the
+  # cluster number of every endpoint (in the same order as ids),
+  # numbered in the order the clusters are found from the top of the tree
+  def cut(self,k):
+    k=max(1,min(k,self.n))
+    # Nodes numbered from here up are the merges that get undone
+    first=len(self.left)-(k-1)
+    labels=[-1]*len(self.left)
+    nextlabel=0
+    # Parents always have higher numbers, so walking down the node
+    # numbers sees every parent before its children
+    for node in range(len(self.left)-1,-1,-1):
+      if node>=first: continue
+      p=self.parent[node]
+      if p==-1 or p>=first:
+        labels[node]=nextlabel
+        nextlabel+=1
+      else:
+        labels[node]=labels[p]
+    return labels[0:self.n]
+
+  def tolinkage(self):
+    heights=self.getheights()
+    return [[self.left[node],self.right[node],self.distance[node],heights[node]]
+            for node in range(self.n,len(self.left))]
+
+def toarraytree(clust):
+  # Collect every node without recursing
+  nodes=[]
+  stack=[clust]
+  while stack:
+    c=stack.pop()
+    nodes.append(c)
+    if c.left!=None: stack.append(c.left)
+    if c.right!=None: stack.append(c.right)
+
+  # Endpoints are numbered in order of their ids, branches in the order
+  # they were merged (-1 first). For a whole tree from hcluster this
+  # keeps every endpoint's number equal to its id
+  leaves=sorted([c.id for c in nodes if c.id>=0])
+  branches=sorted([c.id for c in nodes if c.id<0],reverse=True)
+  n=len(leaves)
+  index=dict([(leaves[i],i) for i in range(n)])
+  for i in range(len(branches)): index[branches[i]]=n+i
+
+  tree=arraytree(n)
+  tree.ids=leaves
+  for c in nodes:
+    if c.id<0:
+      tree.setmerge(index[c.id],index[c.left.id],index[c.right.id],c.distance)
+  return tree
+
+# Accepts a scipy-style linkage matrix, i.e. n-1 rows of
+# [left,right,distance] or [left,right,distance,count]
+def fromlinkage(z):
+  n=len(z)+1
+  tree=arraytree(n)
+  for i in range(len(z)):
+    tree.setmerge(n+i,int(z[i][0]),int(z[i][1]),float(z[i][2]))
+  return tree
 
 
 #### K-Means Clustering
@@ -0,0 +1,377 @@
+import BaseHTTPServer
+import SocketServer
+import httplib
+import random
+import robotparser
+import socket
+import threading
+import time
+import urllib2
+from collections import deque
+from urlparse import urlparse
+from Queue import Queue
+from bs4 import BeautifulSoup
+import searchengine
+
+# Usage:
+# 1. import searchengine, concurrentcrawl
+# 2. crawler=searchengine.crawler('searchindex.db')
+# 3. crawler.createindextables()
+# 4. engine=concurrentcrawl.crawlengine(crawler,workers=8,perhost=2,delay=1.0)
+# 5. engine.crawl(['http://gameofthrones.wikia.com/wiki/Game_of_Thrones_Wiki'])
+# 6. engine.printstats()
+#
+# Pages are fetched and parsed by a pool of worker threads. Every index
+# write goes through the thread that called crawl, so the crawler's
+# sqlite connection is only ever used by one thread.
+#
+# To try it against a canned site on this machine:
+# 1. import concurrentcrawl
+# 2. server=concurrentcrawl.servesite(concurrentcrawl.makesite(200))
+# 3. engine=concurrentcrawl.crawlengine(crawler)
+# 4. engine.crawl([concurrentcrawl.siteurl(server)],depth=3)
+# 5. server.shutdown()
+
+# The urls waiting to be fetched. Every url is only ever queued once,
+# at most perhost fetches run against a host at the same time, and
+# requests to the same host are at least delay seconds apart
+class frontier:
+  def __init__(self, perhost=2, delay=0.0):
+    self.perhost=perhost
+    self.delay=delay
+    self.lock=threading.Condition()
+    self.seen=set()
+    self.queues={}
+    self.inflight={}
+    self.nextfetch={}
+    self.hostdelay={}
+    # Urls that have been queued but not finished yet
+    self.pending=0
+    self.closed=False
+
+  def add(self, url, level):
+    self.lock.acquire()
+    try:
+      if url in self.seen: return False
+      self.seen.add(url)
+      host=urlparse(url)[1]
+      self.queues.setdefault(host,deque()).append((url,level))
+      self.pending+=1
+      self.lock.notify_all()
+      return True
+    finally:
+      self.lock.release()
+
+  # Ask for a longer gap between requests to one host, e.g. from its robots.txt
+  def setdelay(self, host, delay):
+    self.lock.acquire()
+    try:
+      self.hostdelay[host]=max(delay,self.delay)
+    finally:
+      self.lock.release()
+
+  # Blocks until some host is allowed another request, then returns
+  # (url,level). Returns None once the frontier has been closed
+  def get(self):
+    self.lock.acquire()
+    try:
+      while not self.closed:
+        now=time.time()
+        wait=None
+        for host in self.queues.keys():
+          queue=self.queues[host]
+          if len(queue)==0 or self.inflight.get(host,0)>=self.perhost: continue
+          ready=self.nextfetch.get(host,0)
+          if ready<=now:
+            self.inflight[host]=self.inflight.get(host,0)+1
+            self.nextfetch[host]=now+self.hostdelay.get(host,self.delay)
+            return queue.popleft()
+          if wait==None or ready-now<wait: wait=ready-now
+        self.lock.wait(wait)
+      return None
+    finally:
+      self.lock.release()
+
+  # Called once a url handed out by get has been dealt with
+  def done(self, url):
+    self.lock.acquire()
+    try:
+      host=urlparse(url)[1]
+      self.inflight[host]-=1
+      if self.inflight[host]==0 and len(self.queues[host])==0:
+        del self.inflight[host]
+        del self.queues[host]
+      self.pending-=1
+      self.lock.notify_all()
+    finally:
+      self.lock.release()
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      self.closed=True
+      self.lock.notify_all()
+    finally:
+      self.lock.release()
+
+# robots.txt for every host, fetched the first time the host is seen.
+# Each host has its own lock, so that workers that reach a new host at the
+# same time wait for one of them to fetch it, while other hosts go on
+class robotcache:
+  def __init__(self, useragent, timeout=10):
+    self.useragent=useragent
+    self.timeout=timeout
+    self.lock=threading.Lock()
+    self.parsers={}
+    self.hostlocks={}
+
+  # Returns (allowed, crawl delay or None)
+  def check(self, url):
+    parts=urlparse(url)
+    root='%s://%s' % (parts[0],parts[1])
+    self.lock.acquire()
+    try:
+      entry=self.parsers.get(root)
+      hostlock=self.hostlocks.setdefault(root,threading.Lock())
+    finally:
+      self.lock.release()
+    if entry==None:
+      hostlock.acquire()
+      try:
+        # Another worker may have fetched it while this one waited
+        entry=self.parsers.get(root)
+        if entry==None:
+          entry=self.fetch(root)
+          self.lock.acquire()
+          try:
+            self.parsers[root]=entry
+          finally:
+            self.lock.release()
+      finally:
+        hostlock.release()
+    rp,crawldelay=entry
+    return rp.can_fetch(self.useragent,url),crawldelay
+
+  def fetch(self, root):
+    rp=robotparser.RobotFileParser(root+'/robots.txt')
+    lines=[]
+    try:
+      req=urllib2.Request(root+'/robots.txt',headers={'User-Agent': self.useragent})
+      lines=urllib2.urlopen(req,timeout=self.timeout).read().splitlines()
+    except urllib2.HTTPError, e:
+      # Same rules as RobotFileParser.read
+      if e.code in (401,403): rp.disallow_all=True
+    except (urllib2.URLError, httplib.HTTPException, socket.error):
+      pass
+    rp.parse(lines)
+
+    # robotparser doesn't know about Crawl-delay, so pick it out here.
+    # Only the value given for every user agent is used
+    crawldelay=None
+    agent=None
+    for line in lines:
+      line=line.split('#')[0].strip()
+      if ':' not in line: continue
+      field,value=[p.strip() for p in line.split(':',1)]
+      field=field.lower()
+      if field=='user-agent': agent=value
+      elif field=='crawl-delay' and agent=='*':
+        try: crawldelay=float(value)
+        except ValueError: pass
+    return rp,crawldelay
+
+# The error for a page robots.txt doesn't let the crawler fetch
+blockedbyrobots='blocked by robots.txt'
+
+class crawlengine:
+  def __init__(self, crawler, workers=8, perhost=2, delay=0.0, timeout=10,
+               batchsize=50, useragent='searchengine-crawler'):
+    self.crawler=crawler
+    self.workers=workers
+    self.timeout=timeout
+    self.batchsize=batchsize
+    self.useragent=useragent
+    self.frontier=frontier(perhost=perhost,delay=delay)
+    self.robots=robotcache(useragent,timeout=timeout)
+    self.results=Queue()
+    self.statslock=threading.Lock()
+    self.stats=dict([(k,0) for k in ('fetched','fetchtime','bytes','parsed','parsetime',
+                                     'indexed','indextime','failed','blocked','walltime')])
+    self.errors=[]
+
+  def addstats(self, **values):
+    self.statslock.acquire()
+    try:
+      for k in values: self.stats[k]+=values[k]
+    finally:
+      self.statslock.release()
+
+  # Fetch and parse one page. Runs on a worker thread, so it must not
+  # touch the database. Returns (url,level,words,links,error)
+  def fetchpage(self, url, level):
+    allowed,crawldelay=self.robots.check(url)
+    if crawldelay!=None: self.frontier.setdelay(urlparse(url)[1],crawldelay)
+    if not allowed:
+      return (url,level,None,None,blockedbyrobots)
+
+    start=time.time()
+    try:
+      req=urllib2.Request(url,headers={'User-Agent': self.useragent})
+      c=urllib2.urlopen(req,timeout=self.timeout)
+      contenttype=c.info().gettype()
+      if contenttype!='text/html':
+        return (url,level,None,None,'not html (%s)' % contenttype)
+      html=c.read()
+    except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+      return (url,level,None,None,'could not open (%s)' % e)
+    fetched=time.time()
+    self.addstats(fetched=1,fetchtime=fetched-start,bytes=len(html))
+
+    try:
+      soup=BeautifulSoup(html,'html.parser')
+      words=self.crawler.separatewords(self.crawler.gettextonly(soup))
+      links=[(u,self.crawler.separatewords(t)) for (u,t) in self.crawler.getlinks(url,soup)]
+    except Exception, e:
+      return (url,level,None,None,'could not parse (%s)' % e)
+    self.addstats(parsed=1,parsetime=time.time()-fetched)
+    return (url,level,words,links,None)
+
+  def worker(self):
+    while True:
+      item=self.frontier.get()
+      if item==None: return
+      url,level=item
+      try:
+        result=self.fetchpage(url,level)
+      except Exception, e:
+        # Anything unexpected still has to be reported, or the crawl
+        # would wait for this url forever
+        result=(url,level,None,None,'failed (%s)' % e)
+      self.results.put(result)
+
+  # Index one fetched page and queue the pages it links to. Runs on the
+  # thread that called crawl
+  def indexpage(self, url, level, words, links, depth):
+    start=time.time()
+    self.crawler.queuewords(url,words,links)
+    if len(self.crawler.pending)>=self.batchsize: self.crawler.flushindex()
+    self.addstats(indexed=1,indextime=time.time()-start)
+
+    if level+1>=depth: return
+    for (linkurl,linkwords) in links:
+      if linkurl[0:4]=='http' and not self.crawler.isindexed(linkurl):
+        self.frontier.add(linkurl,level+1)
+
+  # Starting with a list of pages, crawl to the given depth the same way
+  # crawler.crawl does
+  def crawl(self, pages, depth=2):
+    start=time.time()
+    for page in pages:
+      if not self.crawler.isindexed(page): self.frontier.add(page,0)
+
+    threads=[threading.Thread(target=self.worker) for i in range(self.workers)]
+    for t in threads:
+      t.daemon=True
+      t.start()
+
+    try:
+      while self.frontier.pending>0:
+        url,level,words,links,error=self.results.get()
+        try:
+          if error!=None:
+            print 'Could not index %s: %s' % (url,error)
+            self.errors.append((url,error))
+            # Pages robots.txt keeps out are counted as blocked, not failed
+            if error==blockedbyrobots: self.addstats(blocked=1)
+            else: self.addstats(failed=1)
+          elif not self.crawler.isindexed(url):
+            self.indexpage(url,level,words,links,depth)
+        finally:
+          self.frontier.done(url)
+      start_flush=time.time()
+      self.crawler.flushindex()
+      self.addstats(indextime=time.time()-start_flush)
+    finally:
+      self.frontier.close()
+      for t in threads: t.join()
+      self.addstats(walltime=time.time()-start)
+    return self.stats
+
+  def printstats(self):
+    s=self.stats
+    def rate(count,seconds):
+      if seconds==0: return 0.0
+      return count/seconds
+    print 'fetch  %6d pages %10d bytes %8.2fs busy %8.1f pages/sec per worker' % (
+      s['fetched'],s['bytes'],s['fetchtime'],rate(s['fetched'],s['fetchtime']))
+    print 'parse  %6d pages %8.2fs busy %8.1f pages/sec per worker' % (
+      s['parsed'],s['parsetime'],rate(s['parsed'],s['parsetime']))
+    print 'index  %6d pages %8.2fs busy %8.1f pages/sec' % (
+      s['indexed'],s['indextime'],rate(s['indexed'],s['indextime']))
+    print 'total  %6d pages %8.2fs wall %8.1f pages/sec (%d failed, %d blocked by robots.txt)' % (
+      s['indexed'],s['walltime'],rate(s['indexed'],s['walltime']),s['failed'],s['blocked'])
+
+#### Canned site served from this machine
+
+class sitehandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    page=self.server.pages.get(self.path.split('?')[0])
+    if page==None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    if self.path.endswith('.txt'): self.send_header('Content-Type','text/plain')
+    else: self.send_header('Content-Type','text/html')
+    self.send_header('Content-Length',str(len(page)))
+    self.end_headers()
+    self.wfile.write(page)
+
+  # Keep quiet instead of logging every request to stderr
+  def log_message(self, format, *args):
+    pass
+
+class siteserver(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads=True
+
+# Serve a dict of path->content on localhost from a background thread
+def servesite(pages, port=0):
+  server=siteserver(('127.0.0.1',port),sitehandler)
+  server.pages=pages
+  t=threading.Thread(target=server.serve_forever)
+  t.daemon=True
+  t.start()
+  return server
+
+def siteurl(server, path='/index.html'):
+  return 'http://%s:%d%s' % (server.server_address[0],server.server_address[1],path)
+
+# A made up site of linked pages, always the same for the same seed
+def makesite(count=100, words=300, links=10, seed=0, robots=None):
+  rnd=random.Random(seed)
+  vocabulary=['word%d' % i for i in range(2000)]
+  pages={}
+  for i in range(count):
+    body=' '.join([rnd.choice(vocabulary) for j in range(words)])
+    anchors=''.join(['<a href="/page%d.html">%s %s</a>\n' %
+                     (rnd.randint(0,count-1),rnd.choice(vocabulary),rnd.choice(vocabulary))
+                     for j in range(links)])
+    pages['/page%d.html' % i]='<html><head><title>Page %d</title></head><body><p>%s</p>%s</body></html>' % (i,body,anchors)
+  # The index links to a few pages so every depth has something to do
+  pages['/index.html']='<html><body>%s</body></html>' % ''.join(
+    ['<a href="/page%d.html">page %d</a>\n' % (i,i) for i in range(min(count,links))])
+  if robots!=None: pages['/robots.txt']=robots
+  return pages
+
+if __name__=='__main__':
+  import os, tempfile, datastore
+  server=servesite(makesite(200,robots='User-agent: *\nDisallow: /page13.html\n'))
+  fd,dbname=tempfile.mkstemp(suffix='.db')
+  os.close(fd)
+  os.remove(dbname)
+  crawler=searchengine.crawler(dbname,pragmas=datastore.walpragmas)
+  crawler.createindextables()
+  engine=crawlengine(crawler,workers=8,perhost=8)
+  engine.crawl([siteurl(server)],depth=4)
+  engine.printstats()
+  server.shutdown()
+  os.remove(dbname)
@@ -0,0 +1,164 @@
+import os
+import re
+import random
+import tempfile
+import time
+from bs4 import BeautifulSoup
+import searchengine
+import datastore
+import shardindex
+
+# Compares the one-statement-at-a-time indexer with the batched one on
+# a set of made up pages. Nothing is fetched over the network.
+#
+# Usage:
+# 1. python indexbench.py
+# or
+# 1. import indexbench
+# 2. indexbench.run(pages=200, batchsize=50)
+# 3. indexbench.rankbench(urls=100000, links=1000000)
+# 4. indexbench.textbench(pages=20, depth=6)
+# 5. indexbench.shardbench(pages=400, processes=[1, 2, 4])
+
+vocabulary = ['word%d' % i for i in range(5000)]
+
+# (url, html) of made up pages
+def makehtml(count, words=800, links=20, seed=0):
+  rnd = random.Random(seed)
+  pages = []
+  for i in range(count):
+    body = ' '.join([rnd.choice(vocabulary) for j in range(words)])
+    anchors = ''.join(['<a href="/page%d.html">%s %s</a>\n' %
+                       (rnd.randint(0, count-1), rnd.choice(vocabulary), rnd.choice(vocabulary))
+                       for j in range(links)])
+    html = '<html><head><title>Page %d</title></head><body><p>%s</p>%s</body></html>' % (i, body, anchors)
+    pages.append(('http://bench.local/page%d.html' % i, html))
+  return pages
+
+def makepages(count, words=800, links=20, seed=0):
+  return [(url, BeautifulSoup(html, 'html.parser')) for (url, html) in makehtml(count, words, links, seed)]
+
+def newcrawler():
+  fd, dbname = tempfile.mkstemp(suffix='.db')
+  os.close(fd)
+  os.remove(dbname)
+  c = searchengine.crawler(dbname, pragmas=datastore.walpragmas)
+  c.createindextables()
+  return c, dbname
+
+def indexserial(c, pages):
+  for (url, soup) in pages:
+    c.addtoindex(url, soup)
+    for (linkurl, linktext) in c.getlinks(url, soup):
+      c.addlinkref(url, linkurl, linktext)
+    c.dbcommit()
+
+def indexbatched(c, pages, batchsize):
+  for (url, soup) in pages:
+    c.queuepage(url, soup)
+    if len(c.pending) >= batchsize: c.flushindex()
+  c.flushindex()
+
+def timeit(label, pages, index):
+  c, dbname = newcrawler()
+  start = time.time()
+  index(c)
+  elapsed = time.time() - start
+  rows = c.con.execute('select count(*) from wordlocation').fetchone()[0]
+  c.con.close()
+  os.remove(dbname)
+  print '%-10s %6d pages %8.2fs %8.1f pages/sec (%d locations)' % (label, len(pages), elapsed, len(pages)/elapsed, rows)
+  return len(pages)/elapsed
+
+def run(pages=100, batchsize=50):
+  pagelist = makepages(pages)
+  serial = timeit('serial', pagelist, lambda c: indexserial(c, pagelist))
+  batched = timeit('batched', pagelist, lambda c: indexbatched(c, pagelist, batchsize))
+  print 'speedup    %.1fx' % (batched/serial)
+
+# Time calculatepagerank on a random link graph
+def rankbench(urls=100000, links=1000000, seed=0):
+  rnd = random.Random(seed)
+  c, dbname = newcrawler()
+  c.con.executemany('insert into urllist(url) values (?)',
+                    [('http://bench.local/page%d.html' % i,) for i in xrange(urls)])
+  c.con.executemany('insert into link(fromid,toid) values (?,?)',
+                    ((rnd.randint(1, urls), rnd.randint(1, urls)) for i in xrange(links)))
+  c.dbcommit()
+  start = time.time()
+  c.calculatepagerank()
+  elapsed = time.time() - start
+  c.con.close()
+  os.remove(dbname)
+  print 'pagerank   %6d urls %8d links %8.2fs' % (urls, links, elapsed)
+  return elapsed
+
+# Time building the index from parsed html with shardindex, with each
+# number of processes
+def shardbench(pages=400, processes=[1, 2, 4]):
+  htmlpages = makehtml(pages)
+  for n in processes:
+    c, dbname = newcrawler()
+    c.con.close()
+    os.remove(dbname)
+    start = time.time()
+    shardindex.buildindex(htmlpages, dbname, processes=n)
+    elapsed = time.time() - start
+    os.remove(dbname)
+    print '%-10s %6d pages %8.2fs %8.1f pages/sec' % ('%d procs' % n, pages, elapsed, pages/elapsed)
+
+# The text extraction and word splitting the crawler used before
+# searchengine.extracttext and wordsplitter, to compare them with
+def oldgettextonly(soup):
+  v=soup.string
+  if v == None:
+    c=soup.contents
+    resulttext=''
+    for t in c:
+      subtext=oldgettextonly(t)
+      resulttext+=subtext+'\n'
+    return resulttext
+  else:
+    return v.strip()
+
+def oldseparatewords(text):
+  splitter=re.compile('\\W*')
+  return [s.lower() for s in splitter.split(text) if s!='']
+
+# Pages with text nested depth tags deep, which is where building the
+# text up a level at a time costs the most
+def makenestedpages(count, words=5000, depth=6, seed=0):
+  rnd = random.Random(seed)
+  pages = []
+  for i in range(count):
+    chunks = []
+    for j in range(0, words, 10):
+      text = ' '.join([rnd.choice(vocabulary) for k in range(10)])
+      chunks.append('<div>'*depth + '<span>%s</span> <b>%s</b>' % (text, rnd.choice(vocabulary)) + '</div>'*depth)
+    html = '<html><body>%s</body></html>' % ''.join(chunks)
+    pages.append(BeautifulSoup(html, 'html.parser'))
+  return pages
+
+# Time getting the words out of parsed pages, the old way and the new,
+# and with stop words and stemming. Both give the same words
+def textbench(pages=20, words=5000, depth=6):
+  soups = makenestedpages(pages, words, depth)
+  splitter = searchengine.wordsplitter()
+  stemming = searchengine.wordsplitter(stopwords=searchengine.ignorewords, stemmer=searchengine.stemword)
+  def old(): return [oldseparatewords(oldgettextonly(soup)) for soup in soups]
+  def new(): return [splitter.split(searchengine.extracttext(soup)) for soup in soups]
+  def stemmed(): return [stemming.split(searchengine.extracttext(soup)) for soup in soups]
+
+  results = {}
+  for (label, extract) in [('old', old), ('new', new), ('stemmed', stemmed)]:
+    start = time.time()
+    results[label] = extract()
+    elapsed = time.time() - start
+    count = sum([len(w) for w in results[label]])
+    print '%-10s %6d pages %8.3fs %10.0f words/sec' % (label, pages, elapsed, count/elapsed)
+  if results['old'] != results['new']: print 'warning: the old and new words differ'
+
+if __name__ == '__main__':
+  run()
+  rankbench()
+  textbench()
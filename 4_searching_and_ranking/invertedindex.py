@@ -0,0 +1,207 @@
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import product
+import datastore
+
+# An inverted index built from the wordlocation table, so that searcher
+# doesn't need to self-join wordlocation once per query word.
+#
+# Usage:
+# 1. python invertedindex.py searchindex.db searchindex.idx
+#    (or invertedindex.buildindex(con,'searchindex.idx') with an open connection)
+# 2. import searchengine
+# 3. s=searchengine.searcher('searchindex.db',indexfile='searchindex.idx')
+# 4. s.query('john snow')
+#
+# The index is a snapshot: build it again after crawling more pages.
+#
+# File layout (all little endian):
+#   header     magic, version, number of words
+#   directory  (wordid, number of urls, offset of the word's block) per word
+#   blocks     for each word:
+#                urlids      sorted uint32 urlids
+#                posoffsets  uint32 offsets into positions, one per url plus an end
+#                positions   the word's locations on each url, sorted, stored as
+#                            the gap from the previous location in varint bytes
+
+MAGIC = 'PCII'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+ENTRY = struct.Struct('<IIQ')
+
+def encodevarint(value, out):
+  while value >= 0x80:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+def encodepositions(positions, out):
+  last = 0
+  for p in positions:
+    encodevarint(p-last, out)
+    last = p
+
+def decodepositions(data, start, end):
+  positions = []
+  last = 0
+  value = 0
+  shift = 0
+  for i in xrange(start, end):
+    b = ord(data[i])
+    value |= (b & 0x7f) << shift
+    if b & 0x80:
+      shift += 7
+    else:
+      last += value
+      positions.append(last)
+      value = 0
+      shift = 0
+  return positions
+
+def writeblock(f, urlids, positions):
+  blob = bytearray()
+  offsets = array('I')
+  for locs in positions:
+    offsets.append(len(blob))
+    encodepositions(locs, blob)
+  offsets.append(len(blob))
+  f.write(array('I', urlids).tostring())
+  f.write(offsets.tostring())
+  f.write(blob)
+
+# Build the index file from the wordlocation table in one ordered scan
+def buildindex(con, filename):
+  nwords = con.execute('select count(distinct wordid) from wordlocation').fetchone()[0]
+  directory = []
+  f = open(filename, 'wb')
+  try:
+    # Leave room for the header and directory, which are written last
+    f.write('\0' * (HEADER.size + ENTRY.size*nwords))
+    cur = con.execute('select wordid,urlid,location from wordlocation order by wordid,urlid,location')
+    wordid = None
+    urlids, positions = [], []
+    for (w, u, loc) in cur:
+      if w != wordid:
+        if wordid != None:
+          directory.append((wordid, len(urlids), f.tell()))
+          writeblock(f, urlids, positions)
+        wordid = w
+        urlids, positions = [], []
+      if len(urlids) == 0 or urlids[-1] != u:
+        urlids.append(u)
+        positions.append([])
+      positions[-1].append(loc)
+    if wordid != None:
+      directory.append((wordid, len(urlids), f.tell()))
+      writeblock(f, urlids, positions)
+
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, len(directory)))
+    for entry in directory: f.write(ENTRY.pack(*entry))
+  finally:
+    f.close()
+  return len(directory)
+
+# Smallest i >= lo with a[i] >= x. Steps through a in doubling strides
+# before bisecting, so walking a long list in order stays cheap when
+# most of it is skipped
+def gallop(a, x, lo=0):
+  n = len(a)
+  if lo >= n or a[lo] >= x: return lo
+  prev = lo
+  step = 1
+  cur = lo + 1
+  while cur < n and a[cur] < x:
+    prev = cur
+    step *= 2
+    cur = prev + step
+  return bisect_left(a, x, prev+1, min(cur, n))
+
+# Intersect sorted lists. Returns a list of (value, [index of value in
+# each list]). The shortest list drives the search and the others are
+# galloped forward, so the cost depends mostly on the shortest list
+def intersect(lists):
+  if len(lists) == 0: return []
+  order = sorted(range(len(lists)), key=lambda k: len(lists[k]))
+  first = lists[order[0]]
+  idx = [0] * len(lists)
+  result = []
+  i = 0
+  while i < len(first):
+    x = first[i]
+    match = True
+    for k in order[1:]:
+      l = lists[k]
+      p = gallop(l, x, idx[k])
+      idx[k] = p
+      if p == len(l): return result
+      if l[p] != x:
+        # Skip the driving list ahead to the next possible match
+        i = gallop(first, l[p], i)
+        match = False
+        break
+    if match:
+      idx[order[0]] = i
+      result.append((x, idx[:]))
+      i += 1
+  return result
+
+class invertedindex:
+  def __init__(self, filename, usemmap=True):
+    self.f = open(filename, 'rb')
+    if usemmap:
+      self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self.data = self.f.read()
+    magic, version, nwords = HEADER.unpack_from(self.data, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('%s is not a version %d index file' % (filename, VERSION))
+    self.directory = {}
+    for i in range(nwords):
+      wordid, n, offset = ENTRY.unpack_from(self.data, HEADER.size + ENTRY.size*i)
+      self.directory[wordid] = (n, offset)
+
+  def close(self):
+    if isinstance(self.data, mmap.mmap): self.data.close()
+    self.f.close()
+
+  # Sorted urlids of the pages containing a word
+  def urlids(self, wordid):
+    if wordid not in self.directory: return array('I')
+    n, offset = self.directory[wordid]
+    return array('I', self.data[offset:offset+4*n])
+
+  # Locations of a word on the i-th url in its posting list
+  def positions(self, wordid, i):
+    n, offset = self.directory[wordid]
+    offsetsstart = offset + 4*n
+    start, end = struct.unpack_from('<II', self.data, offsetsstart + 4*i)
+    blobstart = offsetsstart + 4*(n+1)
+    return decodepositions(self.data, blobstart+start, blobstart+end)
+
+  # The urls containing every word, as a dict of urlid -> a list with
+  # the sorted locations of each word on that url
+  def getpositions(self, wordids):
+    matches = intersect([self.urlids(w) for w in wordids])
+    return dict([(urlid, [self.positions(wordids[k], idx[k]) for k in range(len(wordids))])
+                 for (urlid, idx) in matches])
+
+  # Same rows as searcher.getmatchrows: (urlid, loc1, loc2, ...) for
+  # every combination of locations of the words
+  def getmatchrows(self, wordids):
+    rows = []
+    for (urlid, positions) in self.getpositions(wordids).items():
+      for locs in product(*positions):
+        rows.append((urlid,) + locs)
+    return rows
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    print 'usage: python invertedindex.py searchindex.db searchindex.idx'
+    sys.exit(1)
+  con = datastore.connect(sys.argv[1])
+  print 'Indexed %d words' % buildindex(con, sys.argv[2])
+  con.close()
@@ -1,5 +1,8 @@
-from math import tanh
-import sqlite3 as sqlite
+import time
+import atexit
+import weakref
+import numpy
+import datastore
 
 # USAGE:
 # Setup:
@@ -23,108 +26,269 @@ import sqlite3 as sqlite
 # 8. net.trainquery([wordTyrion,wordLannister],[urlTyrionLannister, urlJaimeLannister, urlCerseiLannister],urlTyrionLannister)
 # 9. net.getresult([wordTyrion, wordLannister], [urlTyrionLannister, urlJaimeLannister, urlCerseiLannister])
 #      [0.3350632467125332, 0.055127057492088, 0.055127057492088]
+#
+# Changed weights are kept in memory and written to the database every
+# flushevery training calls (trainquery or trainbatch), when net.flush() or
+# net.close() is called, and when the program exits. Pass flushevery=1 to
+# write after every call as before.
+#
+# Every word combination trained on gets its own hidden node. To keep the
+# hidden layer from growing without bound, give a maximum number of nodes:
+#   net=nn.searchnet('nn.db', maxhidden=10000)
+# When a new node would go over it, the least used nodes are dropped along
+# with their weights until the layer is back to nine tenths of the maximum.
+
+# Networks with weights that haven't been written yet, flushed at exit
+opennets = weakref.WeakSet()
+
+def flushall():
+    for net in list(opennets):
+        net.flush()
+
+atexit.register(flushall)
 
 def dtanh(y):
     return 1.0-y*y
 
 class searchnet:
-    def __init__(self, dbname):
-        self.con = sqlite.connect(dbname)
+    def __init__(self, dbname, flushevery=100, maxhidden=None):
+        self.con = datastore.connect(dbname)
+        self.flushevery = flushevery
+        self.maxhidden = maxhidden
+        self.hiddencount = None
+        self.updates = 0
+        self.tablesok = False
+        # hiddenid -> times trained on since the last flush
+        self.hiddenuses = {}
+        # Weights not written to the database yet. Input weights are keyed
+        # on the word and output weights on the url, as those are what
+        # loadweights looks them up by: {wordid: {hiddenid: strength}} and
+        # {urlid: {hiddenid: strength}}
+        self.dirtyinput = {}
+        self.dirtyoutput = {}
+        # Goes up whenever a weight changes, so searcher's result cache can
+        # tell, as the cached weights aren't in the database until flush
+        self.generation = 0
+        opennets.add(self)
 
+    # opennets drops a net by itself once it is garbage, and may already be
+    # gone while the interpreter shuts down, so only close() takes it out
     def __del__(self):
+        if self.con != None: self.closedb()
+
+    def close(self):
+        if self.con == None: return
+        self.closedb()
+        opennets.discard(self)
+
+    def closedb(self):
+        self.flush()
         self.con.close()
+        self.con = None
 
     def maketables(self):
-        self.con.execute('create table hiddennode(create_key)')
+        self.con.execute('create table hiddennode(create_key, uses default 0, lastused default 0)')
         self.con.execute('create table wordhidden(fromid, toid, strength)')
         self.con.execute('create table hiddenurl(fromid, toid, strength)')
+        self.checktables()
         self.con.commit()
 
+    # flush writes with an upsert, which needs (fromid, toid) to be unique,
+    # the weights are looked up from either end, and pruning needs the
+    # usage columns. Databases made before these existed get them the
+    # first time they are written to
+    def checktables(self):
+        if self.tablesok: return
+        columns = [row[1] for row in self.con.execute('pragma table_info(hiddennode)')]
+        if 'uses' not in columns:
+            self.con.execute('alter table hiddennode add column uses default 0')
+            self.con.execute('alter table hiddennode add column lastused default 0')
+        self.con.execute('create unique index if not exists hiddennodeidx on hiddennode(create_key)')
+        self.con.execute('create index if not exists hiddenusesidx on hiddennode(uses, lastused)')
+        self.con.execute('create unique index if not exists wordhiddenidx on wordhidden(fromid, toid)')
+        self.con.execute('create index if not exists wordhiddentoidx on wordhidden(toid)')
+        self.con.execute('create unique index if not exists hiddenurlidx on hiddenurl(fromid, toid)')
+        self.con.execute('create index if not exists hiddenurltoidx on hiddenurl(toid)')
+        self.tablesok = True
+
     def getstrength(self, fromid, toid, layer):
-        if layer == 0: table = 'wordhidden'
-        else: table = 'hiddenurl'
-        res = self.con.execute('select strength from %s where fromid=%d and toid=%d' % (table, fromid, toid)).fetchone()
+        if layer == 0:
+            table = 'wordhidden'
+            dirty = self.dirtyinput.get(fromid, {}).get(toid)
+        else:
+            table = 'hiddenurl'
+            dirty = self.dirtyoutput.get(toid, {}).get(fromid)
+        if dirty != None: return dirty
+        res = self.con.execute('select strength from %s where fromid=? and toid=?' % table, (fromid, toid)).fetchone()
         if res == None:
             if layer == 0: return -0.2
             if layer == 1: return 0
         return res[0]
 
+    # Only changes the cached weight. flush writes it to the database
     def setstrength(self, fromid, toid, layer, strength):
-        if layer == 0: table = 'wordhidden'
-        else: table = 'hiddenurl'
-        res = self.con.execute('select rowid from %s where fromid=%d and toid=%d' % (table, fromid, toid)).fetchone()
-        if res == None:
-            self.con.execute('insert into %s (fromid, toid, strength) values (%d, %d, %f)' % (table, fromid, toid, strength))
-        else:
-            rowid = res[0]
-            self.con.execute('update %s set strength = %f where rowid = %d' % (table , strength, rowid))
+        if layer == 0: self.dirtyinput.setdefault(fromid, {})[toid] = float(strength)
+        else: self.dirtyoutput.setdefault(toid, {})[fromid] = float(strength)
+        self.generation += 1
+
+    # Write every cached weight and the hidden node usage in one transaction
+    def flush(self):
+        if self.con == None or (len(self.dirtyinput) == 0 and len(self.dirtyoutput) == 0 and
+                                len(self.hiddenuses) == 0): return
+        inputs = [(w, h, strength) for (w, hidden) in self.dirtyinput.items() for (h, strength) in hidden.items()]
+        outputs = [(h, u, strength) for (u, hidden) in self.dirtyoutput.items() for (h, strength) in hidden.items()]
+        now = time.time()
+        uses = [(count, now, h) for (h, count) in self.hiddenuses.items()]
+        try:
+            self.checktables()
+            self.con.executemany('insert into wordhidden (fromid, toid, strength) values (?, ?, ?) '
+                                 'on conflict (fromid, toid) do update set strength = excluded.strength', inputs)
+            self.con.executemany('insert into hiddenurl (fromid, toid, strength) values (?, ?, ?) '
+                                 'on conflict (fromid, toid) do update set strength = excluded.strength', outputs)
+            self.con.executemany('update hiddennode set uses = uses + ?, lastused = ? where rowid = ?', uses)
+            self.con.commit()
+        except:
+            # Keep the cache so nothing is lost, and try again next time
+            self.con.rollback()
+            raise
+        self.dirtyinput = {}
+        self.dirtyoutput = {}
+        self.hiddenuses = {}
+        self.updates = 0
 
     def generatehiddennode(self, wordids, urls):
         if len(wordids) > 3: return None
         # Check if we already created a node for this set of words
         createkey = "_".join(sorted([str(wi) for wi in wordids]))
-        res = self.con.execute("select rowid from hiddennode where create_key = '%s'" % createkey).fetchone()
+        res = self.con.execute("select rowid from hiddennode where create_key = ?", (createkey,)).fetchone()
 
         # If not, create it
         if res == None:
-            cur = self.con.execute("insert into hiddennode (create_key) values ('%s')" % createkey)
+            self.checktables()
+            if self.maxhidden != None:
+                if self.hiddencount == None:
+                    self.hiddencount = self.con.execute('select count(*) from hiddennode').fetchone()[0]
+                if self.hiddencount >= self.maxhidden: self.prunehiddennodes(int(self.maxhidden*0.9))
+            # Being created counts as the node's first use, so it isn't
+            # the first to go when the layer is pruned
+            cur = self.con.execute("insert into hiddennode (create_key, uses, lastused) values (?, 1, ?)",
+                                   (createkey, time.time()))
             hiddenid = cur.lastrowid
-            # Put in some default weights
-            for wordid in wordids:
-                self.setstrength(wordid, hiddenid, 0, 1.0/len(wordids))
-            for urlid in urls:
-                self.setstrength(hiddenid, urlid, 1, 0.1)
+            if self.hiddencount != None: self.hiddencount += 1
+            # Put in some default weights, committed with the node so that
+            # it is never in the database without them
+            self.con.executemany('insert into wordhidden (fromid, toid, strength) values (?, ?, ?)',
+                                 [(wordid, hiddenid, 1.0/len(wordids)) for wordid in set(wordids)])
+            self.con.executemany('insert into hiddenurl (fromid, toid, strength) values (?, ?, ?)',
+                                 [(hiddenid, urlid, 0.1) for urlid in set(urls)])
             self.con.commit()
 
+    # Drop the least used hidden nodes and their weights until there are
+    # only keep of them left
+    def prunehiddennodes(self, keep):
+        self.flush()
+        count = self.con.execute('select count(*) from hiddennode').fetchone()[0]
+        if count <= keep: return 0
+        ids = [row[0] for row in self.con.execute('select rowid from hiddennode order by uses, lastused limit ?',
+                                                  (count-keep,))]
+        try:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                marks = ','.join(['?']*len(chunk))
+                self.con.execute('delete from wordhidden where toid in (%s)' % marks, chunk)
+                self.con.execute('delete from hiddenurl where fromid in (%s)' % marks, chunk)
+                self.con.execute('delete from hiddennode where rowid in (%s)' % marks, chunk)
+            self.con.commit()
+        except:
+            self.con.rollback()
+            raise
+        self.generation += 1
+        self.hiddencount = count - len(ids)
+        return len(ids)
+
     def getallhiddenids(self, wordids, urlids):
-        l1 = {}
-        for wordid in wordids:
-            cur = self.con.execute('select toid from wordhidden where fromid = %d' % wordid)
-            for row in cur: l1[row[0]] = 1
-        for urlid in urlids:
-            cur = self.con.execute('select fromid from hiddenurl where toid = %d' % urlid)
-            for row in cur: l1[row[0]] = 1
-        return l1.keys()
+        inputs, outputs = self.loadweights(wordids, urlids)
+        return list(set([h for (w, h) in inputs] + [h for (h, u) in outputs]))
+
+    # Every stored weight from the words to hidden nodes and from hidden
+    # nodes to the urls, as dicts of (fromid, toid) -> strength, which also
+    # gives the hidden nodes connected to either. Both layers come from one
+    # query, unless there are too many urls for sqlite to take as
+    # parameters at once, when the rest of them follow 500 at a time.
+    # Cached weights replace the ones read from the database
+    def loadweights(self, wordids, urlids):
+        wordids = list(set(wordids))
+        urlids = list(set(urlids))
+        inputs = {}
+        outputs = {}
+        for i in range(0, max(len(urlids), 1), 500):
+            words = i == 0 and wordids or []
+            urls = urlids[i:i+500]
+            cur = self.con.execute('select 0, fromid, toid, strength from wordhidden where fromid in (%s) '
+                                   'union all '
+                                   'select 1, fromid, toid, strength from hiddenurl where toid in (%s)' %
+                                   (','.join(['?']*len(words)), ','.join(['?']*len(urls))), words + urls)
+            for (layer, fromid, toid, strength) in cur:
+                if layer == 0: inputs[(fromid, toid)] = strength
+                else: outputs[(fromid, toid)] = strength
+        for w in wordids:
+            for (h, strength) in self.dirtyinput.get(w, {}).items(): inputs[(w, h)] = strength
+        for u in urlids:
+            for (h, strength) in self.dirtyoutput.get(u, {}).items(): outputs[(h, u)] = strength
+        return inputs, outputs
 
     def setupnetwork(self, wordids, urlids):
         # value list
         self.wordids = wordids
-        self.hiddenids = self.getallhiddenids(wordids, urlids)
         self.urlids = urlids
+        inputs, outputs = self.loadweights(wordids, urlids)
+        self.hiddenids = sorted(set([h for (w, h) in inputs] + [h for (h, u) in outputs]))
 
         # node outputs
-        self.activation_input = [1.0]*len(self.wordids)
-        self.activation_hidden = [1.0]*len(self.hiddenids)
-        self.activation_output = [1.0]*len(self.urlids)
-
-        # create weights matrix
-        self.weights_input = [[self.getstrength(wordid, hiddenid, 0)
-                        for hiddenid in self.hiddenids]
-                    for wordid in self.wordids]
-        self.weights_output = [[self.getstrength(hiddenid, urlid, 1)
-                        for urlid in self.urlids]
-                    for hiddenid in self.hiddenids]
+        self.activation_input = numpy.ones(len(self.wordids))
+        self.activation_hidden = numpy.ones(len(self.hiddenids))
+        self.activation_output = numpy.ones(len(self.urlids))
+
+        # create weights matrix, starting from the same defaults as getstrength,
+        # and note which weights exist in the database
+        hiddenindex = dict([(self.hiddenids[j], j) for j in range(len(self.hiddenids))])
+        wordpositions = {}
+        for i in range(len(self.wordids)): wordpositions.setdefault(self.wordids[i], []).append(i)
+        urlpositions = {}
+        for k in range(len(self.urlids)): urlpositions.setdefault(self.urlids[k], []).append(k)
+
+        self.weights_input = numpy.empty((len(self.wordids), len(self.hiddenids)))
+        self.weights_input.fill(-0.2)
+        self.stored_input = numpy.zeros(self.weights_input.shape, dtype=bool)
+        for ((w, h), strength) in inputs.items():
+            for i in wordpositions[w]:
+                self.weights_input[i, hiddenindex[h]] = strength
+                self.stored_input[i, hiddenindex[h]] = True
+
+        self.weights_output = numpy.zeros((len(self.hiddenids), len(self.urlids)))
+        self.stored_output = numpy.zeros(self.weights_output.shape, dtype=bool)
+        for ((h, u), strength) in outputs.items():
+            for k in urlpositions[u]:
+                self.weights_output[hiddenindex[h], k] = strength
+                self.stored_output[hiddenindex[h], k] = True
+
+        # Which weights updatedatabase writes back (all of them for a single
+        # query), and how many times each hidden node was trained on
+        self.changed_input = numpy.ones(self.weights_input.shape, dtype=bool)
+        self.changed_output = numpy.ones(self.weights_output.shape, dtype=bool)
+        self.hiddenused = numpy.ones(len(self.hiddenids), dtype=int)
 
     def feedforward(self):
         # the only inputs are the query words
-        for i in range(len(self.wordids)):
-            self.activation_input[i] = 1.0
+        self.activation_input = numpy.ones(len(self.wordids))
 
         # hidden activations
-        for j in range(len(self.hiddenids)):
-            sum = 0.0
-            for i in range(len(self.wordids)):
-                sum = sum + self.activation_input[i] * self.weights_input[i][j]
-            self.activation_hidden[j] = tanh(sum)
+        self.activation_hidden = numpy.tanh(self.activation_input.dot(self.weights_input))
 
         # output activations
-        for k in range(len(self.urlids)):
-            sum = 0.0
-            for j in range(len(self.hiddenids)):
-                sum = sum + self.activation_hidden[j] * self.weights_output[j][k]
-            self.activation_output[k] = tanh(sum)
+        self.activation_output = numpy.tanh(self.activation_hidden.dot(self.weights_output))
 
-        return self.activation_output[:]
+        return self.activation_output.tolist()
 
     def getresult(self, wordids, urlids):
         self.setupnetwork(wordids, urlids)
@@ -132,30 +296,19 @@ class searchnet:
 
     def backpropagate(self, targets, N = 0.5):
         # calculate the errors for the output
-        output_deltas = [0.0] * len(self.urlids)
-        for k in range(len(self.urlids)):
-            error = targets[k] - self.activation_output[k]
-            output_deltas[k] = dtanh(self.activation_output[k]) * error
+        error = numpy.array(targets) - self.activation_output
+        output_deltas = dtanh(self.activation_output) * error
 
         # calculate errors for hidden layer
-        hidden_deltas = [0.0] * len(self.hiddenids)
-        for j in range(len(self.hiddenids)):
-            error = 0.0
-            for k in range(len(self.urlids)):
-                error = error + output_deltas[k] * self.weights_output[j][k]
-            hidden_deltas[j] = dtanh(self.activation_hidden[j]) * error
+        hidden_deltas = dtanh(self.activation_hidden) * self.weights_output.dot(output_deltas)
 
         # update output weights
-        for j in range(len(self.hiddenids)):
-            for k in range(len(self.urlids)):
-                change = output_deltas[k]*self.activation_hidden[j]
-                self.weights_output[j][k] = self.weights_output[j][k] + N*change
+        self.weights_output += N * numpy.outer(self.activation_hidden, output_deltas)
 
         # update input weights
-        for i in range(len(self.wordids)):
-            for j in range(len(self.hiddenids)):
-                change = hidden_deltas[j]*self.activation_input[i]
-                self.weights_input[i][j] = self.weights_input[i][j] + N*change
+        self.weights_input += N * numpy.outer(self.activation_input, hidden_deltas)
+
+        return 0.5 * (error**2).sum()
 
     def trainquery(self, wordids, urlids, selectedurl):
         # generate a hidden node if necessary
@@ -167,13 +320,78 @@ class searchnet:
         targets[urlids.index(selectedurl)] = 1.0
         error = self.backpropagate(targets)
         self.updatedatabase()
+        return error
+
+    # Set up one network over all the words, hidden nodes and urls of a
+    # list of (wordids, urlids, ...) examples, with a row per example of
+    # its query words, the urls it was shown and the hidden nodes connected
+    # to either. Masking with these gives every example only the part of
+    # the network that setupnetwork would have built for it alone
+    def setupbatch(self, examples):
+        allwords = sorted(set([w for e in examples for w in e[0]]))
+        allurls = sorted(set([u for e in examples for u in e[1]]))
+        self.setupnetwork(allwords, allurls)
+        wordindex = dict([(allwords[i], i) for i in range(len(allwords))])
+        self.urlindex = dict([(allurls[k], k) for k in range(len(allurls))])
+
+        inputs = numpy.zeros((len(examples), len(allwords)))
+        shown = numpy.zeros((len(examples), len(allurls)))
+        for b in range(len(examples)):
+            for w in examples[b][0]: inputs[b, wordindex[w]] += 1.0
+            for u in examples[b][1]: shown[b, self.urlindex[u]] = 1.0
+        hidden = ((inputs > 0).dot(self.stored_input) + shown.dot(self.stored_output.T)) > 0
+        return inputs, shown, hidden
+
+    def feedbatch(self, inputs, shown, hidden):
+        activation_hidden = numpy.tanh(inputs.dot(self.weights_input)) * hidden
+        activation_output = numpy.tanh(activation_hidden.dot(self.weights_output)) * shown
+        return activation_hidden, activation_output
+
+    # getresult for a list of (wordids, urlids) at once
+    def getbatchresults(self, examples):
+        inputs, shown, hidden = self.setupbatch(examples)
+        activation_output = self.feedbatch(inputs, shown, hidden)[1]
+        return [[activation_output[b, self.urlindex[u]] for u in examples[b][1]] for b in range(len(examples))]
+
+    # Train on a list of (wordids, urlids, selectedurl) at once. The changes
+    # from all examples are averaged and applied once, so a batch of one is
+    # the same as trainquery. Returns the average error before the update.
+    def trainbatch(self, examples, N = 0.5):
+        for (wordids, urlids, selectedurl) in examples:
+            self.generatehiddennode(wordids, urlids)
+
+        inputs, shown, hidden = self.setupbatch(examples)
+        targets = numpy.zeros(shown.shape)
+        for b in range(len(examples)):
+            targets[b, self.urlindex[examples[b][2]]] = 1.0
+
+        # feed forward
+        activation_hidden, activation_output = self.feedbatch(inputs, shown, hidden)
+
+        # back propagate
+        error = (targets - activation_output) * shown
+        output_deltas = dtanh(activation_output) * error
+        hidden_deltas = dtanh(activation_hidden) * output_deltas.dot(self.weights_output.T) * hidden
+        rate = float(N) / len(examples)
+        self.weights_output += rate * activation_hidden.T.dot(output_deltas)
+        self.weights_input += rate * inputs.T.dot(hidden_deltas)
+
+        # Only write the weights some example's own network would have had
+        self.changed_input = (inputs > 0).T.dot(hidden) > 0
+        self.changed_output = hidden.T.dot(shown) > 0
+        self.hiddenused = hidden.sum(axis=0)
+        self.updatedatabase()
+        return 0.5 * (error**2).sum() / len(examples)
 
     def updatedatabase(self):
-        # set them to database values
-        for i in range(len(self.wordids)):
-            for j in range(len(self.hiddenids)):
-                self.setstrength(self.wordids[i], self.hiddenids[j], 0, self.weights_input[i][j])
-        for j in range(len(self.hiddenids)):
-            for k in range(len(self.urlids)):
-                self.setstrength(self.hiddenids[j], self.urlids[k], 1, self.weights_output[j][k])
-        self.con.commit()
+        # set them to database values, in the cache until the next flush
+        for (i, j) in zip(*numpy.nonzero(self.changed_input)):
+            self.setstrength(self.wordids[i], self.hiddenids[j], 0, self.weights_input[i, j])
+        for (j, k) in zip(*numpy.nonzero(self.changed_output)):
+            self.setstrength(self.hiddenids[j], self.urlids[k], 1, self.weights_output[j, k])
+        for j in numpy.nonzero(self.hiddenused)[0]:
+            hiddenid = self.hiddenids[j]
+            self.hiddenuses[hiddenid] = self.hiddenuses.get(hiddenid, 0) + int(self.hiddenused[j])
+        self.updates += 1
+        self.generation += 1
+        if self.updates >= self.flushevery: self.flush()
@@ -0,0 +1,137 @@
+import sys
+import time
+import random
+import argparse
+import datastore
+import nn
+
+# Trains the search network offline from a log of clicks, instead of
+# calling trainquery once per click.
+#
+# Each line of the log is one click, tab separated:
+#   query words <TAB> the urls shown, separated by spaces <TAB> the url clicked
+# e.g.
+#   tyrion lannister<TAB>http://a/Tyrion http://a/Jaime http://a/Cersei<TAB>http://a/Tyrion
+#
+# Words and urls are looked up in the search index, and clicks on words or
+# urls it doesn't have are skipped.
+#
+# Usage:
+# 1. python nntrain.py clicks.log searchindex.db nn.db --epochs 5 --batchsize 50
+# 2. import searchengine
+# 3. s=searchengine.searcher('searchindex.db')
+# 4. s.query('tyrion lannister', weights={'nn': 1.0})
+#
+# Step 3 and 4 don't train anything: nnscore reads the weights written to
+# nn.db by step 1.
+
+# Read the log one line at a time as (wordids, urlids, selectedurl)
+def readclicks(filename, con):
+  wordids = {}
+  urlids = {}
+  def lookup(table, field, value, cache):
+    if value not in cache:
+      row = con.execute('select rowid from %s where %s=?' % (table, field), (value,)).fetchone()
+      cache[value] = row and row[0]
+    return cache[value]
+
+  f = open(filename)
+  try:
+    for line in f:
+      parts = line.rstrip('\n').split('\t')
+      if len(parts) != 3: continue
+      words = [lookup('wordlist', 'word', w.lower(), wordids) for w in parts[0].split()]
+      urls = [lookup('urllist', 'url', u, urlids) for u in parts[1].split()]
+      selected = lookup('urllist', 'url', parts[2].strip(), urlids)
+      if len(words) == 0 or None in words or None in urls or selected not in urls: continue
+      yield (words, urls, selected)
+  finally:
+    f.close()
+
+# Split off a random share of the examples to check the training against
+def splitexamples(examples, validation, rnd):
+  train, held = [], []
+  for e in examples:
+    if rnd.random() < validation: held.append(e)
+    else: train.append(e)
+  return train, held
+
+def minibatches(examples, batchsize, rnd):
+  order = examples[:]
+  rnd.shuffle(order)
+  for i in range(0, len(order), batchsize):
+    yield order[i:i+batchsize]
+
+# The error of the network on the examples, and how well it ranks the
+# clicked url among the ones shown: the mean reciprocal rank and how often
+# it comes first. Nothing is trained
+def evaluate(net, examples, batchsize=100):
+  loss = 0.0
+  reciprocal = 0.0
+  first = 0
+  results = []
+  for i in range(0, len(examples), batchsize):
+    results.extend(net.getbatchresults(examples[i:i+batchsize]))
+  for ((wordids, urlids, selectedurl), outputs) in zip(examples, results):
+    selected = outputs[urlids.index(selectedurl)]
+    loss += 0.5 * sum([(o - (u == selectedurl and 1.0 or 0.0))**2 for (o, u) in zip(outputs, urlids)])
+    rank = 1 + len([o for o in outputs if o > selected])
+    reciprocal += 1.0 / rank
+    if rank == 1: first += 1
+  n = max(len(examples), 1)
+  return loss/n, reciprocal/n, float(first)/n
+
+# The same measures if the urls are left in the order they were shown
+def evaluateshown(examples):
+  ranks = [urlids.index(selectedurl)+1 for (wordids, urlids, selectedurl) in examples]
+  n = max(len(examples), 1)
+  return sum([1.0/r for r in ranks])/n, float(len([r for r in ranks if r == 1]))/n
+
+def train(net, examples, epochs=5, batchsize=50, validation=0.1, rate=0.5, seed=0):
+  rnd = random.Random(seed)
+  trainset, heldout = splitexamples(examples, validation, rnd)
+  print 'Training on %d clicks, %d held out' % (len(trainset), len(heldout))
+
+  for epoch in range(epochs):
+    start = time.time()
+    loss = 0.0
+    for batch in minibatches(trainset, batchsize, rnd):
+      loss += net.trainbatch(batch, rate) * len(batch)
+    net.flush()
+    elapsed = time.time() - start
+    line = 'epoch %d: %.0f clicks/s, train loss %.4f' % (
+      epoch+1, len(trainset)/max(elapsed, 1e-9), loss/max(len(trainset), 1))
+    if len(heldout) > 0: line += ', held out loss %.4f' % evaluate(net, heldout)[0]
+    print line
+
+  testset = heldout or trainset
+  loss, mrr, top = evaluate(net, testset)
+  shownmrr, showntop = evaluateshown(testset)
+  print 'Ranking on %d %s clicks: MRR %.3f, clicked first %.1f%% (as shown: MRR %.3f, first %.1f%%)' % (
+    len(testset), heldout and 'held out' or 'training', mrr, 100*top, shownmrr, 100*showntop)
+  return loss, mrr, top
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Train the search network from a click log')
+  parser.add_argument('clicklog')
+  parser.add_argument('indexdb', help='the crawler\'s database, e.g. searchindex.db')
+  parser.add_argument('netdb', help='the network\'s database, e.g. nn.db')
+  parser.add_argument('--epochs', type=int, default=5)
+  parser.add_argument('--batchsize', type=int, default=50)
+  parser.add_argument('--validation', type=float, default=0.1, help='share of clicks held out')
+  parser.add_argument('--rate', type=float, default=0.5, help='learning rate')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--maketables', action='store_true', help='create the tables in a new netdb')
+  args = parser.parse_args()
+
+  con = datastore.connect(args.indexdb)
+  start = time.time()
+  examples = list(readclicks(args.clicklog, con))
+  con.close()
+  print 'Read %d clicks in %.2fs' % (len(examples), time.time()-start)
+  if len(examples) == 0: sys.exit(1)
+
+  net = nn.searchnet(args.netdb)
+  if args.maketables: net.maketables()
+  train(net, examples, args.epochs, args.batchsize, args.validation, args.rate, args.seed)
+  net.close()
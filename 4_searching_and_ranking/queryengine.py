@@ -0,0 +1,368 @@
+import re
+from bisect import bisect_left, bisect_right
+from invertedindex import intersect
+
+# Queries with phrases, proximity and boolean operators, matched against
+# the locations of words on each page rather than by scoring every
+# combination of locations afterwards.
+#
+#   "jon snow"                  the words next to each other, in this order
+#   jon NEAR/5 ygritte          at most 5 words apart, in either order
+#   "jon snow" NEAR/10 wall     NEAR also works with phrases
+#   stark OR lannister          either word
+#   stark NOT "ned stark"       the first but not the second
+#   (stark OR tully) winterfell parentheses group, words next to each other
+#                               without an operator must all be on the page
+#
+# Operators have to be in capitals, anything else is a word. NOT has to
+# have something without NOT next to it, as there is no list of every page
+# to take the excluded ones away from.
+#
+# Usage:
+# 1. import searchengine
+# 2. s=searchengine.searcher('searchindex.db')
+# 3. s.query('"jon snow" NEAR/10 wall')
+# searcher.getmatches uses this for any query with one of the operators in
+# it, and the words it returns can be scored by every scoring function.
+#
+# Or directly, with a function that looks up the ID of a word:
+# 1. node=queryengine.parse('"jon snow" OR ygritte', s.getwordid, searchengine.ignorewords)
+# 2. queryengine.getmatches(node, queryengine.sqlpostings(s.con))
+#
+# Every page has to contain the words of the query, so the pages to check
+# come from intersecting the sorted lists of pages for each word, as for a
+# plain query. For a phrase or NEAR only those pages are checked against
+# the locations, and checking a page stops at the first place it matches.
+
+tokenizer = re.compile(r'"[^"]*"?|[()]|[^\s()"]+')
+nearoperator = re.compile(r'^NEAR/(\d+)$')
+# The same way the crawler splits text into words
+splitter = re.compile(r'\W+')
+
+def isadvanced(q):
+  for token in tokenizer.findall(q):
+    if token[0] in '"()' or token in ('OR', 'NOT') or nearoperator.match(token): return True
+  return False
+
+# Sorted union of sorted lists
+def union(lists):
+  urls = set()
+  for l in lists: urls.update(l)
+  return sorted(urls)
+
+def contains(sortedlist, value):
+  i = bisect_left(sortedlist, value)
+  return i < len(sortedlist) and sortedlist[i] == value
+
+#### Where the words are
+
+# Pages and locations of words from the wordlocation table. Each word's
+# locations are read the first time they are needed
+class sqlpostings:
+  def __init__(self, con):
+    self.con = con
+    self.words = {}
+
+  def load(self, wordid):
+    if wordid not in self.words:
+      locations = {}
+      cur = self.con.execute('select urlid,location from wordlocation where wordid=? order by urlid,location', (wordid,))
+      for (urlid, location) in cur:
+        locations.setdefault(urlid, []).append(location)
+      self.words[wordid] = (sorted(locations), locations)
+    return self.words[wordid]
+
+  def urlids(self, wordid):
+    return self.load(wordid)[0]
+
+  def positions(self, wordid, urlid):
+    return self.load(wordid)[1].get(urlid, [])
+
+# The same from an invertedindex.invertedindex
+class indexpostings:
+  def __init__(self, index):
+    self.index = index
+    self.words = {}
+
+  def urlids(self, wordid):
+    if wordid not in self.words: self.words[wordid] = self.index.urlids(wordid)
+    return self.words[wordid]
+
+  def positions(self, wordid, urlid):
+    urls = self.urlids(wordid)
+    i = bisect_left(urls, urlid)
+    if i == len(urls) or urls[i] != urlid: return []
+    return self.index.positions(wordid, i)
+
+#### Parts of a query
+#
+# Each has:
+#   prepare(postings)  work out the sorted list of pages it could match, in urls
+#   matches(urlid)     whether it matches a page that is in urls
+#   spans(urlid)       the (first, last) locations of each place it matches on
+#                      the page, sorted, for the ones NEAR can be used with
+#   wordids()          the IDs of the words it looks for
+
+class word:
+  def __init__(self, wordid):
+    self.wordid = wordid
+
+  def prepare(self, postings):
+    self.postings = postings
+    if self.wordid == None: self.urls = []
+    else: self.urls = postings.urlids(self.wordid)
+
+  def matches(self, urlid):
+    return True
+
+  def spans(self, urlid):
+    return [(p, p) for p in self.postings.positions(self.wordid, urlid)]
+
+  def wordids(self):
+    if self.wordid == None: return []
+    return [self.wordid]
+
+# Words at fixed distances from the first one. offsets is a list of
+# (distance from the first word, wordid), so that words the crawler doesn't
+# index, like "of", still take up their place
+class phrase:
+  def __init__(self, offsets):
+    self.offsets = offsets
+
+  def prepare(self, postings):
+    self.postings = postings
+    if None in [wordid for (offset, wordid) in self.offsets]:
+      self.urls = []
+    else:
+      self.urls = [urlid for (urlid, idx) in intersect([postings.urlids(wordid) for (offset, wordid) in self.offsets])]
+
+  # Locations where the phrase starts, or just the first one
+  def starts(self, urlid, first=False):
+    positions = [(offset, self.postings.positions(wordid, urlid)) for (offset, wordid) in self.offsets]
+    # Drive from the word with the fewest locations
+    positions.sort(key=lambda p: len(p[1]))
+    lead, leadlocs = positions[0]
+    found = []
+    for loc in leadlocs:
+      start = loc - lead
+      ok = True
+      for (offset, locs) in positions[1:]:
+        if not contains(locs, start + offset):
+          ok = False
+          break
+      if ok:
+        if first: return [start]
+        found.append(start)
+    found.sort()
+    return found
+
+  def matches(self, urlid):
+    return len(self.starts(urlid, first=True)) > 0
+
+  def spans(self, urlid):
+    length = self.offsets[-1][0]
+    return [(s, s + length) for s in self.starts(urlid)]
+
+  def wordids(self):
+    return [wordid for (offset, wordid) in self.offsets if wordid != None]
+
+# Two parts with at most distance words between where one ends and the
+# other starts
+class near:
+  def __init__(self, left, right, distance):
+    self.left = left
+    self.right = right
+    self.distance = distance
+
+  def prepare(self, postings):
+    self.left.prepare(postings)
+    self.right.prepare(postings)
+    self.urls = [urlid for (urlid, idx) in intersect([self.left.urls, self.right.urls])]
+
+  def close(self, a, b):
+    return b[0] - a[1] <= self.distance and a[0] - b[1] <= self.distance
+
+  # For each span on the left, the spans on the right that start soon
+  # enough after it ends are the ones before a point in their list, which
+  # is sorted by start. One of them is close if the latest end among them
+  # is late enough. Spans of an OR of phrases of different lengths don't
+  # end in the same order they start, so this doesn't rely on the ends
+  def matches(self, urlid):
+    a = self.left.spans(urlid)
+    b = self.right.spans(urlid)
+    if len(a) == 0 or len(b) == 0: return False
+    starts = [y[0] for y in b]
+    # latest[k] is the latest end of b[0] to b[k]
+    latest = []
+    for y in b:
+      if len(latest) == 0 or y[1] > latest[-1]: latest.append(y[1])
+      else: latest.append(latest[-1])
+    for x in a:
+      k = bisect_right(starts, x[1] + self.distance)
+      if k > 0 and latest[k-1] >= x[0] - self.distance: return True
+    return False
+
+  def spans(self, urlid):
+    a = self.left.spans(urlid)
+    b = self.right.spans(urlid)
+    found = set()
+    for x in a:
+      for y in b:
+        if self.close(x, y): found.add((min(x[0], y[0]), max(x[1], y[1])))
+    return sorted(found)
+
+  def wordids(self):
+    return self.left.wordids() + self.right.wordids()
+
+# Every one of include, and none of exclude
+class allof:
+  def __init__(self, include, exclude):
+    self.include = include
+    self.exclude = exclude
+
+  def prepare(self, postings):
+    for part in self.include + self.exclude: part.prepare(postings)
+    self.urls = [urlid for (urlid, idx) in intersect([part.urls for part in self.include])]
+
+  def matches(self, urlid):
+    for part in self.include:
+      if not part.matches(urlid): return False
+    for part in self.exclude:
+      if contains(part.urls, urlid) and part.matches(urlid): return False
+    return True
+
+  def wordids(self):
+    return [wordid for part in self.include for wordid in part.wordids()]
+
+class anyof:
+  def __init__(self, parts):
+    self.parts = parts
+
+  def prepare(self, postings):
+    for part in self.parts: part.prepare(postings)
+    self.urls = union([part.urls for part in self.parts])
+
+  def matches(self, urlid):
+    for part in self.parts:
+      if contains(part.urls, urlid) and part.matches(urlid): return True
+    return False
+
+  def spans(self, urlid):
+    found = set()
+    for part in self.parts:
+      if contains(part.urls, urlid) and part.matches(urlid): found.update(part.spans(urlid))
+    return sorted(found)
+
+  def wordids(self):
+    return [wordid for part in self.parts for wordid in part.wordids()]
+
+#### Parsing
+
+# Turn the text of a query into its parts. lookup gives the ID of a word
+# or None if it isn't indexed, and words in ignored, which the crawler
+# leaves out, are skipped. Returns None if nothing is left to look for
+def parse(q, lookup, ignored=()):
+  tokens = tokenizer.findall(q)
+  pos = [0]
+
+  def peek():
+    if pos[0] < len(tokens): return tokens[pos[0]]
+    return None
+
+  def take():
+    pos[0] += 1
+    return tokens[pos[0]-1]
+
+  # A word, a quoted phrase, or something in parentheses
+  def term():
+    token = peek()
+    if token == None or token == ')' or token in ('OR', 'NOT') or nearoperator.match(token): return None
+    take()
+    if token == '(':
+      part = orexpr()
+      if peek() == ')': take()
+      return part
+    # Punctuation splits words the way it does on the page, so jon's is
+    # the phrase "jon s"
+    words = [w.lower() for w in splitter.split(token.strip('"')) if w != '']
+    offsets = [(i, lookup(words[i])) for i in range(len(words)) if words[i] not in ignored]
+    if len(offsets) == 0: return None
+    if len(offsets) == 1 and offsets[0][0] == 0 and len(words) == 1: return word(offsets[0][1])
+    # Measure from the first word that is indexed
+    first = offsets[0][0]
+    return phrase([(offset - first, wordid) for (offset, wordid) in offsets])
+
+  def nearexpr():
+    part = term()
+    while peek() != None and nearoperator.match(peek()):
+      distance = int(nearoperator.match(take()).group(1))
+      right = term()
+      if right == None: break
+      if part == None: part = right
+      else: part = near(part, right, distance)
+    return part
+
+  def andexpr():
+    include, exclude = [], []
+    while True:
+      token = peek()
+      if token == None or token in (')', 'OR'): break
+      if token == 'NOT':
+        take()
+        part = nearexpr()
+        if part != None: exclude.append(part)
+        continue
+      part = nearexpr()
+      if part == None:
+        # Skip anything that can't start a term, like a NEAR with
+        # nothing before it
+        if peek() == token: take()
+        continue
+      include.append(part)
+    if len(include) == 0: return None
+    if len(include) == 1 and len(exclude) == 0: return include[0]
+    return allof(include, exclude)
+
+  def orexpr():
+    parts = []
+    while True:
+      part = andexpr()
+      if part != None: parts.append(part)
+      if peek() == 'OR': take()
+      else: break
+    if len(parts) == 0: return None
+    if len(parts) == 1: return parts[0]
+    return anyof(parts)
+
+  node = None
+  while pos[0] < len(tokens):
+    part = orexpr()
+    if part != None:
+      if node == None: node = part
+      else: node = allof([node, part], [])
+    # A ) without a ( before it
+    if peek() == ')': take()
+  return node
+
+#### Evaluating
+
+# The urlids of the pages the query matches
+def geturlids(node, postings):
+  if node == None: return []
+  node.prepare(postings)
+  return [urlid for urlid in node.urls if node.matches(urlid)]
+
+# The pages the query matches, in the same form as searcher.getmatches:
+# a dict of urlid -> the sorted locations of each query word, and the IDs
+# of the query words. With OR, a page only has locations for the words
+# that are on it. Words after NOT aren't included
+def getmatches(node, postings):
+  if node == None: return {}, []
+  wordids = []
+  for wordid in node.wordids():
+    if wordid not in wordids: wordids.append(wordid)
+  matches = {}
+  for urlid in geturlids(node, postings):
+    positions = [postings.positions(wordid, urlid) for wordid in wordids]
+    matches[urlid] = [locs for locs in positions if len(locs) > 0]
+  return matches, wordids
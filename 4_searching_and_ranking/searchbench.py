@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import searchengine
+import datastore
+import concurrentcrawl
+import invertedindex
+import nn
+
+# Crawls, indexes and queries a made up site served from this machine, and
+# reports how long each part takes, how big the index is, and how fast and
+# how well the searcher answers a fixed set of queries with each scoring
+# function on its own and with all of them together.
+#
+# The site and the queries only depend on the seed, so runs with the same
+# options can be compared across commits:
+# 1. python searchbench.py --out before.json
+# 2. (change something)
+# 3. python searchbench.py --out after.json --compare before.json
+#
+# Every page belongs to one of a number of topics. Most of its words and
+# links are from its own topic, and queries use a topic's words, so the
+# pages of the query's topic are the ones that should come back. That
+# gives a precision for the top results alongside the latency.
+#
+# or
+# 1. import searchbench
+# 2. results=searchbench.run(pages=500, queries=200)
+
+# The scorers a query can be ranked with, as in searchengine.defaultweights,
+# plus the ones that are off unless asked for
+scorers = ['frequency', 'location', 'distance', 'inboundlink', 'pagerank', 'linktext', 'nn']
+
+def makecorpus(pages=300, topics=10, words=300, links=10, seed=0):
+  rnd = random.Random(seed)
+  common = ['word%d' % i for i in range(1000)]
+  # Each topic has 100 words, and shares 40 of them with the next topic, so
+  # a query can match pages of more than one topic
+  topicwords = [['topicword%d' % ((60*t + i) % (60*topics)) for i in range(100)] for t in range(topics)]
+  topicof = dict([(i, i % topics) for i in range(pages)])
+  bytopic = [[i for i in range(pages) if topicof[i] == t] for t in range(topics)]
+
+  site = {}
+  for i in range(pages):
+    t = topicof[i]
+    # Two of every three words and four of every five links stay in the topic
+    body = ' '.join([rnd.random() < 0.66 and rnd.choice(topicwords[t]) or rnd.choice(common)
+                     for j in range(words)])
+    anchors = []
+    for j in range(links):
+      if rnd.random() < 0.8: target = rnd.choice(bytopic[t])
+      else: target = rnd.randint(0, pages-1)
+      anchors.append('<a href="/page%d.html">%s</a>\n' % (target, rnd.choice(topicwords[topicof[target]])))
+    site['/page%d.html' % i] = '<html><head><title>Page %d</title></head><body><p>%s</p>%s</body></html>' % (
+      i, body, ''.join(anchors))
+  # The index links to every page, so a crawl of depth 2 finds all of them
+  site['/index.html'] = '<html><body>%s</body></html>' % ''.join(
+    ['<a href="/page%d.html">page</a>\n' % i for i in range(pages)])
+  return site, topicof, topicwords
+
+# A fixed list of (query, topic) with one to three words from one topic
+def makequeries(topicwords, count=200, seed=0):
+  rnd = random.Random(seed)
+  queries = []
+  for i in range(count):
+    t = rnd.randrange(len(topicwords))
+    queries.append((' '.join(rnd.sample(topicwords[t], rnd.randint(1, 3))), t))
+  return queries
+
+# The weights to rank with: every scorer alone, then the default mix
+def makeconfigs():
+  configs = [(name, {name: 1.0}) for name in scorers]
+  configs.append(('default', searchengine.defaultweights))
+  return configs
+
+def percentile(values, p):
+  if len(values) == 0: return 0.0
+  ordered = sorted(values)
+  return ordered[min(len(ordered)-1, int(p/100.0*len(ordered)))]
+
+def filesize(*names):
+  return sum([os.path.getsize(name) for name in names if os.path.exists(name)])
+
+def gitrevision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def pageid(url):
+  return int(url.rsplit('/page', 1)[1].split('.')[0])
+
+# Crawl and index the site, and calculate PageRank
+def buildindex(site, dbname, indexfile, workers=8):
+  results = {}
+  server = concurrentcrawl.servesite(site)
+  try:
+    c = searchengine.crawler(dbname, pragmas=datastore.walpragmas)
+    c.createindextables()
+    engine = concurrentcrawl.crawlengine(c, workers=workers, perhost=workers)
+    # The crawler prints every page it indexes
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    engine.crawl([concurrentcrawl.siteurl(server)], depth=2)
+    results['crawlseconds'] = time.time() - start
+  finally:
+    sys.stdout = stdout
+    server.shutdown()
+  results['pages'] = engine.stats['indexed']
+  results['crawlpagespersec'] = results['pages'] / max(results['crawlseconds'], 1e-9)
+
+  start = time.time()
+  c.calculatepagerank()
+  results['pagerankseconds'] = time.time() - start
+
+  start = time.time()
+  invertedindex.buildindex(c.con, indexfile)
+  results['invertedindexseconds'] = time.time() - start
+
+  for table in ['wordlist', 'urllist', 'wordlocation', 'link', 'linkwords']:
+    results[table + 'rows'] = c.con.execute('select count(*) from %s' % table).fetchone()[0]
+  c.con.execute('pragma wal_checkpoint(truncate)').fetchall()
+  c.con.close()
+  results['dbbytes'] = filesize(dbname, dbname + '-wal')
+  results['indexbytes'] = filesize(indexfile)
+  return results
+
+# Teach the network that queries go to pages of their own topic, so that
+# the nn scorer has something to go on
+def trainnet(s, net, queries, topicof, seed=0):
+  rnd = random.Random(seed)
+  examples = []
+  for (q, t) in queries:
+    wordids, results = s.rankquery(q, 10, {'frequency': 1.0})
+    urlids = [urlid for (score, urlid, url) in results]
+    relevant = [urlid for (score, urlid, url) in results if topicof[pageid(url)] == t]
+    if len(relevant) > 0: examples.append((wordids, urlids, rnd.choice(relevant)))
+  for i in range(0, len(examples), 50): net.trainbatch(examples[i:i+50])
+  net.flush()
+  return len(examples)
+
+# Run every query with each set of weights. Returns, for each set, the
+# latencies in milliseconds and the share of the top 10 results that are
+# from the query's topic
+def runqueries(s, queries, topicof, configs, n=10):
+  results = []
+  for (name, weights) in configs:
+    latencies = []
+    relevant = 0
+    returned = 0
+    start = time.time()
+    for (q, t) in queries:
+      qstart = time.time()
+      wordids, ranked = s.rankquery(q, n, weights)
+      latencies.append(1000*(time.time() - qstart))
+      returned += len(ranked)
+      relevant += len([url for (score, urlid, url) in ranked if topicof[pageid(url)] == t])
+    elapsed = time.time() - start
+    results.append({'name': name,
+                    'p50ms': percentile(latencies, 50),
+                    'p95ms': percentile(latencies, 95),
+                    'p99ms': percentile(latencies, 99),
+                    'queriespersec': len(queries) / max(elapsed, 1e-9),
+                    'precision': float(relevant) / max(returned, 1)})
+  return results
+
+def run(pages=300, topics=10, queries=200, seed=0, useindex=True, workers=8):
+  site, topicof, topicwords = makecorpus(pages, topics, seed=seed)
+  workload = makequeries(topicwords, queries, seed)
+  tmpdir = tempfile.mkdtemp()
+  dbname = os.path.join(tmpdir, 'searchindex.db')
+  indexfile = os.path.join(tmpdir, 'searchindex.idx')
+  netdb = os.path.join(tmpdir, 'nn.db')
+  try:
+    results = {'revision': gitrevision(), 'options': {'pages': pages, 'topics': topics, 'queries': queries,
+                                                      'seed': seed, 'useindex': useindex}}
+    results['index'] = buildindex(site, dbname, indexfile, workers)
+
+    net = nn.searchnet(netdb)
+    net.maketables()
+    # cachesize=0 so every query is run rather than answered from the cache
+    s = searchengine.searcher(dbname, indexfile=useindex and indexfile or None, cachesize=0, netdb=netdb,
+                              pragmas=datastore.walpragmas)
+    s.loadscoretables()
+    trainnet(s, net, workload, topicof, seed)
+    results['queries'] = runqueries(s, workload, topicof, makeconfigs())
+    s.net.close()
+    net.close()
+  finally:
+    for name in os.listdir(tmpdir): os.remove(os.path.join(tmpdir, name))
+    os.rmdir(tmpdir)
+  return results
+
+def printresults(results, baseline=None):
+  index = results['index']
+  print 'revision %s, %d pages' % (results['revision'], index['pages'])
+  print 'crawl     %8.2fs %8.1f pages/sec' % (index['crawlseconds'], index['crawlpagespersec'])
+  print 'pagerank  %8.2fs' % index['pagerankseconds']
+  print 'invindex  %8.2fs' % index['invertedindexseconds']
+  print 'size      %8.1f KB database, %.1f KB inverted index, %d words, %d locations, %d links' % (
+    index['dbbytes']/1024.0, index['indexbytes']/1024.0,
+    index['wordlistrows'], index['wordlocationrows'], index['linkrows'])
+  before = {}
+  if baseline != None:
+    before = dict([(r['name'], r) for r in baseline['queries']])
+    print 'compared with revision %s (old -> new)' % baseline['revision']
+  print '%-12s %9s %9s %9s %10s %9s' % ('scorer', 'p50 ms', 'p95 ms', 'p99 ms', 'queries/s', 'P@10')
+  for r in results['queries']:
+    print '%-12s %9.2f %9.2f %9.2f %10.1f %9.3f' % (
+      r['name'], r['p50ms'], r['p95ms'], r['p99ms'], r['queriespersec'], r['precision'])
+    if r['name'] in before:
+      b = before[r['name']]
+      print '%-12s %9.2f %9.2f %9.2f %10.1f %9.3f' % (
+        '  was', b['p50ms'], b['p95ms'], b['p99ms'], b['queriespersec'], b['precision'])
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark crawling, indexing and searching a made up site')
+  parser.add_argument('--pages', type=int, default=300)
+  parser.add_argument('--topics', type=int, default=10)
+  parser.add_argument('--queries', type=int, default=200)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=8)
+  parser.add_argument('--noindex', action='store_true', help='match words with SQL instead of the inverted index')
+  parser.add_argument('--out', help='save the results as JSON')
+  parser.add_argument('--compare', help='JSON results of an earlier run to show next to these')
+  args = parser.parse_args()
+
+  baseline = None
+  if args.compare:
+    baseline = json.load(open(args.compare))
+    if baseline['options'] != {'pages': args.pages, 'topics': args.topics, 'queries': args.queries,
+                               'seed': args.seed, 'useindex': not args.noindex}:
+      print 'warning: %s was run with other options: %s' % (args.compare, baseline['options'])
+
+  results = run(args.pages, args.topics, args.queries, args.seed, not args.noindex, args.workers)
+  printresults(results, baseline)
+  if args.out:
+    f = open(args.out, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
@@ -1,13 +1,123 @@
 import urllib2
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
 from urlparse import urljoin
 import sqlite3 as sqlite
 import re
+import datastore
+import numpy
+import heapq
+from collections import deque, OrderedDict
 import nn
+import invertedindex
+import queryengine
 mynet = nn.searchnet('nn.db')
 
 ignorewords = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it'])
 
+# How much each scoring function counts towards a result's score when
+# searcher.query/search aren't given weights of their own
+defaultweights = {'frequency': 1.0,
+                  'location': 1.0,
+                  'pagerank': 1.0,
+                  'linktext': 1.0,
+                  'nn': 1.0}
+
+# Smallest total distance between consecutive query words on a page, choosing
+# one location for each word. positions holds the sorted locations of each
+# word. Gives the same answer as trying every combination of locations, but
+# only ever walks each list of locations twice
+def mindistance(positions):
+  # (location, best total distance to get to this location)
+  best = [(p, 0) for p in positions[0]]
+  for locs in positions[1:]:
+    costs = [None]*len(locs)
+    # Coming from a location at or before p costs cost+(p-q)
+    j = 0
+    lowest = None
+    for i in range(len(locs)):
+      while j < len(best) and best[j][0] <= locs[i]:
+        if lowest == None or best[j][1]-best[j][0] < lowest: lowest = best[j][1]-best[j][0]
+        j += 1
+      if lowest != None: costs[i] = lowest+locs[i]
+    # Coming from a location at or after p costs cost+(q-p)
+    j = len(best)-1
+    lowest = None
+    for i in range(len(locs)-1, -1, -1):
+      while j >= 0 and best[j][0] >= locs[i]:
+        if lowest == None or best[j][1]+best[j][0] < lowest: lowest = best[j][1]+best[j][0]
+        j -= 1
+      if lowest != None and (costs[i] == None or lowest-locs[i] < costs[i]): costs[i] = lowest-locs[i]
+    best = zip(locs, costs)
+  return min([cost for (p, cost) in best])
+
+# All the text of a page or part of one, without the tags. Every piece of
+# text goes on its own line, so words in different tags are never joined.
+# The tree is walked in document order without recursion, and the text is
+# joined once at the end
+def extracttext(soup):
+  if isinstance(soup, NavigableString): return unicode(soup)
+  return '\n'.join([t for t in soup.descendants if isinstance(t, NavigableString)])
+
+# Runs of letters, digits and _, which is what separatewords has always
+# split text into
+wordpattern = re.compile(r'\w+')
+
+# A light English stemmer that only strips plurals, -ing and -ed. Any
+# function of a word can be given to wordsplitter instead, e.g.
+# nltk.stem.PorterStemmer().stem
+def stemword(word):
+  if len(word) <= 3 or word.endswith('ss'): return word
+  if word.endswith('sses'): return word[:-2]
+  if word.endswith('ies'): return word[:-3]+'y'
+  if word.endswith('s'): return word[:-1]
+  for suffix in ('ing', 'ed'):
+    if word.endswith(suffix) and len(word)-len(suffix) >= 3:
+      stem = word[:-len(suffix)]
+      # running -> run, but not falling -> fal
+      if stem[-1] == stem[-2] and stem[-1] not in 'aeioulsz': stem = stem[:-1]
+      return stem
+  return word
+
+# Splits text into lowercase words, and optionally drops stop words and
+# stems the rest as it goes. A stop word is replaced by None rather than
+# removed, so that the words after it keep their locations, the same as
+# with ignorewords. Give the same splitter to the crawler and the searcher:
+# 1. splitter=searchengine.wordsplitter(stopwords=set(['a', 'an']), stemmer=searchengine.stemword)
+# 2. crawler=searchengine.crawler('searchindex.db', splitter=splitter)
+# 3. s=searchengine.searcher('searchindex.db', splitter=splitter)
+class wordsplitter:
+  def __init__(self, stopwords=None, stemmer=None):
+    self.stopwords = stopwords or set()
+    self.stemmer = stemmer
+    # word -> stem, as the same words come up over and over
+    self.stems = {}
+
+  # A single word the way it is indexed, or None for a stop word
+  def normalize(self, word):
+    word = word.lower()
+    if word in self.stopwords: return None
+    if self.stemmer == None: return word
+    if word not in self.stems: self.stems[word] = self.stemmer(word)
+    return self.stems[word]
+
+  def split(self, text):
+    if not self.stopwords and self.stemmer == None:
+      return [w.lower() for w in wordpattern.findall(text)]
+    stopwords = self.stopwords
+    stemmer = self.stemmer
+    stems = self.stems
+    words = []
+    for w in wordpattern.findall(text):
+      w = w.lower()
+      if w in stopwords:
+        words.append(None)
+      elif stemmer == None:
+        words.append(w)
+      else:
+        if w not in stems: stems[w] = stemmer(w)
+        words.append(stems[w])
+    return words
+
 # Usage:
 # 1. import searchengine
 # 2. crawler=searchengine.crawler('searchindex.db')
@@ -15,11 +125,25 @@ ignorewords = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it'])
 # 4. crawler.crawl(['http://gameofthrones.wikia.com/wiki/Game_of_Thrones_Wiki'])
 # 5. To check if the crawling worked or not:
 #      [row for row in crawler.con.execute('select rowid from wordlocation where wordid=1')]
+# 6. To index in batches instead of one statement at a time:
+#      crawler.crawl(pages, batchsize=50)
+# To crawl into a database in WAL mode, so it can be searched while the
+# crawler writes to it:
+#   crawler=searchengine.crawler('searchindex.db', pragmas=datastore.walpragmas)
 
 class crawler:
-  # Initialize the crawler with the name of the database
-  def __init__(self, dbname):
-    self.con = sqlite.connect(dbname)
+  # Initialize the crawler with the name of the database, and optionally
+  # a wordsplitter with stop words or a stemmer, and the pragmas for
+  # datastore.connect
+  def __init__(self, dbname, splitter=None, pragmas=None):
+    self.con = datastore.connect(dbname, pragmas)
+    self.splitter = splitter or wordsplitter()
+    # In-process word->rowid and url->rowid caches for batched indexing
+    self.wordcache = {}
+    self.urlcache = {}
+    # Pages gathered by queuepage that haven't been written yet
+    self.pending = []
+    self.pendingurls = set()
 
   def __del__(self):
     self.con.close()
@@ -29,10 +153,10 @@ class crawler:
 
   # Auxilliary function for getting an entry id and adding it if it's not present
   def getentryid(self, table, field, value, createnew = True):
-    cur=self.con.execute("select rowid from %s where %s='%s'" % (table,field,value))
+    cur=self.con.execute("select rowid from %s where %s=?" % (table,field),(value,))
     res=cur.fetchone( )
     if res==None:
-      cur=self.con.execute("insert into %s (%s) values ('%s')" % (table,field,value))
+      cur=self.con.execute("insert into %s (%s) values (?)" % (table,field),(value,))
       return cur.lastrowid
     else:
       return res[0]
@@ -52,35 +176,26 @@ class crawler:
     # Link each word to this url
     for i in range(len(words)):
       word=words[i]
-      if word in ignorewords: continue
+      if word==None or word in ignorewords: continue
       wordid=self.getentryid('wordlist','word',word)
-      self.con.execute("insert into wordlocation(urlid,wordid,location) values (%d,%d,%d)" % (urlid,wordid,i))
+      self.con.execute("insert into wordlocation(urlid,wordid,location) values (?,?,?)",(urlid,wordid,i))
 
   # Extract the text from an HTML page (no tags)
   def gettextonly(self, soup):
-    v=soup.string
-    if v == None:
-      c=soup.contents
-      resulttext=''
-      for t in c:
-        subtext=self.gettextonly(t)
-        resulttext+=subtext+'\n'
-      return resulttext
-    else:
-      return v.strip()
+    return extracttext(soup)
 
   # Separate the words by any nonalphanumeric character
   # i.e. anything special character that is not a letter or number e.g. [,.<
   def separatewords(self, text):
-    splitter=re.compile('\\W*')
-    return [s.lower() for s in splitter.split(text) if s!='']
+    return self.splitter.split(text)
 
   # Return true if this url is already indexed
   def isindexed(self, url):
-    u=self.con.execute("select rowid from urllist where url='%s'" % url).fetchone()
+    if url in self.pendingurls: return True
+    u=self.con.execute("select rowid from urllist where url=?",(url,)).fetchone()
     if u!=None:
       # Check if it has actually been crawled
-      v=self.con.execute('select * from wordlocation where urlid=%d' % u[0]).fetchone()
+      v=self.con.execute('select * from wordlocation where urlid=?',(u[0],)).fetchone()
       if v!=None: return True
     return False
 
@@ -90,16 +205,119 @@ class crawler:
     fromid = self.getentryid('urllist', 'url', urlFrom)
     toid = self.getentryid('urllist', 'url', urlTo)
     if fromid == toid: return
-    cur = self.con.execute("insert into link(fromid,toid) values (%d,%d)" % (fromid,toid))
+    cur = self.con.execute("insert into link(fromid,toid) values (?,?)",(fromid,toid))
     linkid = cur.lastrowid
     for word in words:
-      if word in ignorewords: continue
+      if word==None or word in ignorewords: continue
       wordid = self.getentryid('wordlist','word', word)
-      self.con.execute("insert into linkwords(linkid,wordid) values (%d,%d)" % (linkid,wordid))
+      self.con.execute("insert into linkwords(linkid,wordid) values (?,?)",(linkid,wordid))
+
+  # Get the (url, link text) of every link on a page
+  def getlinks(self, page, soup):
+    links=[]
+    for link in soup('a'):
+      if ('href' in dict(link.attrs)):
+        #E.g. urljoin('http://google.com', 'www.haha.org') gives http://google.com/www.haha.org
+        #But url = urljoin('http://google.com', '//www.haha.org') gives http://www.haha.org
+        url=urljoin(page,link['href'])
+        url=url.split('#')[0]  # remove location portion
+        links.append((url,self.gettextonly(link)))
+    return links
+
+  # Batched indexing: gather a page's words and links in memory. Nothing
+  # is written until flushindex is called
+  def queuepage(self, url, soup):
+    if self.isindexed(url): return []
+    links=self.getlinks(url,soup)
+    self.queuewords(url,self.separatewords(self.gettextonly(soup)),
+                    [(u,self.separatewords(t)) for (u,t) in links])
+    return links
+
+  # Queue a page that has already been parsed: its words in order, and
+  # the (url, words of the link text) of every link on it
+  def queuewords(self, url, words, links):
+    print 'Indexing '+url
+    self.pending.append((url,words,links))
+    self.pendingurls.add(url)
+
+  # Look up the rowids of many entries at once, adding the ones that
+  # aren't there yet. Results are kept in cache so each value is only
+  # looked up once per crawler
+  def getentryids(self, table, field, values, cache):
+    missing=[v for v in set(values) if v not in cache]
+    if missing:
+      self.selectentryids(table, field, missing, cache)
+      new=[v for v in missing if v not in cache]
+      if new:
+        self.con.executemany('insert into %s (%s) values (?)' % (table,field), [(v,) for v in new])
+        self.selectentryids(table, field, new, cache)
+    return cache
+
+  def selectentryids(self, table, field, values, cache):
+    # sqlite allows at most 999 parameters per statement
+    for i in range(0, len(values), 500):
+      chunk=values[i:i+500]
+      cur=self.con.execute('select %s,rowid from %s where %s in (%s)' %
+                           (field, table, field, ','.join(['?']*len(chunk))), chunk)
+      for (value,rowid) in cur: cache[value]=rowid
+
+  # Write every queued page in a single transaction
+  def flushindex(self):
+    if len(self.pending)==0: return
+    words=set()
+    urls=set()
+    for (url,pagewords,links) in self.pending:
+      urls.add(url)
+      words.update(pagewords)
+      for (linkurl,linkwords) in links:
+        urls.add(linkurl)
+        words.update(linkwords)
+    words.difference_update(ignorewords)
+    words.discard(None)
+
+    try:
+      wordids=self.getentryids('wordlist','word',words,self.wordcache)
+      urlids=self.getentryids('urllist','url',urls,self.urlcache)
+
+      locations=[]
+      linkrefs=[]
+      linkwords=[]
+      # Rowids of a table nobody deletes from are handed out in order, so
+      # the links inserted below will get the ids that follow this one
+      linkid=self.con.execute('select max(rowid) from link').fetchone()[0] or 0
+      for (url,pagewords,links) in self.pending:
+        urlid=urlids[url]
+        for i in range(len(pagewords)):
+          if pagewords[i]==None or pagewords[i] in ignorewords: continue
+          locations.append((urlid,wordids[pagewords[i]],i))
+        for (linkurl,anchorwords) in links:
+          toid=urlids[linkurl]
+          if toid==urlid: continue
+          linkid+=1
+          linkrefs.append((urlid,toid))
+          for word in anchorwords:
+            if word==None or word in ignorewords: continue
+            linkwords.append((wordids[word],linkid))
+
+      self.con.executemany('insert into wordlocation(urlid,wordid,location) values (?,?,?)', locations)
+      self.con.executemany('insert into link(fromid,toid) values (?,?)', linkrefs)
+      self.con.executemany('insert into linkwords(wordid,linkid) values (?,?)', linkwords)
+      self.dbcommit()
+    except:
+      # Nothing from the batch is kept, including the cached ids of
+      # words and urls that were inserted as part of it
+      self.con.rollback()
+      self.wordcache.clear()
+      self.urlcache.clear()
+      raise
+    finally:
+      self.pending=[]
+      self.pendingurls=set()
 
   # Starting with a list of pages, do a breadth first search to the given depth, indexing pages
-  # as we go
-  def crawl(self,pages,depth=2):
+  # as we go. With a batchsize, pages are written batchsize at a time by flushindex,
+  # and an error writing them is raised rather than skipping the batch
+  def crawl(self,pages,depth=2,batchsize=0):
     for i in range(depth):
       newpages={}
       for page in pages:
@@ -110,25 +328,26 @@ class crawler:
           continue
         try:
           soup=BeautifulSoup(c.read())
-          self.addtoindex(page,soup)
-
-          links=soup('a')
-          for link in links:
-            if ('href' in dict(link.attrs)):
-              #E.g. urljoin('http://google.com', 'www.haha.org') gives http://google.com/www.haha.org
-              #But url = urljoin('http://google.com', '//www.haha.org') gives http://www.haha.org
-              url=urljoin(page,link['href'])
-              if url.find("'")!=-1: continue
-              url=url.split('#')[0]  # remove location portion
-              if url[0:4]=='http' and not self.isindexed(url):
-                newpages[url]=1
-              linkText=self.gettextonly(link)
+          if batchsize:
+            links=self.queuepage(page,soup)
+          else:
+            self.addtoindex(page,soup)
+            links=self.getlinks(page,soup)
+            for (url,linkText) in links:
               self.addlinkref(page,url,linkText)
+            self.dbcommit()
 
-          self.dbcommit()
+          for (url,linkText) in links:
+            if url[0:4]=='http' and not self.isindexed(url):
+              newpages[url]=1
         except:
           print "Could not parse page %s" % page
 
+        # Outside the try above, so that a database error stops the crawl
+        # rather than being reported as a page that couldn't be parsed
+        if batchsize and len(self.pending)>=batchsize: self.flushindex()
+
+      if batchsize: self.flushindex()
       pages=newpages
 
   # Create the database tables
@@ -148,111 +367,458 @@ class crawler:
   # import searchengine
   # crawler=searchengine.crawler('searchindex.db')
   # crawler.calculatepagerank()
+  # Iterates until no score moves by more than tolerance (or for at most
+  # iterations rounds), entirely in memory
 
   # To test if it worked:
   # cur=crawler.con.execute('select * from pagerank order by score desc')
   # for i in range(3): print cur.next()
   # e.geturlname(438)
-  def calculatepagerank(self, iterations = 20):
+  # With warmstart, iteration starts from the scores already in the
+  # pagerank table, which takes fewer iterations when little has changed
+  def calculatepagerank(self, iterations = 100, tolerance = 1e-6, damping = 0.85, warmstart = False):
+    self.flushindex()
+    urlids, indptr, indices, outcount = self.getlinkgraph()
+    n = len(urlids)
+
+    #initialize every url with a PageRank of 1
+    pr = numpy.ones(n)
+    if warmstart:
+      try:
+        old = numpy.array(self.con.execute('select urlid,score from pagerank').fetchall()).reshape(-1, 2)
+      except sqlite.OperationalError:
+        old = numpy.zeros((0, 2))
+      idx = numpy.searchsorted(urlids, old[:,0].astype(numpy.int64))
+      found = (idx < n) & (urlids[numpy.minimum(idx, n-1)] == old[:,0]) if n > 0 else idx < 0
+      pr[idx[found]] = old[found,1]
+    rowlengths = numpy.diff(indptr)
+    dangling = outcount == 0
+    safecount = numpy.where(dangling, 1, outcount)
+
+    done = 0
+    for i in range(iterations):
+      done += 1
+      # Every page hands its PageRank out evenly over its links. Pages
+      # without any links share theirs with every page instead
+      contrib = numpy.where(dangling, 0.0, pr/safecount)
+      inbound = numpy.bincount(indices, weights=numpy.repeat(contrib, rowlengths), minlength=n)
+      newpr = (1-damping) + damping*(inbound + pr[dangling].sum()/n)
+      change = numpy.abs(newpr-pr).max() if n > 0 else 0.0
+      pr = newpr
+      if change < tolerance: break
+    print "Finished after %d iterations" % done
+
     # clear out the current PageRank tables
     self.con.execute('drop table if exists pagerank')
     self.con.execute('create table pagerank(urlid primary key,score)')
-
-    #initialize every url with a PageRank of 1
-    self.con.execute('insert into pagerank select rowid, 1.0 from urllist')
+    self.con.executemany('insert into pagerank(urlid,score) values (?,?)',
+                         zip(urlids.tolist(), pr.tolist()))
+
+    # Remember enough about this run for updatepagerank to carry on from it
+    danglingsum = pr[dangling].sum() if n > 0 else 0.0
+    lastlinkid = self.con.execute('select max(rowid) from link').fetchone()[0] or 0
+    lasturlid = int(urlids[-1]) if n > 0 else 0
+    self.savepagerankstate((1-damping) + (damping*danglingsum/n if n > 0 else 0.0),
+                           danglingsum, n, lastlinkid, lasturlid, damping)
+    self.dbcommit()
+    return pr
+
+  def savepagerankstate(self, teleport, danglingsum, urlcount, lastlinkid, lasturlid, damping):
+    self.con.execute('drop table if exists pagerankstate')
+    self.con.execute('create table pagerankstate(teleport,danglingsum,urlcount,lastlinkid,lasturlid,damping)')
+    self.con.execute('insert into pagerankstate values (?,?,?,?,?,?)',
+                     (teleport, danglingsum, urlcount, lastlinkid, lasturlid, damping))
+
+  # Bring the PageRank table up to date after more pages have been crawled,
+  # starting from the previous scores and only visiting the pages whose
+  # scores actually move.
+  #
+  # Every page's score is teleport + damping*(its share of the scores of
+  # the pages linking to it), where teleport includes the scores of pages
+  # with no links shared out over every page. While holding teleport
+  # fixed, the pages that gained links push the change in their shares
+  # to the pages they link to, and every page that moves by more than
+  # tolerance pushes its change on in turn (new pages start at 0 and push
+  # the whole teleport). Scores are proportional to teleport, so once the
+  # pushes settle, teleport is corrected by rescaling every score in one
+  # statement, and only when that changes them by more than tolerance.
+  # Each update can leave scores off by about tolerance/(1-damping), so
+  # run calculatepagerank now and then to start afresh.
+  #
+  # When the change reaches so much of the graph that the pushes would cost
+  # more than maxpushes (by default one per page), this gives up and runs
+  # calculatepagerank from the previous scores instead.
+  #
+  # import searchengine
+  # crawler=searchengine.crawler('searchindex.db')
+  # crawler.calculatepagerank()
+  # crawler.crawl(morepages)
+  # crawler.updatepagerank()
+  def updatepagerank(self, tolerance = 1e-6, damping = 0.85, maxpushes = None):
+    self.flushindex()
+    try:
+      state = self.con.execute('select * from pagerankstate').fetchone()
+    except sqlite.OperationalError:
+      state = None
+    if state == None or state[5] != damping:
+      return self.calculatepagerank(tolerance = tolerance, damping = damping)
+    teleport, danglingsum, urlcount, lastlinkid, lasturlid = state[0:5]
+    if maxpushes == None: maxpushes = urlcount
+
+    newurls = [r[0] for r in self.con.execute('select rowid from urllist where rowid>?', (lasturlid,))]
+    changed = [r[0] for r in self.con.execute('select distinct fromid from link where rowid>?', (lastlinkid,))]
+
+    # Scores from the last run, read as they are needed
+    scores = {}
+    def score(urlid):
+      if urlid not in scores:
+        if urlid > lasturlid:
+          scores[urlid] = 0.0
+        else:
+          row = self.con.execute('select score from pagerank where urlid=?', (urlid,)).fetchone()
+          scores[urlid] = row[0] if row != None else 0.0
+      return scores[urlid]
+
+    # Distinct pages linked from a page, and its number of links
+    outlinks = {}
+    def getoutlinks(urlid):
+      if urlid not in outlinks:
+        cur = self.con.execute('select toid,count(*) from link where fromid=? group by toid', (urlid,))
+        targets = []
+        count = 0
+        for (toid, c) in cur:
+          targets.append(toid)
+          count += c
+        outlinks[urlid] = (targets, count)
+      return outlinks[urlid]
+
+    residual = dict([(u, teleport) for u in newurls])
+    for u in changed:
+      x = score(u)
+      if x == 0.0: continue
+      oldtargets = set()
+      oldcount = 0
+      for (toid, isold) in self.con.execute('select toid,rowid<=? from link where fromid=?', (lastlinkid, u)):
+        if isold:
+          oldtargets.add(toid)
+          oldcount += 1
+      # This page used to have no links, so it was counted in teleport
+      if oldcount == 0: danglingsum -= x
+      targets, count = getoutlinks(u)
+      for v in targets:
+        residual[v] = residual.get(v, 0.0) + damping*x/count
+      for v in oldtargets:
+        residual[v] = residual.get(v, 0.0) - damping*x/oldcount
+
+    # Push residuals until none is bigger than tolerance
+    delta = {}
+    pushes = 0
+    queue = deque([v for v in residual if abs(residual[v]) > tolerance])
+    queued = set(queue)
+    while queue:
+      v = queue.popleft()
+      queued.discard(v)
+      r = residual.pop(v)
+      delta[v] = delta.get(v, 0.0) + r
+      pushes += 1
+      if pushes > maxpushes:
+        print 'Change reached too much of the graph, recalculating'
+        self.calculatepagerank(tolerance = tolerance, damping = damping, warmstart = True)
+        return self.con.execute('select count(*) from urllist').fetchone()[0]
+      targets, count = getoutlinks(v)
+      if count == 0:
+        danglingsum += r
+        continue
+      share = damping*r/count
+      for w in targets:
+        residual[w] = residual.get(w, 0.0) + share
+        if abs(residual[w]) > tolerance and w not in queued:
+          queue.append(w)
+          queued.add(w)
+
+    self.con.executemany('insert into pagerank(urlid,score) values (?,0.0)', [(u,) for u in newurls])
+    self.con.executemany('update pagerank set score=score+? where urlid=?',
+                         [(d, u) for (u, d) in delta.items()])
+
+    # Correct teleport for the new number of pages and the new total
+    # score of pages with no links
+    urlcount += len(newurls)
+    newteleport = (1-damping)/(1 - damping*danglingsum/(teleport*urlcount))
+    factor = newteleport/teleport
+    rescaled = abs(factor-1) > tolerance
+    if rescaled:
+      self.con.execute('update pagerank set score=score*?', (factor,))
+      danglingsum *= factor
+      teleport = newteleport
+
+    lastlinkid = self.con.execute('select max(rowid) from link').fetchone()[0] or 0
+    lasturlid = self.con.execute('select max(rowid) from urllist').fetchone()[0] or 0
+    self.savepagerankstate(teleport, danglingsum, urlcount, lastlinkid, lasturlid, damping)
     self.dbcommit()
 
-    for i in range(iterations):
-      print "Iteration %d" % (i)
-      for (urlid,) in self.con.execute('select rowid from urllist'):
-        pr = 0.15
-
-        # Loop through all the pages that link to this one
-        for (linker,) in self.con.execute('select distinct fromid from link where toid=%d' % urlid):
-          # Get the PageRank of the linker
-          linkingpr = self.con.execute('select score from pagerank where urlid=%d' % linker).fetchone()[0]
-
-          # Get the total number of links from the linker
-          linkingcount = self.con.execute('select count(*) from link where fromid=%d' % linker).fetchone()[0]
-          pr += 0.85*(linkingpr/linkingcount)
-        self.con.execute('update pagerank set score = %f where urlid=%d' % (pr, urlid))
-      self.dbcommit()
+    print 'Updated %d of %d pages (%d pushes)%s' % (len(delta), urlcount, pushes,
+                                                   rescaled and ', rescaled all scores' or '')
+    return len(delta)
+
+  # Read the whole link table in one scan, as a compressed sparse row
+  # matrix over the urls: the pages linked from urlids[i] are
+  # urlids[indices[indptr[i]:indptr[i+1]]] (each one only once), and
+  # outcount[i] is the number of links on the page, counting repeats
+  def getlinkgraph(self):
+    urlids = numpy.array([r[0] for r in self.con.execute('select rowid from urllist order by rowid')], dtype=numpy.int64)
+    n = len(urlids)
+    links = numpy.array(self.con.execute('select fromid,toid from link').fetchall(), dtype=numpy.int64).reshape(-1, 2)
+    fromidx = numpy.searchsorted(urlids, links[:,0])
+    toidx = numpy.searchsorted(urlids, links[:,1])
+    outcount = numpy.bincount(fromidx, minlength=n)
+
+    # Sorting the edges by source also removes repeated links
+    edges = numpy.unique(fromidx*n + toidx)
+    fromidx, indices = edges // n, edges % n
+    indptr = numpy.zeros(n+1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(fromidx, minlength=n), out=indptr[1:])
+    return urlids, indptr, indices, outcount
 
 # Usage:
 # 1. import searchengine
 # 2. s=searchengine.searcher('searchindex.db')
 # 3. s.getmatchrows('john snow')
+# 4. s.getmatches('john snow')
+#      ({298: [[1938], [2671, 2674, 2926]], 300: [[2304], [1928, 1930]]}, [678, 675])
+# To match words with an inverted index file instead of joining wordlocation
+# (see invertedindex.py for how to build one):
+# 2. s=searchengine.searcher('searchindex.db', indexfile='searchindex.idx')
+# PageRank, inbound link counts and link text are read into memory the first
+# time they are needed. After crawling or calculatepagerank, reload them with:
+#   s.loadscoretables()
+# To get results back instead of printed, with other weights:
+#   s.search('john snow', n=20, weights={'frequency': 1.0, 'pagerank': 2.0})
+#      [(3.41, 298, 'http://gameofthrones.wikia.com/wiki/Jon_Snow'), ...]
+# Results are cached until the index, the score tables or the neural
+# network change.
+# The neural network scores with whatever weights are in nn.db. To use a
+# network trained offline by nntrain.py into another file:
+# 2. s=searchengine.searcher('searchindex.db', netdb='clicks.db')
+# Phrases, NEAR/k, OR and NOT (see queryengine.py):
+#   s.query('"jon snow" NEAR/10 wall NOT ygritte')
 
 class searcher:
-  def __init__(self,dbname):
-    self.con = sqlite.connect(dbname)
-
-  def getscoredlist(self, rows, wordids):
-    totalscores = dict([(row[0],0) for row in rows])
-
-    #This is where you'll later put the scoring functions
-    # weights = []
-    # weights = [(1.0, self.frequencyscore(rows))]
-    # weights = [(1.0, self.locationscore(rows))]
-    # weights = [(1.0, self.distancescore(rows))]
-    # weights = [(1.0, self.inboundlinkscore(rows))]
-    # weights = [(1.0, self.pagerankscore(rows))]
-    weights = [(1.0, self.frequencyscore(rows)),
-               (1.0, self.locationscore(rows)),
-               (1.0, self.pagerankscore(rows)),
-               (1.0, self.linktextscore(rows, wordids)),
-               (1.0, self.nnscore(rows, wordids))]
-
-    for (weight,scores) in weights:
+  def __init__(self,dbname,indexfile=None,cachesize=1000,netdb=None,splitter=None,pragmas=None):
+    self.con = datastore.connect(dbname, pragmas)
+    self.splitter = splitter
+    self.net = mynet
+    if netdb!=None: self.net = nn.searchnet(netdb)
+    self.index = None
+    if indexfile!=None: self.index = invertedindex.invertedindex(indexfile)
+    self.pageranks = None
+    self.inboundcounts = None
+    self.linktextranks = None
+    self.tablegeneration = 0
+    self.cachesize = cachesize
+    self.cache = OrderedDict()
+    self.cachegeneration = None
+
+  # Read the scores that don't depend on the query, so the scoring
+  # functions don't need to query the database for every url. Each table
+  # is only read by the scorers that use it, so an index without PageRank
+  # can still be scored by inbound links. This reads every table there is
+  # now, and the others the first time they are needed
+  def loadscoretables(self):
+    self.pageranks = None
+    self.inboundcounts = None
+    self.linktextranks = None
+    self.tablegeneration += 1
+    self.getinboundcounts()
+    if self.con.execute("select count(*) from sqlite_master where name='pagerank'").fetchone()[0] > 0:
+      self.getlinktextranks()
+
+  # urlid -> PageRank
+  def getpageranks(self):
+    if self.pageranks == None:
+      self.pageranks = dict(self.con.execute('select urlid,score from pagerank'))
+    return self.pageranks
+
+  # urlid -> number of links to it
+  def getinboundcounts(self):
+    if self.inboundcounts == None:
+      self.inboundcounts = dict(self.con.execute('select toid,count(*) from link group by toid'))
+    return self.inboundcounts
+
+  # wordid -> {urlid: total PageRank of the pages linking to the url
+  #            with that word in the link text}
+  def getlinktextranks(self):
+    if self.linktextranks == None:
+      pageranks = self.getpageranks()
+      linktextranks = {}
+      cur = self.con.execute('select linkwords.wordid,link.fromid,link.toid from linkwords,link where linkwords.linkid=link.rowid')
+      for (wordid,fromid,toid) in cur:
+        ranks = linktextranks.setdefault(wordid, {})
+        ranks[toid] = ranks.get(toid, 0) + pageranks.get(fromid, 0)
+      self.linktextranks = linktextranks
+    return self.linktextranks
+
+  # weights is a dict of scoring function name -> weight, e.g.
+  #   {'frequency': 1.0}
+  #   {'location': 1.0, 'distance': 1.0}
+  #   {'inboundlink': 1.0, 'pagerank': 1.0}
+  # Functions that aren't listed, or have a weight of 0, aren't run
+  def getscoredlist(self, matches, wordids, weights = None):
+    if weights == None: weights = defaultweights
+    totalscores = dict([(url,0) for url in matches])
+
+    scorers = {'frequency': lambda: self.frequencyscore(matches),
+               'location': lambda: self.locationscore(matches),
+               'distance': lambda: self.distancescore(matches),
+               'inboundlink': lambda: self.inboundlinkscore(matches),
+               'pagerank': lambda: self.pagerankscore(matches),
+               'linktext': lambda: self.linktextscore(matches, wordids),
+               'nn': lambda: self.nnscore(matches, wordids)}
+
+    for (name,weight) in weights.items():
+      if weight == 0: continue
+      scores = scorers[name]()
       for url in totalscores:
         totalscores[url] += weight * scores[url]
 
     return totalscores
 
   def geturlname(self,id):
-    return self.con.execute("select url from urllist where rowid=%d" % id).fetchone()[0]
+    return self.con.execute("select url from urllist where rowid=?",(id,)).fetchone()[0]
+
+  # Get the names of many urls in one query
+  def geturlnames(self,ids):
+    ids = list(ids)
+    names = {}
+    for i in range(0, len(ids), 500):
+      chunk = ids[i:i+500]
+      cur = self.con.execute('select rowid,url from urllist where rowid in (%s)' % ','.join(['?']*len(chunk)), chunk)
+      names.update(cur)
+    return names
+
+  # Changes whenever anything the results depend on might have changed:
+  # data_version moves when another connection commits to the database,
+  # total_changes when this one does, and the net's generation when it is
+  # trained, before the new weights are written
+  def getgeneration(self):
+    return (self.con.execute('pragma data_version').fetchone()[0], self.con.total_changes,
+            self.net.con.execute('pragma data_version').fetchone()[0], self.net.con.total_changes,
+            self.net.generation, self.tablegeneration)
+
+  # The n best results as a list of (score, urlid, url), along with the
+  # IDs of the query words
+  def rankquery(self,q,n=10,weights=None):
+    if weights == None: weights = defaultweights
+    key = (tuple(q.split()), tuple(sorted(weights.items())), n)
+    generation = self.getgeneration()
+    if generation != self.cachegeneration:
+      self.cache.clear()
+      self.cachegeneration = generation
+    if key in self.cache:
+      # Move it to the end so the least recently used query is dropped first
+      result = self.cache.pop(key)
+      self.cache[key] = result
+      return result
+
+    matches, wordids = self.getmatches(q)
+    results = []
+    if len(matches) > 0:
+      scores = self.getscoredlist(matches, wordids, weights)
+      # Keep the n best in a heap rather than sorting every result
+      best = heapq.nlargest(n, [(score, url) for (url,score) in scores.items()])
+      names = self.geturlnames([urlid for (score,urlid) in best])
+      results = [(score, urlid, names[urlid]) for (score,urlid) in best]
+
+    self.cache[key] = (wordids, results)
+    if len(self.cache) > self.cachesize: self.cache.popitem(last = False)
+    return wordids, results
+
+  def search(self,q,n=10,weights=None):
+    return self.rankquery(q,n,weights)[1]
+
+  def query(self,q,weights=None):
+    wordids, results = self.rankquery(q,10,weights)
+    for (score, urlid, url) in results:
+      print '%f\t%s' % (score, url)
+    return wordids, [urlid for (score, urlid, url) in results]
+
+  # Get the IDs of the words in a query, skipping words that aren't indexed
+  def getwordids(self,q):
+    wordids = []
 
-  def query(self,q):
-    rows, wordids = self.getmatchrows(q)
-    scores = self.getscoredlist(rows, wordids)
-    # Python has supports keyword arguments. sorted has a keyword argument called reverse
-    rankedscores = sorted([(score, url) for (url,score) in scores.items()], reverse = 1)
-    for (score, urlid) in rankedscores[0:10]:
-      print '%f\t%s' % (score, self.geturlname(urlid))
-    return wordids, [r[1] for r in rankedscores[0:10]]
+    # Split the words by whitespace
+    for word in q.split():
+      wordid = self.getwordid(word)
+      if wordid!=None: wordids.append(wordid)
+    return wordids
+
+  # The ID of a word, or None if it isn't indexed. With a splitter, the
+  # word is looked up the way the crawler indexed it
+  def getwordid(self,word):
+    if self.splitter!=None:
+      word = self.splitter.normalize(word)
+      if word==None: return None
+    wordrow = self.con.execute("select rowid from wordlist where word = ?",(word,)).fetchone()
+    if wordrow==None: return None
+    return wordrow[0]
+
+  # The pages containing every word in the query, as a dict of
+  # urlid -> [sorted locations of each word on that page]. Unlike
+  # getmatchrows, this grows with the number of locations rather
+  # than the number of combinations of locations. Queries with phrases,
+  # NEAR, OR or NOT go to queryengine
+  def getmatches(self,q):
+    if queryengine.isadvanced(q): return self.getquerymatches(q)
+    wordids = self.getwordids(q)
+    if len(wordids) == 0: return {}, wordids
+    if self.index!=None: return self.index.getpositions(wordids), wordids
+
+    perword = {}
+    for wordid in set(wordids):
+      locations = {}
+      cur = self.con.execute('select urlid,location from wordlocation where wordid=? order by urlid,location',(wordid,))
+      for (urlid,location) in cur:
+        locations.setdefault(urlid,[]).append(location)
+      perword[wordid] = locations
+
+    urls = set(perword[wordids[0]])
+    for wordid in wordids[1:]: urls.intersection_update(perword[wordid])
+    return dict([(u, [perword[wordid][u] for wordid in wordids]) for u in urls]), wordids
+
+  def getquerymatches(self,q):
+    ignored = ignorewords
+    if self.splitter!=None: ignored = ignorewords | set(self.splitter.stopwords)
+    node = queryengine.parse(q, self.getwordid, ignored)
+    if self.index!=None: postings = queryengine.indexpostings(self.index)
+    else: postings = queryengine.sqlpostings(self.con)
+    return queryengine.getmatches(node, postings)
 
   def getmatchrows(self,q):
     # Strings to build the query
     fieldlist = 'w0.urlid'
     tablelist = ''
     clauselist = ''
-    wordids = []
-
-    # Split the words by spaces
-    words = q.split(' ')
+    wordids = self.getwordids(q)
     tablenumber = 0
 
-    for word in words:
-      # Get the work ID
-      wordrow = self.con.execute("select rowid from wordlist where word = '%s'" % word).fetchone()
-      if wordrow!=None:
-        wordid=wordrow[0]
-        wordids.append(wordid)
-        if tablenumber>0:
-          tablelist+=','
-          clauselist+=' and '
-          clauselist+='w%d.urlid=w%d.urlid and ' % (tablenumber-1,tablenumber)
-        fieldlist+=',w%d.location' % tablenumber
-        tablelist+='wordlocation w%d' % tablenumber
-        clauselist+='w%d.wordid=%d' % (tablenumber,wordid)
-        tablenumber+=1
+    for wordid in wordids:
+      if tablenumber>0:
+        tablelist+=','
+        clauselist+=' and '
+        clauselist+='w%d.urlid=w%d.urlid and ' % (tablenumber-1,tablenumber)
+      fieldlist+=',w%d.location' % tablenumber
+      tablelist+='wordlocation w%d' % tablenumber
+      clauselist+='w%d.wordid=?' % tablenumber
+      tablenumber+=1
 
     # Create the query from the separate parts
     if tablelist == '':
       return [], wordids
 
+    if self.index!=None:
+      return self.index.getmatchrows(wordids), wordids
+
     fullquery = 'select %s from %s where %s' % (fieldlist, tablelist, clauselist)
-    cur = self.con.execute(fullquery)
+    cur = self.con.execute(fullquery, wordids)
     rows = [row for row in cur]
 
     # rows contains a list of URL IDs, followed by the locations of all the different search terms
@@ -267,68 +833,65 @@ class searcher:
     return rows, wordids #returns a tuple i.e. (rows, wordids).
 
   # Content-Based Ranking
+  # These all take the matches from getmatches. Each score is the same as
+  # working through every combination of word locations on a page, which
+  # is what getmatchrows returns, without building those combinations
 
   ## Word Frequency
-  def frequencyscore(self, rows):
-    counts = dict([(row[0],0) for row in rows])
-    for row in rows: counts[row[0]] += 1
+  def frequencyscore(self, matches):
+    # The number of combinations of locations of the words
+    counts = dict([(u,reduce(lambda a,b: a*b, [len(locs) for locs in positions]))
+                   for (u,positions) in matches.items()])
     return self.normalizescores(counts)
 
   ## Document Location
-  def locationscore(self, rows):
-    locations = dict([(row[0], 1000000) for row in rows])
-    for row in rows:
-      loc = sum(row[1:])
-      if loc < locations[row[0]]: locations[row[0]]=loc
-
+  def locationscore(self, matches):
+    # The best combination uses the first location of every word
+    locations = dict([(u, min(1000000, sum([locs[0] for locs in positions])))
+                      for (u,positions) in matches.items()])
     return self.normalizescores(locations, smallIsBetter = 1)
 
   ## Word Distance
-  def distancescore(self, rows):
+  def distancescore(self, matches):
     # If there's only one word, everyone wins!
-    if len(rows[0]) <= 2: return dict([(row[0],1.0) for row in rows])
-
-    # Initialize the dictionary with large values
-    mindistance = dict([(row[0], 1000000) for row in rows])
+    if max([len(positions) for positions in matches.values()]) <= 1: return dict([(u,1.0) for u in matches])
 
-    for row in rows:
-      dist = sum([abs(row[i] - row[i-1]) for i in range(2, len(row))])
-      if dist < mindistance[row[0]]: mindistance[row[0]] = dist
-    return self.normalizescores(mindistance, smallIsBetter = 1)
+    distances = dict([(u, min(1000000, mindistance(positions)))
+                      for (u,positions) in matches.items()])
+    return self.normalizescores(distances, smallIsBetter = 1)
 
   # Inbound Clicks Ranking
 
   ## Simple Count
-  def inboundlinkscore(self, rows):
-    uniqueurls = set([row[0] for row in rows])
-    inboundcount=dict([(u,self.con.execute('select count(*) from link where toid=%d' % u).fetchone()[0]) for u in uniqueurls])
+  def inboundlinkscore(self, matches):
+    inboundcounts = self.getinboundcounts()
+    inboundcount=dict([(u,inboundcounts.get(u,0)) for u in matches])
     return self.normalizescores(inboundcount)
 
   ## PageRank
-  def pagerankscore(self, rows):
-    pageranks = dict([(row[0], self.con.execute('select score from pagerank where urlid=%d' % row[0]).fetchone()[0]) for row in rows])
+  def pagerankscore(self, matches):
+    allranks = self.getpageranks()
+    pageranks = dict([(u, allranks.get(u,0)) for u in matches])
     maxrank = max(pageranks.values())
     normalizedscores = dict([(u, float(l)/maxrank) for (u,l) in pageranks.items()])
     return normalizedscores
 
   ## Link Text
-  def linktextscore(self, rows, wordids):
-    linkscores = dict([(row[0],0) for row in rows])
+  def linktextscore(self, matches, wordids):
+    linktextranks = self.getlinktextranks()
+    linkscores = dict([(u,0) for u in matches])
     for wordid in wordids:
-      cur = self.con.execute('select link.fromid,link.toid from linkwords,link where wordid=%d and linkwords.linkid=link.rowid' % wordid)
-      for (fromid,toid) in cur:
-        if toid in linkscores:
-          pr = self.con.execute('select score from pagerank where urlid=%d' % fromid).fetchone()[0]
-          linkscores[toid] += pr
-    maxscore = max(linkscores.values())
-    normalizedscores = dict([(u, float(l)/maxscore) for (u,l) in linkscores.items()])
-    return normalizedscores
+      ranks = linktextranks.get(wordid, {})
+      for u in linkscores:
+        if u in ranks: linkscores[u] += ranks[u]
+    # No links with these words at all gives every page 0
+    return self.normalizescores(linkscores)
 
   ## Neural Network
-  def nnscore(self, rows, wordids):
+  def nnscore(self, matches, wordids):
       # Get the unique URL IDs as an ordered list
-      urlids = [urlid for urlid in set([row[0] for row in rows])]
-      nnres = mynet.getresult(wordids, urlids)
+      urlids = matches.keys()
+      nnres = self.net.getresult(wordids, urlids)
       scores = dict([(urlids[i], nnres[i]) for i in range(len(urlids))])
       return self.normalizescores(scores)
 
@@ -344,4 +907,5 @@ class searcher:
       return dict([(u, float(c)/maxscore) for (u,c) in scores.items()])
 
   def __del__(self):
+    if self.index!=None: self.index.close()
     self.con.close()
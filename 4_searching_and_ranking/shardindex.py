@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import zlib
+import urllib2
+import tempfile
+import multiprocessing
+from bs4 import BeautifulSoup
+import searchengine
+
+# Builds the index with several processes. The urls are split into shards
+# by a hash of the url, every shard is indexed by its own process into its
+# own sqlite file, and the shards are then merged into one database the
+# searcher can use. Parsing pages is what takes the time, so this goes
+# about as many times faster as there are cores, up to the merge.
+#
+# Each page is either a url, which is fetched, or a (url, html) pair. The
+# links on a page are indexed, but not followed: to discover pages, crawl
+# with crawler.crawl or concurrentcrawl first.
+#
+# Usage:
+# 1. import shardindex
+# 2. shardindex.buildindex(urls, 'searchindex.db', processes=4)
+# 3. crawler=searchengine.crawler('searchindex.db')
+# 4. crawler.calculatepagerank()
+#
+# Or merge shards that were built some other way, each with the tables
+# from crawler.createindextables:
+#   shardindex.mergeshards('searchindex.db', ['shard0.db', 'shard1.db'])
+
+# The shard a url belongs in. crc32 rather than hash so that it is the
+# same in every process and on every run
+def shardof(url, shards):
+  if isinstance(url, unicode): url = url.encode('utf8')
+  return (zlib.crc32(url) & 0xffffffff) % shards
+
+def pageurl(page):
+  if isinstance(page, tuple): return page[0]
+  return page
+
+def partition(pages, shards):
+  parts = [[] for i in range(shards)]
+  for page in pages:
+    parts[shardof(pageurl(page), shards)].append(page)
+  return parts
+
+# Index a list of pages into a new shard. Runs in a worker process, so it
+# takes its arguments as one tuple and returns plain values
+def buildshard(args):
+  shardfile, pages, batchsize, splitter = args
+  start = time.time()
+  # The crawler prints every page it indexes
+  sys.stdout = open(os.devnull, 'w')
+  c = searchengine.crawler(shardfile, splitter=splitter)
+  c.createindextables()
+  failed = 0
+  for page in pages:
+    try:
+      if isinstance(page, tuple): url, html = page
+      else: url, html = page, urllib2.urlopen(page).read()
+      c.queuepage(url, BeautifulSoup(html, 'html.parser'))
+    except Exception:
+      failed += 1
+      continue
+    if len(c.pending) >= batchsize: c.flushindex()
+  c.flushindex()
+  c.con.close()
+  return len(pages) - failed, failed, time.time() - start
+
+# Copy every shard into dbname. Words and urls are matched by their text,
+# so each gets one rowid in dbname however many shards it was in, and the
+# rows that refer to them are rewritten with the new rowids. Every shard
+# is copied in one transaction. The pages in the shards shouldn't already
+# be indexed in dbname, or their words would be there twice
+def mergeshards(dbname, shardfiles):
+  c = searchengine.crawler(dbname)
+  if c.con.execute("select count(*) from sqlite_master where name='wordlocation'").fetchone()[0] == 0:
+    c.createindextables()
+  con = c.con
+  # old rowid -> new rowid, with the old one as the key so the joins
+  # below look it up by rowid
+  con.execute('create temp table wordmap(old integer primary key, new integer)')
+  con.execute('create temp table urlmap(old integer primary key, new integer)')
+  try:
+    for shardfile in shardfiles:
+      con.execute('attach database ? as shard', (shardfile,))
+      for (table, field) in [('wordlist', 'word'), ('urllist', 'url')]:
+        con.execute('insert into main.%s(%s) select distinct %s from shard.%s '
+                    'where %s not in (select %s from main.%s)' % (table, field, field, table, field, field, table))
+        con.execute('delete from %smap' % field)
+        con.execute('insert into %smap select s.rowid, m.rowid from shard.%s s join main.%s m on m.%s=s.%s' %
+                    (field, table, table, field, field))
+
+      con.execute('insert into main.wordlocation(urlid,wordid,location) '
+                  'select u.new, w.new, l.location from shard.wordlocation l '
+                  'join urlmap u on u.old=l.urlid join wordmap w on w.old=l.wordid')
+
+      # Links keep their order, moved up past the links already there,
+      # so linkwords can find them by adding the same offset
+      offset = con.execute('select max(rowid) from main.link').fetchone()[0] or 0
+      con.execute('insert into main.link(rowid,fromid,toid) '
+                  'select l.rowid+?, f.new, t.new from shard.link l '
+                  'join urlmap f on f.old=l.fromid join urlmap t on t.old=l.toid', (offset,))
+      con.execute('insert into main.linkwords(wordid,linkid) '
+                  'select w.new, lw.linkid+? from shard.linkwords lw join wordmap w on w.old=lw.wordid', (offset,))
+
+      con.commit()
+      con.execute('detach database shard')
+  except:
+    con.rollback()
+    raise
+  finally:
+    con.close()
+
+def buildindex(pages, dbname, processes=None, batchsize=100, splitter=None, shards=None, keepshards=False):
+  if processes == None: processes = multiprocessing.cpu_count()
+  if shards == None: shards = processes
+  start = time.time()
+  shardfiles = []
+  for i in range(shards):
+    fd, shardfile = tempfile.mkstemp(suffix='.shard%d.db' % i)
+    os.close(fd)
+    os.remove(shardfile)
+    shardfiles.append(shardfile)
+
+  try:
+    tasks = [(shardfiles[i], part, batchsize, splitter) for (i, part) in enumerate(partition(pages, shards))]
+    if processes > 1:
+      pool = multiprocessing.Pool(processes)
+      try:
+        results = pool.map(buildshard, tasks)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      stdout = sys.stdout
+      try:
+        results = map(buildshard, tasks)
+      finally:
+        sys.stdout = stdout
+    built = time.time()
+    indexed = sum([r[0] for r in results])
+    failed = sum([r[1] for r in results])
+    print 'shards  %6d pages %8.2fs (%d failed, %d shards, %d processes)' % (indexed, built-start, failed, shards, processes)
+
+    mergeshards(dbname, shardfiles)
+    print 'merge   %15s %8.2fs' % ('', time.time()-built)
+  finally:
+    if not keepshards:
+      for shardfile in shardfiles:
+        for name in (shardfile, shardfile + '-wal', shardfile + '-shm'):
+          if os.path.exists(name): os.remove(name)
+  return indexed
@@ -0,0 +1,55 @@
+import unittest
+import queryengine
+
+# Tests for phrase, NEAR, OR and NOT queries on pages given as word lists.
+#
+# Usage:
+# python -m unittest test_queryengine
+
+# The postings of pages given as a dict of urlid -> list of words, with
+# each word as its own ID
+class listpostings:
+  def __init__(self, pages):
+    self.locations = {}
+    for (urlid, words) in pages.items():
+      for i in range(len(words)):
+        self.locations.setdefault(words[i], {}).setdefault(urlid, []).append(i)
+
+  def urlids(self, wordid):
+    return sorted(self.locations.get(wordid, {}))
+
+  def positions(self, wordid, urlid):
+    return self.locations.get(wordid, {}).get(urlid, [])
+
+def lookup(word):
+  return word
+
+class neartest(unittest.TestCase):
+  def geturlids(self, q, pages):
+    return queryengine.geturlids(queryengine.parse(q, lookup), listpostings(pages))
+
+  # The OR's phrase has its other word in it, so the phrase starts before
+  # the word and ends after it, and the OR's spans don't end in the order
+  # they start. Only page 1 has snow next to the end of the phrase
+  def testmixedlengthor(self):
+    pages = {1: 'x the wall of winterfell snow'.split(),
+             2: 'the wall of winterfell x x snow'.split()}
+    q = '("the wall of winterfell" OR wall) NEAR/1 snow'
+    self.assertEqual(self.geturlids(q, pages), [1])
+    q = 'snow NEAR/1 ("the wall of winterfell" OR wall)'
+    self.assertEqual(self.geturlids(q, pages), [1])
+
+  # matches agrees with spans, which tries every pair
+  def testmatchesagreeswithspans(self):
+    words = 'a b c d e'.split()
+    pages = {}
+    for urlid in range(200):
+      pages[urlid] = [words[(urlid*7 + i*i*3 + i) % 5] for i in range(12 + urlid % 7)]
+    for q in ['("a b c" OR d) NEAR/1 e', '(a OR "b c d e") NEAR/0 ("c d" OR a)', 'e NEAR/2 ("a b" OR "c d e a")']:
+      node = queryengine.parse(q, lookup)
+      node.prepare(listpostings(pages))
+      for urlid in node.urls:
+        self.assertEqual(node.matches(urlid), len(node.spans(urlid)) > 0)
+
+if __name__ == '__main__':
+  unittest.main()
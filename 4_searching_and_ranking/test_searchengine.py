@@ -0,0 +1,92 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import searchengine
+import nn
+
+# Tests for the searcher on small indexes built from word lists, without
+# crawling anything.
+#
+# Usage:
+# python -m unittest test_searchengine
+
+# Index pages, a dict of url -> (list of words, list of urls it links to),
+# into a new database in directory
+def makeindex(directory, pages):
+  dbname = os.path.join(directory, 'index.db')
+  c = searchengine.crawler(dbname)
+  c.createindextables()
+  # queuewords prints every page it indexes
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    for url in sorted(pages):
+      words, links = pages[url]
+      c.queuewords(url, words, [(link, []) for link in links])
+    c.flushindex()
+  finally:
+    sys.stdout = stdout
+  return c, dbname
+
+class searchertest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.crawler, self.dbname = makeindex(self.directory, {
+      'http://a': (['wall', 'snow'], ['http://b', 'http://c']),
+      'http://b': (['wall', 'ice'], ['http://c']),
+      'http://c': (['wall'], [])})
+    self.nets = []
+
+  def tearDown(self):
+    # Before the files go, or they would be flushed after
+    for net in self.nets: net.close()
+    shutil.rmtree(self.directory)
+
+  def searcher(self):
+    netdb = os.path.join(self.directory, 'nn.db')
+    net = nn.searchnet(netdb)
+    net.maketables()
+    s = searchengine.searcher(self.dbname, netdb=netdb)
+    self.nets += [net, s.net]
+    return s
+
+  def urls(self, results):
+    return [url for (score, urlid, url) in results]
+
+  # Inbound links don't need PageRank, so they score an index that
+  # calculatepagerank hasn't been run on
+  def testinboundlinkwithoutpagerank(self):
+    s = self.searcher()
+    results = s.search('wall', weights={'inboundlink': 1.0})
+    self.assertEqual(self.urls(results)[0], 'http://c')
+    s.loadscoretables()
+    self.assertEqual(self.urls(s.search('wall', weights={'inboundlink': 1.0}))[0], 'http://c')
+
+  def testpagerankafterloadscoretables(self):
+    s = self.searcher()
+    self.crawler.calculatepagerank(iterations=20)
+    s.loadscoretables()
+    results = s.search('wall', weights={'pagerank': 1.0, 'linktext': 1.0})
+    self.assertEqual(self.urls(results)[0], 'http://c')
+
+  # Training keeps the new weights in the net until it flushes, and the
+  # cached results still have to change with them
+  def testtrainingchangescachedresults(self):
+    s = self.searcher()
+    weights = {'nn': 1.0}
+    wordids, results = s.rankquery('wall', weights=weights)
+    urlids = sorted([urlid for (score, urlid, url) in results])
+    s.net.trainquery(wordids, urlids, urlids[0])
+    before = s.rankquery('wall', weights=weights)[1]
+    self.assertEqual(before[0][1], urlids[0])
+
+    for i in range(30): s.net.trainquery(wordids, urlids, urlids[-1])
+    self.assertTrue(len(s.net.dirtyoutput) > 0)
+    after = s.rankquery('wall', weights=weights)[1]
+    self.assertEqual(after[0][1], urlids[-1])
+    self.assertNotEqual(self.urls(after), self.urls(before))
+
+if __name__ == '__main__':
+  unittest.main()
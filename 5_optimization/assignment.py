@@ -0,0 +1,234 @@
+import heapq
+import numpy
+
+# Solves assignment problems exactly: finds the way of giving every row (a
+# student) a column (a dorm) with the lowest total cost.
+#
+# solve takes a matrix with the cost of every row in every column, and
+# gives every row its own column. It is the Hungarian algorithm, in the
+# form that adds one row at a time by the cheapest augmenting path, with
+# the work on each row done as NumPy array operations. It takes time
+# proportional to the number of rows cubed, so a few hundred rows at most.
+#
+# assign is for when each row only has a few columns of its own to choose
+# from, and any other column costs the same, and columns can take more
+# than one row, as with dorms. It finds a minimum cost flow through a
+# graph with an edge for each choice rather than each pair of row and
+# column, so it can solve thousands of rows in seconds.
+#
+# Usage:
+# 1. import assignment
+# 2. assignment.solve([[4, 1, 3], [2, 0, 5], [3, 2, 2]])
+#    [1, 0, 2], the column for each row
+# 3. assignment.assign([[(0, 0), (1, 1)], [(0, 0)], [(0, 0), (1, 1)]], [2, 2], othercost=3)
+#    [0, 0, 1]
+#
+# For dorms, see dorm.bestsolution, which builds the choices from prefs
+# and dorms.
+
+# The column for each row, with no two rows in the same column, and the
+# lowest total cost. There can't be more rows than columns
+def solve(cost):
+    cost = numpy.asarray(cost, dtype=float)
+    n, m = cost.shape
+    if n > m: raise ValueError('%d rows but only %d columns' % (n, m))
+    if n == 0: return []
+
+    # u and v are the duals of the rows and columns: cost[i,j]-u[i]-v[j]
+    # is never below 0, and is 0 for every row and the column it has.
+    # Column m is a dummy the path for each new row starts from
+    u = cost.min(axis=1)
+    v = numpy.zeros(m+1)
+    rowof = -numpy.ones(m+1, dtype=int)
+
+    # Start with every row that can in a column where it costs its
+    # minimum, which is most of them when most rows have a column they
+    # are cheapest in to themselves
+    unassigned = []
+    for i in range(n):
+        tight = numpy.flatnonzero((cost[i] == u[i]) & (rowof[:m] < 0))
+        if len(tight) > 0: rowof[tight[0]] = i
+        else: unassigned.append(i)
+
+    for i in unassigned:
+        rowof[m] = i
+        j0 = m
+        # The cheapest way found so far to reach each column, and the
+        # column it is reached from
+        minv = numpy.empty(m+1)
+        minv.fill(numpy.inf)
+        way = -numpy.ones(m+1, dtype=int)
+        used = numpy.zeros(m+1, dtype=bool)
+        usedcols = []
+        while True:
+            used[j0] = True
+            usedcols.append(j0)
+            i0 = rowof[j0]
+            free = numpy.flatnonzero(~used[:m])
+            reduced = cost[i0, free] - u[i0] - v[free]
+            better = reduced < minv[free]
+            minv[free[better]] = reduced[better]
+            way[free[better]] = j0
+
+            k = minv[free].argmin()
+            j1 = free[k]
+            delta = minv[j1]
+
+            # Move the duals so that the column reached is tight
+            cols = numpy.array(usedcols)
+            u[rowof[cols]] += delta
+            v[cols] -= delta
+            minv[free] -= delta
+
+            j0 = j1
+            if rowof[j0] < 0: break
+
+        # Flip the path back to the dummy column
+        while j0 != m:
+            j1 = way[j0]
+            rowof[j0] = rowof[j1]
+            j0 = j1
+
+    colof = [0] * n
+    for j in range(m):
+        if rowof[j] >= 0: colof[rowof[j]] = j
+    return colof
+
+# The total cost of giving each row the column in cols
+def totalcost(cost, cols):
+    cost = numpy.asarray(cost)
+    return cost[numpy.arange(len(cols)), cols].sum()
+
+# A graph for minimum cost flow, with each edge next to its reverse, so
+# edge e^1 is the reverse of edge e
+class flowgraph:
+    def __init__(self, nodes):
+        self.adj = [[] for i in range(nodes)]
+        self.to = []
+        self.cap = []
+        self.cost = []
+
+    def add(self, u, v, cap, cost):
+        for (a, b, c, w) in [(u, v, cap, cost), (v, u, 0, -cost)]:
+            self.adj[a].append(len(self.to))
+            self.to.append(b)
+            self.cap.append(c)
+            self.cost.append(w)
+
+    # Shortest distances from s along edges with room, with the costs
+    # made non-negative by the potentials
+    def distances(self, s, pot):
+        dist = [None] * len(self.adj)
+        dist[s] = 0
+        heap = [(0, s)]
+        while len(heap) > 0:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]: continue
+            for e in self.adj[u]:
+                if self.cap[e] == 0: continue
+                v = self.to[e]
+                nd = d + self.cost[e] + pot[u] - pot[v]
+                if dist[v] == None or nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    # Whether an edge is on a shortest path, once the potentials are the
+    # distances
+    def tight(self, u, e, pot):
+        return self.cap[e] > 0 and abs(self.cost[e] + pot[u] - pot[self.to[e]]) < 1e-9
+
+    # Levels of the nodes from s along tight edges, as in Dinic's maximum
+    # flow, so that flow only goes forward and can't go round in circles
+    def levels(self, s, pot):
+        level = [-1] * len(self.adj)
+        level[s] = 0
+        queue = [s]
+        for u in queue:
+            for e in self.adj[u]:
+                v = self.to[e]
+                if level[v] < 0 and self.tight(u, e, pot):
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        return level
+
+    # Send flow along one path from s to t of tight edges going up a level
+    # at a time. next[u] is the first edge of u that might still lead to
+    # t, so no edge is tried twice between calls to levels
+    def augment(self, s, t, level, next, pot):
+        path = []
+        u = s
+        while True:
+            if u == t:
+                flow = min([self.cap[e] for e in path])
+                for e in path:
+                    self.cap[e] -= flow
+                    self.cap[e^1] += flow
+                return flow
+            adj = self.adj[u]
+            while next[u] < len(adj):
+                e = adj[next[u]]
+                if level[self.to[e]] == level[u] + 1 and self.tight(u, e, pot): break
+                next[u] += 1
+            if next[u] < len(adj):
+                e = adj[next[u]]
+                path.append(e)
+                u = self.to[e]
+            else:
+                # A dead end, so go back and try the next edge
+                if u == s: return 0
+                e = path.pop()
+                u = self.to[e^1]
+                next[u] += 1
+
+    # Send as much flow as there is room for from s to t, at the lowest
+    # cost. All the paths of the same, cheapest, cost are found together,
+    # so there are only as many rounds as path costs
+    def mincostflow(self, s, t):
+        pot = [0] * len(self.adj)
+        while True:
+            dist = self.distances(s, pot)
+            if dist[t] == None: break
+            for v in range(len(pot)):
+                if dist[v] != None: pot[v] += dist[v]
+            while True:
+                level = self.levels(s, pot)
+                if level[t] < 0: break
+                next = [0] * len(self.adj)
+                while self.augment(s, t, level, next, pot) > 0: pass
+
+# The column for each row, for the lowest total cost, when each row has a
+# few columns to choose from. options[i] is a list of (column, cost) for
+# row i, capacity[j] is how many rows column j can take, and othercost, if
+# it is given, is the cost of any column that isn't one of a row's
+# options. Rows are None if there wasn't room for them in their options
+def assign(options, capacity, othercost=None):
+    n, m = len(options), len(capacity)
+    # Rows, then columns, then the source, the sink, and a hub every row
+    # can go through to any column for othercost
+    source, sink, hub = n+m, n+m+1, n+m+2
+    graph = flowgraph(n+m+3)
+    for i in range(n):
+        graph.add(source, i, 1, 0)
+        for (j, cost) in options[i]: graph.add(i, n+j, 1, cost)
+        if othercost != None: graph.add(i, hub, 1, othercost)
+    for j in range(m):
+        if othercost != None: graph.add(hub, n+j, capacity[j], 0)
+        graph.add(n+j, sink, capacity[j], 0)
+    graph.mincostflow(source, sink)
+
+    # The column each row's flow went to. Rows that went through the hub
+    # all cost the same, so they share out the columns it sent flow to
+    cols = [None] * n
+    viahub = []
+    for i in range(n):
+        for e in graph.adj[i]:
+            if e % 2 == 0 and graph.cap[e] == 0:
+                if graph.to[e] == hub: viahub.append(i)
+                else: cols[i] = graph.to[e] - n
+    if len(viahub) > 0:
+        spare = []
+        for e in graph.adj[hub]:
+            if e % 2 == 0: spare += [graph.to[e] - n] * graph.cap[e^1]
+        for (i, j) in zip(viahub, spare): cols[i] = j
+    return cols
@@ -1,5 +1,7 @@
 import random
 import math
+import numpy
+import assignment
 
 # The dorms, each of which has two available spaces
 dorms = ['Zeus', 'Athena', 'Hercules', 'Bacchus', 'Pluto']
@@ -43,24 +45,127 @@ def printsolution(vec):
         # Remove this slot
         del slots[x]
 
-def dormcost(vec):
+# Two slots for each dorm, as indexes into dorms
+def makeslots(dorms):
+    slots = []
+    for i in range(len(dorms)): slots += [i,i]
+    return slots
+
+# What a dorm costs a student with the choices in pref: their first choice
+# costs 0, their second choice costs 1, and a dorm not on their list
+# costs 3
+def studentcost(pref, dorm):
+    if pref[0] == dorm: return 0
+    elif pref[1] == dorm: return 1
+    else: return 3
+
+# prefs and dorms can be given to cost other students and dorms
+def dormcost(vec, prefs=prefs, dorms=dorms):
     cost = 0
     # Create the list of slots
-    slots = [0,0,1,1,2,2,3,3,4,4]
+    slots = makeslots(dorms)
 
     # Lopp over each student
     for i in range(len(vec)):
         x = int(vec[i]);
         dorm = dorms[slots[x]]
-        pref = prefs[i][1]
-
-        # First choice of costs 0, second choice costs 1
-        if pref[0] == dorm: cost += 0
-        elif prefs[1] == dorm: cost += 1
-        else: cost += 3
-        # Not on the list of costs 3
+        cost += studentcost(prefs[i][1], dorm)
 
         # Remove selected slot
         del slots[x]
 
     return cost
+
+# The cost as single students are moved, for hillclimb and
+# annealingoptimize (see optimization.scheduletracker). Moving a student
+# changes the slots left for everyone after them, so only the students
+# before the one that moved keep their cost. The slots left and the cost
+# so far before each student are kept, so a change starts from there
+class dormtracker:
+    def __init__(self, vec, prefs=prefs, dorms=dorms):
+        self.sol = list(vec)
+        self.prefs = prefs
+        self.dorms = dorms
+        self.refresh()
+
+    # The cost of the students from i on, with slots left before i
+    def costfrom(self, i, slots, vec):
+        slots = slots[:]
+        cost = 0
+        for j in range(i, len(vec)):
+            x = int(vec[j])
+            cost += studentcost(self.prefs[j][1], self.dorms[slots[x]])
+            del slots[x]
+        return cost
+
+    def refresh(self):
+        self.slots = []
+        self.before = []
+        slots = makeslots(self.dorms)
+        cost = 0
+        for i in range(len(self.sol)):
+            self.slots.append(slots[:])
+            self.before.append(cost)
+            x = int(self.sol[i])
+            cost += studentcost(self.prefs[i][1], self.dorms[slots[x]])
+            del slots[x]
+        self.cost = cost
+
+    def change(self, i, value):
+        vec = self.sol[:]
+        vec[i] = value
+        return self.before[i] + self.costfrom(i, self.slots[i], vec) - self.cost
+
+    def move(self, i, value):
+        self.sol[i] = value
+        self.refresh()
+
+dormcost.tracker = dormtracker
+
+# The cost to each student of each slot, as a matrix with a row for each
+# student and a column for each slot, for assignment.solve. Slot j is in
+# dorm makeslots(dorms)[j]
+def costmatrix(prefs=prefs, dorms=dorms):
+    index = dict([(dorms[d], d) for d in range(len(dorms))])
+    slots = numpy.array(makeslots(dorms))
+    cost = numpy.empty((len(prefs), len(slots)))
+    cost.fill(3)
+    for i in range(len(prefs)):
+        first, second = prefs[i][1]
+        # Second choice first, so a student who put the same dorm twice
+        # gets it at the cost of a first choice
+        if second in index: cost[i, slots == index[second]] = 1
+        if first in index: cost[i, slots == index[first]] = 0
+    return cost
+
+# The dorm each student gets, as an index into dorms, for the lowest total
+# cost there is, rather than a good one found by searching. Each student's
+# two choices are their options, and every other dorm costs 3. Raises
+# ValueError if there are more students than places
+def bestassignment(prefs=prefs, dorms=dorms):
+    if len(prefs) > 2*len(dorms):
+        raise ValueError('not enough capacity: %d students but %d places in %d dorms' %
+                         (len(prefs), 2*len(dorms), len(dorms)))
+    index = dict([(dorms[d], d) for d in range(len(dorms))])
+    options = []
+    for (name, (first, second)) in prefs:
+        options.append([(index[d], cost) for (d, cost) in [(first, 0), (second, 1)] if d in index])
+    return assignment.assign(options, [2] * len(dorms), othercost=3)
+
+# The solution that gives each student the dorm in assigned, in the form
+# dormcost and printsolution take
+def tosolution(assigned, dorms=dorms):
+    slots = makeslots(dorms)
+    vec = []
+    for d in assigned:
+        x = slots.index(d)
+        vec.append(x)
+        del slots[x]
+    return vec
+
+# 1. import dorm
+# 2. s = dorm.bestsolution()
+# 3. dorm.dormcost(s)
+# 4. dorm.printsolution(s)
+def bestsolution(prefs=prefs, dorms=dorms):
+    return tosolution(bestassignment(prefs, dorms), dorms)
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import random
+import argparse
+import optimization
+import dorm
+import assignment
+
+# Compares assigning students to dorms exactly, with dorm.bestsolution,
+# against the Hungarian algorithm on the full matrix of costs, and against
+# searching for a good assignment with annealingoptimize and
+# geneticoptimize, on dormcost, for made up problems of growing size.
+#
+# Usage:
+# python dormbench.py
+# python dormbench.py --sizes 10,100,1000,4000 --searchlimit 200
+#
+# or
+# 1. import dormbench
+# 2. dormbench.printresults(dormbench.run([10, 100, 1000]))
+
+# A problem with students students and enough dorms of two places for
+# them, at least two.
+# Some dorms are far more popular than others, so that not everyone can
+# have their first choice
+def makeproblem(students, seed=0):
+    rnd = random.Random(seed)
+    # At least two, so that everyone's second choice can be a different dorm
+    dorms = ['Dorm%d' % i for i in range(max((students+1)/2, 2))]
+    # Dorm i is picked in proportion to 1/(i+1)
+    weights = [1.0/(i+1) for i in range(len(dorms))]
+    total = sum(weights)
+
+    def pick(exclude=None):
+        while True:
+            r = rnd.random()*total
+            for i in range(len(dorms)):
+                r -= weights[i]
+                if r <= 0: break
+            if dorms[i] != exclude: return dorms[i]
+
+    prefs = []
+    for i in range(students):
+        first = pick()
+        prefs.append(('Student%d' % i, (first, pick(first))))
+    return prefs, dorms
+
+# One entry for each student, picking from the slots the students before
+# them have left, as dorm.domain does
+def makedomain(students, dorms):
+    return [(0, (len(dorms)*2)-i-1) for i in range(0, students)]
+
+# The solution each way of solving finds, its cost and how long it took.
+# The Hungarian algorithm and the searches are only run on problems up to
+# searchlimit students, as the first takes time proportional to the number
+# of students cubed, and each evaluation of the others to it squared
+def run(sizes=[10, 50, 100, 500, 1000, 5000], seed=0, searchlimit=500):
+    results = []
+    for students in sizes:
+        prefs, dorms = makeproblem(students, seed)
+        domain = makedomain(students, dorms)
+        costf = lambda v: dorm.dormcost(v, prefs, dorms)
+        costf.tracker = lambda v: dorm.dormtracker(v, prefs, dorms)
+
+        methods = [('assignment', lambda: dorm.bestsolution(prefs, dorms))]
+        if students <= searchlimit:
+            def anneal():
+                random.seed(seed)
+                return optimization.annealingoptimize(domain, costf)
+            # Mutation can step outside the domain, which dormcost can't
+            # cost (see the note in optimization)
+            genetic = lambda: optimization.geneticoptimize(domain, costf, mutprod=0.0, seed=seed)
+            def hungarian():
+                slots = dorm.makeslots(dorms)
+                cols = assignment.solve(dorm.costmatrix(prefs, dorms))
+                return dorm.tosolution([slots[j] for j in cols], dorms)
+            methods += [('hungarian', hungarian), ('annealing', anneal), ('genetic', genetic)]
+
+        for (name, solve) in methods:
+            # geneticoptimize prints every generation
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                start = time.time()
+                sol = solve()
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+            results.append({'students': students, 'method': name, 'seconds': elapsed,
+                            'cost': dorm.dormcost(sol, prefs, dorms)})
+    return results
+
+def printresults(results):
+    print '%8s %-12s %10s %8s' % ('students', 'method', 'seconds', 'cost')
+    for r in results:
+        print '%8d %-12s %10.3f %8d' % (r['students'], r['method'], r['seconds'], r['cost'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare exact dorm assignment with annealing and the genetic optimizer')
+    parser.add_argument('--sizes', default='10,50,100,500,1000,5000', help='numbers of students, comma separated')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--searchlimit', type=int, default=500,
+                        help='only run annealing and the genetic optimizer up to this many students')
+    args = parser.parse_args()
+    printresults(run([int(n) for n in args.sizes.split(',')], args.seed, args.searchlimit))
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import random
+import argparse
+import multiprocessing
+import optimization
+
+# Runs the optimizers many times from different random starts, spread over
+# several processes, and keeps the best solution any of them found. Each
+# run uses one optimizer with its own seed and options, so the runs are a
+# mix of hill climbing, annealing with different cooling schedules, the
+# genetic optimizer and random search.
+#
+# A run can be given a budget: a number of cost evaluations for each run,
+# and a number of seconds for all of them. Within the budget a run starts
+# its optimizer again from a new random solution each time it finishes, so
+# hillclimb does random restarts until the budget is spent. With only an
+# evaluation budget, the same seed gives the same answer.
+#
+# Usage:
+# 1. import optimization, multistart
+# 2. domain = [(0,8)]*(len(optimization.people)*2)
+# 3. sol, cost, runs = multistart.runmany(domain, optimization.schedulecost, runs=12, evaluations=20000)
+# 4. optimization.printschedule(sol)
+# 5. multistart.printruns(runs)
+#
+# or python multistart.py --runs 12 --evaluations 20000 --seconds 10
+#
+# For socialnetwork, annealing needs bigger steps:
+#   multistart.runmany(socialnetwork.domain, socialnetwork.crosscount, seconds=30, step=50)
+
+class budgetspent(Exception):
+    pass
+
+# Wraps a cost function to count the evaluations, stop the optimizer by
+# raising budgetspent once the budget is spent, and keep the best solution
+# it has been given. It keeps the batch and tracker paths of the cost
+# function it wraps, and counts every solution they cost
+class budgetcost:
+    def __init__(self, costf, evaluations=None, deadline=None):
+        self.costf = costf
+        self.evaluations = evaluations
+        self.deadline = deadline
+        self.start = time.time()
+        self.count = 0
+        self.best = None
+        self.bestsol = None
+        # (evaluations, seconds, best cost) every time the best improves
+        self.trace = []
+        if hasattr(costf, 'batch'): self.batch = self.costbatch
+        if hasattr(costf, 'tracker'): self.tracker = self.maketracker
+
+    # How many of wanted solutions the budget has room for
+    def left(self, wanted=1):
+        if self.deadline != None and time.time() >= self.deadline: return 0
+        if self.evaluations == None: return wanted
+        return max(0, min(wanted, self.evaluations - self.count))
+
+    def spend(self, wanted=1):
+        n = self.left(wanted)
+        if n == 0: raise budgetspent()
+        self.count += n
+        return n
+
+    def record(self, cost, sol, count=None):
+        if self.best == None or cost < self.best:
+            self.best = cost
+            self.bestsol = list(sol)
+            if count == None: count = self.count
+            self.trace.append((count, time.time()-self.start, cost))
+
+    def __call__(self, sol):
+        self.spend()
+        cost = self.costf(sol)
+        self.record(cost, sol)
+        return cost
+
+    # Cost as many of the solutions as the budget has room for, and stop
+    # if that isn't all of them
+    def costbatch(self, sols):
+        if len(sols) == 0: return []
+        n = self.spend(len(sols))
+        costs = optimization.getcosts(self.costf, sols[:n])
+        for i in range(n): self.record(costs[i], sols[i], self.count-n+i+1)
+        if n < len(sols): raise budgetspent()
+        return costs
+
+    def maketracker(self, sol):
+        self.spend()
+        return budgettracker(self, self.costf.tracker(sol))
+
+# A cost function's tracker, counting every change it is asked to cost
+class budgettracker:
+    def __init__(self, budget, tracker):
+        self.budget = budget
+        self.inner = tracker
+        budget.record(tracker.cost, tracker.sol)
+
+    # cost, sol and move are the tracker's own
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def change(self, i, value):
+        self.budget.spend()
+        change = self.inner.change(i, value)
+        cost = self.inner.cost + change
+        if self.budget.best == None or cost < self.budget.best:
+            sol = self.inner.sol[:]
+            sol[i] = value
+            self.budget.record(cost, sol)
+        return change
+
+# count runs as (optimizer, options, seed), going round hill climbing,
+# three cooling schedules for annealing, the genetic optimizer and random
+# search. step is passed to the optimizers that take it
+def makeruns(count, seed=0, step=1):
+    kinds = [('hillclimb', {}),
+             ('annealingoptimize', {'T': 10000.0, 'cool': 0.95, 'step': step}),
+             ('geneticoptimize', {'step': step}),
+             ('annealingoptimize', {'T': 10000.0, 'cool': 0.99, 'step': step}),
+             ('randomoptimize', {}),
+             ('annealingoptimize', {'T': 100000.0, 'cool': 0.999, 'step': step})]
+    rnd = random.Random(seed)
+    return [(kinds[i % len(kinds)][0], kinds[i % len(kinds)][1], rnd.randint(0, 2**31-1))
+            for i in range(count)]
+
+# The cost function and domain for the workers of a process pool, which
+# get them when they are forked, as with optimization.poolcostf
+poolcostf = None
+pooldomain = None
+
+# One run: its optimizer again and again from new starts until the budget
+# is spent, or once if there is no budget. Runs in a worker process, so it
+# takes its arguments as one tuple and returns plain values
+def dorun(task):
+    name, options, seed, evaluations, seconds, deadline, costf, domain = task
+    if costf == None: costf, domain = poolcostf, pooldomain
+    # Its share of the time, but not past the end of all of them
+    if seconds != None: deadline = min(deadline, time.time() + seconds)
+    rnd = random.Random(seed)
+    budget = budgetcost(costf, evaluations, deadline)
+    optimizer = getattr(optimization, name)
+    restarts = 0
+    errors = 0
+    error = None
+
+    # geneticoptimize prints the best cost of every generation
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        while True:
+            restarts += 1
+            random.seed(rnd.random())
+            if name == 'geneticoptimize': options = dict(options, seed=rnd.randint(0, 2**31-1))
+            count = budget.count
+            try:
+                optimizer(domain, budget, **options)
+            except budgetspent:
+                raise
+            except Exception, e:
+                # Some optimizers can step outside the domain, and not every
+                # cost function can cost that. Start again, unless it
+                # failed before costing anything
+                errors += 1
+                error = '%s: %s' % (e.__class__.__name__, e)
+                if budget.count == count: break
+            if evaluations == None and deadline == None: break
+    except budgetspent:
+        pass
+    finally:
+        sys.stdout = stdout
+
+    return {'optimizer': name, 'options': options, 'seed': seed,
+            'cost': budget.best, 'solution': budget.bestsol,
+            'evaluations': budget.count, 'seconds': time.time() - budget.start,
+            'restarts': restarts, 'trace': budget.trace, 'errors': errors, 'error': error}
+
+# Do every run and return the best solution, its cost, and the result of
+# each run. runs is a number of runs from makeruns or a list like it.
+# evaluations is the budget of each run, seconds the budget of them all.
+# When there are more runs than processes, each run gets its share of the
+# seconds, so the ones that start last still get to run
+def runmany(domain, costf, runs=8, processes=None, evaluations=None, seconds=None, seed=0, step=1):
+    global poolcostf, pooldomain
+    if isinstance(runs, int): runs = makeruns(runs, seed, step)
+    if processes == None: processes = min(multiprocessing.cpu_count(), len(runs))
+    deadline = share = None
+    if seconds != None:
+        deadline = time.time() + seconds
+        rounds = (len(runs) + processes - 1) / processes
+        share = float(seconds) / max(rounds, 1)
+
+    if processes > 1:
+        poolcostf, pooldomain = costf, domain
+        tasks = [(name, options, s, evaluations, share, deadline, None, None) for (name, options, s) in runs]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(dorun, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(dorun, [(name, options, s, evaluations, share, deadline, costf, domain)
+                              for (name, options, s) in runs])
+
+    done = [r for r in results if r['cost'] != None]
+    if len(done) == 0: return None, None, results
+    best = min(done, key=lambda r: r['cost'])
+    return best['solution'], best['cost'], results
+
+def printruns(results):
+    print '%-18s %-30s %10s %8s %8s %10s' % ('optimizer', 'options', 'evals', 'starts', 'seconds', 'cost')
+    for r in results:
+        options = ','.join(['%s=%s' % (k, v) for (k, v) in sorted(r['options'].items()) if k != 'seed'])
+        print '%-18s %-30s %10d %8d %8.2f %10s' % (r['optimizer'], options, r['evaluations'], r['restarts'],
+                                                 r['seconds'], r['cost'])
+        if r['errors']: print '  %d starts failed, the last with %s' % (r['errors'], r['error'])
+
+# How the best cost of a run came down: the cost after each number of
+# evaluations in points
+def convergence(result, points=[100, 1000, 10000, 100000]):
+    costs = []
+    for n in points:
+        seen = [cost for (count, seconds, cost) in result['trace'] if count <= n]
+        if len(seen) > 0: costs.append(seen[-1])
+        else: costs.append(None)
+    return costs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the cheapest flight schedule with many optimizer runs')
+    parser.add_argument('--runs', type=int, default=12)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--evaluations', type=int, default=None, help='cost evaluations for each run')
+    parser.add_argument('--seconds', type=float, default=None, help='seconds for all the runs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    domain = [(0,8)]*(len(optimization.people)*2)
+    start = time.time()
+    sol, cost, results = runmany(domain, optimization.schedulecost, args.runs, args.processes,
+                                 args.evaluations, args.seconds, args.seed)
+    printruns(results)
+    print 'best cost %s in %.2fs' % (cost, time.time()-start)
+    if sol != None: optimization.printschedule(sol)
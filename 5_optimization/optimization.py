@@ -1,12 +1,18 @@
 import time
 import random
 import math
+import threading
+from collections import OrderedDict
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy
 
 # Play
 # 1. import optimization
 # 2. s=[1,4,3,2,7,3,6,3,2,4,5,3]
 # 3. optimization.printschedule(s)
 # 4. optimization.schedulecost(s)
+# 5. optimization.schedulecosts([s, [0]*12])
 
 # Play: dorms
 # 1. import optimization
@@ -51,40 +57,257 @@ def printschedule(r):
         ret = flights[(destination, origin)][r[d+1]]
         print '%10s%10s %5s-%5s $%3s %5s-%5s $%3s' % (name, origin, out[0], out[1], out[2], ret[0], ret[1], ret[2])
 
-def schedulecost(sol):
-    totalprice = 0
-    latestarrival = 0
-    earliestdep = 24 * 60
-
-    for d in range(len(sol)/2):
-        # Get the inbound and outbound flights
-        origin = people[d][1]
-        outbound = flights[(origin, destination)][int(sol[d])]
-        returnf = flights[(destination, origin)][int(sol[d+1])]
-
-        # Total price is the price of all outbound and return flights
-        totalprice += outbound[2]
-        totalprice += returnf[2]
-
-        # Track the latest arrival and earliest departure
-        if latestarrival < getminutes(outbound[1]): latestarrival = getminutes(outbound[1])
-        if earliestdep > getminutes(returnf[0]): earliestdep = getminutes(returnf[0])
+# The flights of each person as arrays, so that the cost of many solutions
+# can be worked out at once instead of looking up and parsing every flight
+# each time. Row d is people[d]'s route. Call again after changing people
+# or flights
+def compileflights():
+    global flightcounts, outprice, outarrive, retprice, retdepart
+    outbound = [flights[(origin, destination)] for (name, origin) in people]
+    returnf = [flights[(destination, origin)] for (name, origin) in people]
+    flightcounts = numpy.array([[len(o) for o in outbound], [len(r) for r in returnf]])
+    width = flightcounts.max()
+
+    # Routes with fewer flights are padded, indexes past their end are
+    # caught in schedulecosts
+    def table(routes, field, minutes):
+        t = numpy.zeros((len(routes), width), dtype=int)
+        for d in range(len(routes)):
+            for i in range(len(routes[d])):
+                value = routes[d][i][field]
+                if minutes: value = getminutes(value)
+                t[d, i] = value
+        return t
+
+    outprice = table(outbound, 2, False)
+    outarrive = table(outbound, 1, True)
+    retprice = table(returnf, 2, False)
+    retdepart = table(returnf, 0, True)
+
+compileflights()
+
+# The cost of each of a list of solutions, the same as calling schedulecost
+# on every one of them
+def schedulecosts(sols):
+    sols = numpy.asarray(sols).astype(int)
+    if sols.ndim == 1: sols = sols.reshape(1, -1)
+    n = sols.shape[1]/2
+    if n == 0: return numpy.zeros(len(sols), dtype=int)
+    who = numpy.arange(n)
+
+    # Person d flies out on flight sol[d] and back on flight sol[d+1].
+    # Negative indexes count from the end, as they do for lists
+    out = sols[:, :n]
+    ret = sols[:, 1:n+1]
+    outcount = flightcounts[0, :n]
+    retcount = flightcounts[1, :n]
+    out = numpy.where(out < 0, out + outcount, out)
+    ret = numpy.where(ret < 0, ret + retcount, ret)
+    if (out < 0).any() or (out >= outcount).any() or (ret < 0).any() or (ret >= retcount).any():
+        raise IndexError('flight index out of range')
+
+    # Total price is the price of all outbound and return flights
+    totalprice = outprice[who, out].sum(axis=1) + retprice[who, ret].sum(axis=1)
 
     # Every person must wait at the airport until the latest person arrives
     # They also must arrive at the same time and wait for their flights
-    totalwait = 0
-    for d in range(len(sol)/2):
-        origin = people[d][1]
-        outbound = flights[(origin, destination)][int(sol[d])]
-        returnf = flights[(destination, origin)][int(sol[d+1])]
-        totalwait += latestarrival - getminutes(outbound[1])
-        totalwait += getminutes(returnf[0]) - earliestdep
+    arrive = outarrive[who, out]
+    depart = retdepart[who, ret]
+    latestarrival = arrive.max(axis=1)
+    earliestdep = numpy.minimum(depart.min(axis=1), 24 * 60)
+    totalwait = (latestarrival[:, None] - arrive).sum(axis=1) + (depart - earliestdep[:, None]).sum(axis=1)
 
     # Does this solution require an extra day of car rental? That'll be $50
-    if latestarrival > earliestdep: totalprice += 50
+    totalprice += 50 * (latestarrival > earliestdep)
 
     return totalprice + totalwait
 
+def schedulecost(sol):
+    return int(schedulecosts([sol])[0])
+
+# Optimizers check for this to cost a whole population in one call
+schedulecost.batch = schedulecosts
+
+# The cost of a schedule as single flights are changed, for hillclimb and
+# annealingoptimize. A cost function's tracker(sol) has:
+#   cost                the cost of sol
+#   change(i, value)    how much the cost goes up if sol[i] is set to value
+#   move(i, value)      set sol[i] to value
+# and keeps the current solution in sol.
+#
+# Position d is person d's outbound flight and position d+1 their return
+# flight, as in schedulecost, so a change only touches one or two flights.
+# The latest arrival and earliest departure without each person are kept,
+# so a change doesn't need to look at anyone else. A move costs the whole
+# schedule again, as the second latest and earliest can be anyone's, but
+# there is only one move for all the changes tried before it
+class scheduletracker:
+    def __init__(self, sol):
+        self.sol = list(sol)
+        self.n = len(sol)/2
+        self.outprice = outprice.tolist()
+        self.outarrive = outarrive.tolist()
+        self.retprice = retprice.tolist()
+        self.retdepart = retdepart.tolist()
+        self.counts = flightcounts.tolist()
+        self.refresh()
+
+    # The flight a value picks for person d, counting from the end when
+    # it is negative, as schedulecost does
+    def flight(self, d, value, ret):
+        i = int(value)
+        count = self.counts[ret and 1 or 0][d]
+        if i < 0: i += count
+        if i < 0 or i >= count: raise IndexError('flight index out of range')
+        if ret: return self.retprice[d][i], self.retdepart[d][i]
+        return self.outprice[d][i], self.outarrive[d][i]
+
+    def refresh(self):
+        n = self.n
+        out = [self.flight(d, self.sol[d], False) for d in range(n)]
+        ret = [self.flight(d, self.sol[d+1], True) for d in range(n)]
+        self.outpaid = [p for (p, t) in out]
+        self.retpaid = [p for (p, t) in ret]
+        self.price = sum(self.outpaid) + sum(self.retpaid)
+        self.arrive = [t for (p, t) in out]
+        self.depart = [t for (p, t) in ret]
+        self.sumarrive = sum(self.arrive)
+        self.sumdepart = sum(self.depart)
+
+        # The latest arrival and the latest without the person who has it,
+        # and the same for the earliest departure
+        self.latestby = self.earliestby = None
+        if n > 0:
+            self.latestby = self.arrive.index(max(self.arrive))
+            self.earliestby = self.depart.index(min(self.depart))
+        self.latest = max([0] + self.arrive)
+        self.nextlatest = max([0] + [self.arrive[d] for d in range(n) if d != self.latestby])
+        self.earliest = min([24 * 60] + self.depart)
+        self.nextearliest = min([24 * 60] + [self.depart[d] for d in range(n) if d != self.earliestby])
+        self.cost = self.total(self.price, self.sumarrive, self.sumdepart, self.latest, self.earliest)
+
+    def total(self, price, sumarrive, sumdepart, latest, earliest):
+        # Everyone waits from their arrival until the latest one, and
+        # from the earliest departure until their own
+        cost = price + self.n*latest - sumarrive + sumdepart - self.n*earliest
+        if latest > earliest: cost += 50
+        return cost
+
+    def change(self, i, value):
+        price, sumarrive, sumdepart = self.price, self.sumarrive, self.sumdepart
+        latest, earliest = self.latest, self.earliest
+        if i < self.n:
+            p, t = self.flight(i, value, False)
+            price += p - self.outpaid[i]
+            sumarrive += t - self.arrive[i]
+            if i == self.latestby: latest = max(t, self.nextlatest)
+            else: latest = max(t, self.latest)
+        if 1 <= i <= self.n:
+            d = i - 1
+            p, t = self.flight(d, value, True)
+            price += p - self.retpaid[d]
+            sumdepart += t - self.depart[d]
+            if d == self.earliestby: earliest = min(t, self.nextearliest)
+            else: earliest = min(t, self.earliest)
+        return self.total(price, sumarrive, sumdepart, latest, earliest) - self.cost
+
+    def move(self, i, value):
+        self.sol[i] = value
+        self.refresh()
+
+schedulecost.tracker = scheduletracker
+
+# The costs of a list of solutions, in one call if costf has a batch
+# version
+def getcosts(costf, sols):
+    if hasattr(costf, 'batch'):
+        return numpy.asarray(costf.batch(sols)).tolist()
+    return [costf(s) for s in sols]
+
+# Wraps a cost function to keep the costs of the last maxsize solutions it
+# was given, so the optimizers don't cost the same solution again, which
+# hillclimb does for every neighbour it comes back to. It is called the
+# same way, so it can be given to any of them in place of costf:
+# costf = optimization.costcache(optimization.schedulecost)
+# s = optimization.hillclimb(domain, costf)
+# costf.hits, costf.misses, costf.seconds
+#
+# A cost function that is random, like numpredict's, keeps the first cost
+# it gave for a solution. Each process has its own cache.
+#
+# The cache doesn't pass on the tracker of the cost function it wraps, so
+# hillclimb and annealingoptimize go through the cache rather than costing
+# moves with the tracker. Give them costf itself to use its tracker
+class costcache:
+    def __init__(self, costf, maxsize=10000):
+        self.costf = costf
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        # The GA costs solutions from several threads with executor='thread'
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Time spent in costf
+        self.seconds = 0.0
+
+        # Keep the batch path if there is one
+        if hasattr(costf, 'batch'): self.batch = self.costbatch
+
+    def lookup(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.cache:
+                self.misses += 1
+                return None
+            # Move it to the end, the least recently used are at the front
+            self.hits += 1
+            cost = self.cache.pop(key)
+            self.cache[key] = cost
+            return cost
+        finally:
+            self.lock.release()
+
+    def store(self, key, cost, elapsed):
+        self.lock.acquire()
+        try:
+            self.seconds += elapsed
+            self.cache[key] = cost
+            if len(self.cache) > self.maxsize: self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def __call__(self, sol):
+        key = tuple(sol)
+        cost = self.lookup(key)
+        if cost == None:
+            start = time.time()
+            cost = self.costf(sol)
+            self.store(key, cost, time.time()-start)
+        return cost
+
+    # Cost the solutions that aren't cached in one call to costf.batch
+    def costbatch(self, sols):
+        keys = [tuple(v) for v in sols]
+        costs = [self.lookup(key) for key in keys]
+        missing = [i for i in range(len(sols)) if costs[i] == None]
+        if len(missing) > 0:
+            start = time.time()
+            new = numpy.asarray(self.costf.batch([sols[i] for i in missing])).tolist()
+            elapsed = time.time() - start
+            for (i, cost) in zip(missing, new):
+                self.store(keys[i], cost, elapsed/len(missing))
+                costs[i] = cost
+        return costs
+
+    def hitrate(self):
+        return float(self.hits) / max(self.hits + self.misses, 1)
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
 # 1. import optimization
 # 2. domain = [(0,8)]*(len(optimization.people)*2)
 # 3. s = optimization.randomoptimize(domain, optimization.schedulecost)
@@ -93,19 +316,29 @@ def schedulecost(sol):
 def randomoptimize(domain, costf):
     best = 999999999
     bestr = None
-    for i in range(1000):
-        # Create a random solution
-        r = [random.randint(domain[i][0], domain[i][1]) for i in range(len(domain))]
+    # Create random solutions
+    sols = [[random.randint(domain[i][0], domain[i][1]) for i in range(len(domain))]
+            for j in range(1000)]
 
-        # Get the cost
-        cost = costf(r)
+    # Get the costs
+    costs = getcosts(costf, sols)
 
+    for (cost, r) in zip(costs, sols):
         # Compare it to the best one so far
         if cost < best:
             best = cost
             bestr = r
     return bestr
 
+# The moves to the neighbouring solutions, as (index, new value)
+def neighbourmoves(domain, sol):
+    moves = []
+    for j in range(len(domain)):
+        # One away in each direction, without going outside the domain
+        if sol[j] > domain[j][0]: moves.append((j, sol[j]-1))
+        if sol[j] < domain[j][1]: moves.append((j, sol[j]+1))
+    return moves
+
 # s = optimization.hillclimb(domain, optimization.schedulecost)
 # Performs a little beter than the random algorithm but can get itself into
 # a local mininum
@@ -113,22 +346,34 @@ def hillclimb(domain, costf):
     # Create a random solution
     sol = [random.randint(domain[i][0], domain[i][1]) for i in range(len(domain))]
 
+    # With a tracker, each neighbour is costed by how much it changes
+    if hasattr(costf, 'tracker'):
+        tracker = costf.tracker(sol)
+        while 1:
+            best = 0
+            bestmove = None
+            for (j, value) in neighbourmoves(domain, tracker.sol):
+                change = tracker.change(j, value)
+                if change < best:
+                    best = change
+                    bestmove = (j, value)
+
+            # If there's no improvement, then we've reached the top
+            if bestmove == None: break
+            tracker.move(*bestmove)
+        return tracker.sol
+
     # Main loop
     while 1:
         # Create list of neighboring solutions
-        neighbors = []
-        for j in range(len(domain)):
-            # One away in each direction
-            if sol[j] > domain[j][0]:
-                neighbors.append(sol[0:j]+[sol[j]+1]+sol[j+1:])
-            if sol[j] < domain[j][1]:
-                neighbors.append(sol[0:j]+[sol[j]-1]+sol[j+1:])
+        neighbors = [sol[0:j]+[value]+sol[j+1:] for (j, value) in neighbourmoves(domain, sol)]
 
         # See what the best solution amongst the neighbors is
-        current = costf(sol)
+        costs = getcosts(costf, [sol] + neighbors)
+        current = costs[0]
         best = current
         for j in range(len(neighbors)):
-            cost = costf(neighbors[j])
+            cost = costs[j+1]
             if cost < best:
                 best = cost
                 sol = neighbors[j]
@@ -147,6 +392,8 @@ def annealingoptimize(domain, costf, T = 10000.0, cool = 0.95, step = 1):
     # Initialize the values randomly
     vec = [int(random.randint(domain[i][0], domain[i][1]))
             for i in range(len(domain))]
+    tracker = None
+    if hasattr(costf, 'tracker'): tracker = costf.tracker(vec)
 
     while T > 0.1:
         # Choose one of the indices
@@ -162,66 +409,141 @@ def annealingoptimize(domain, costf, T = 10000.0, cool = 0.95, step = 1):
         elif vecb[i] > domain[i][1]: vecb[i] = domain[i][1]
 
         # Calculate the current cost and the new cost
-        ea = costf(vec)
-        eb = costf(vecb)
+        if tracker != None:
+            ea = tracker.cost
+            eb = ea + tracker.change(i, vecb[i])
+        else:
+            ea, eb = getcosts(costf, [vec, vecb])
         p = pow(math.e,(-eb-ea)/T)
 
         # Is is better, or does it make the probability cutoff?
         if (eb < ea or random.random() < p):
             vec = vecb
+            if tracker != None: tracker.move(i, vecb[i])
 
         # Decrease the temperature
         T = T * cool
     return vec
 
+# The cost function for the workers of a process pool. It is set before
+# the pool starts, so the workers get it when they are forked and it
+# doesn't have to be picklable, which the cost functions numpredict builds
+# aren't
+poolcostf = None
+
+# Cost one solution. With a seed, the random module is seeded first, so a
+# cost function that uses it, like numpredict's crossvalidate, gives the
+# same answer whichever worker runs it and in whatever order
+def costsolution(task):
+    costf, seed, vec = task
+    if costf == None: costf = poolcostf
+    if seed != None: random.seed(seed)
+    return costf(vec)
+
+# Something with a map method to cost solutions with: None to cost them one
+# at a time here, 'thread' or 'process' for a new pool of that many
+# workers, or a pool that is already running. Returns it and whether it
+# was started here and should be closed
+def getexecutor(executor, workers, costf):
+    global poolcostf
+    if executor == None or executor == 'serial': return None, False
+    if executor == 'thread': return ThreadPool(workers), True
+    if executor == 'process':
+        poolcostf = costf
+        return multiprocessing.Pool(workers), True
+    return executor, False
+
+# The costs of a list of solutions, in order. The seed for each one comes
+# from the solution itself and seed, so the same solution always gets the
+# same seed. Threads share the random module, so a cost function that uses
+# it is only repeatable with no executor or processes
+def costsolutions(costf, sols, executor=None, seed=None, processes=False):
+    if executor == None and hasattr(costf, 'batch'): return getcosts(costf, sols)
+    tasks = []
+    for v in sols:
+        taskseed = None
+        if seed != None: taskseed = hash((seed,) + tuple(v))
+        tasks.append((not processes and costf or None, taskseed, v))
+    if executor == None: return map(costsolution, tasks)
+    return executor.map(costsolution, tasks)
+
 # s = optimization.geneticoptimize(domain, optimization.schedulecost)
 # Seems to constantly give the most optimal result
-def geneticoptimize(domain, costf, popsize = 50, step = 1, mutprod=0.2, elite=0.2, maxiter=100):
+# The population can be costed in parallel, with executor='thread' or
+# 'process' and workers, or a running pool. Each solution is only costed
+# once, so the elites aren't costed again every generation. With a seed
+# the result only depends on the seed, not on the executor:
+# s = optimization.geneticoptimize(domain, optimization.schedulecost, executor='process', seed=1)
+def geneticoptimize(domain, costf, popsize = 50, step = 1, mutprod=0.2, elite=0.2, maxiter=100,
+                    executor=None, workers=None, seed=None):
+    # With a seed, the choices here come from their own generator, so
+    # they don't depend on anything else using the random module
+    if seed == None: rnd = random
+    else: rnd = random.Random(seed)
+
     # Mutation Operation
     def mutate(vec):
-        i = random.randint(0, len(domain)-1)
-        if random.random() < 0.5 and vec[i] >= domain[i][0]:
+        i = rnd.randint(0, len(domain)-1)
+        if rnd.random() < 0.5 and vec[i] >= domain[i][0]:
             return vec[0:i]+[vec[i]-step]+vec[i+1:]
         elif vec[i] <= domain[i][1]:
             return vec[0:i]+[vec[i]+step]+vec[i+1:]
 
     # Crossover Operation
     def crossover(r1,r2):
-        i = random.randint(1, len(domain)-2)
+        i = rnd.randint(1, len(domain)-2)
         return r1[0:i]+r2[i:]
 
     # Build the initial population
     pop = []
     for i in range(popsize):
-        vec = [random.randint(domain[i][0], domain[i][1])
+        vec = [rnd.randint(domain[i][0], domain[i][1])
                 for i in range(len(domain))]
         pop.append(vec)
 
     # How many winners from each generation?
     topelite = int(elite*popsize)
 
-    # Main loop
-    for i in range(maxiter):
-        scores=[(costf(v),v) for v in pop]
-        scores.sort()
-        ranked = [v for (s,v) in scores]
-
-        # Start with the pure winners
-        pop = ranked[0:topelite]
-
-        # Add the mutated and bred forms of the winners
-        while len(pop) < popsize:
-            if random.random() < mutprod:
-                # Mutation
-                c = random.randint(0, topelite)
-                pop.append(mutate(ranked[c]))
-            else:
-                # Crossover
-                c1 = random.randint(0, topelite)
-                c2 = random.randint(0, topelite)
-                pop.append(crossover(ranked[c1], ranked[c2]))
-
-        # Print the current best score
-        print scores[0][0]
+    # Costs of the solutions seen so far
+    memo = {}
+    pool, started = getexecutor(executor, workers, costf)
+
+    try:
+        # Main loop
+        for i in range(maxiter):
+            # Only cost the solutions that haven't been costed yet
+            new = []
+            for v in pop:
+                if tuple(v) not in memo:
+                    memo[tuple(v)] = None
+                    new.append(v)
+            costs = costsolutions(costf, new, pool, seed, executor == 'process')
+            for (v, cost) in zip(new, costs): memo[tuple(v)] = cost
+
+            scores = [(memo[tuple(v)], v) for v in pop]
+            scores.sort()
+            ranked = [v for (s,v) in scores]
+
+            # Start with the pure winners
+            pop = ranked[0:topelite]
+
+            # Add the mutated and bred forms of the winners
+            while len(pop) < popsize:
+                if rnd.random() < mutprod:
+                    # Mutation
+                    c = rnd.randint(0, topelite)
+                    pop.append(mutate(ranked[c]))
+                else:
+                    # Crossover
+                    c1 = rnd.randint(0, topelite)
+                    c2 = rnd.randint(0, topelite)
+                    pop.append(crossover(ranked[c1], ranked[c2]))
+
+            # Print the current best score
+            print scores[0][0]
+    finally:
+        if started:
+            pool.close()
+            pool.join()
 
     return scores[0][1]
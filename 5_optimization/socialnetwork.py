@@ -1,4 +1,6 @@
 import math
+import random
+import numpy
 
 # import socialnetwork
 # import optimization
@@ -7,6 +9,8 @@ import math
 # sol=optimization.annealingoptimize(socialnetwork.domain, socialnetwork.crosscount,step=50,cool=0.99)
 # socialnetwork.crosscount(sol)
 # socialnetwork.drawnetwork(sol)
+#
+# For bigger graphs, or many layouts at once, see network below
 
 people = ['Charlie', 'Augustus', 'Veruca', 'Violet', 'Mike', 'Joe', 'Willy', 'Miranda']
 
@@ -23,44 +27,323 @@ links = [('Augustus', 'Willy'),
          ('Veruca', 'Augustus'),
          ('Miranda', 'Joe')]
 
+# Whether the line from p1 to p2 crosses the line from p3 to p4
+def linescross(p1, p2, p3, p4):
+    (x1,y1),(x2,y2) = p1,p2
+    (x3,y3),(x4,y4) = p3,p4
+
+    den=(y4-y3)*(x2-x1)-(x4-x3)*(y2-y1)
+
+    # den==0 if the lines are parallel
+    if den==0: return False
+
+    # Otherwise ua and ub are the fraction of the line where they cross
+    ua=((x4-x3)*(y1-y3)-(y4-y3)*(x1-x3))/float(den)
+    ub=((x2-x1)*(y1-y3)-(y2-y1)*(x1-x3))/float(den)
+
+    # If the fraction is between 0 and 1 for both lines
+    # then they cross each other
+    return ua>0 and ua<1 and ub>0 and ub<1
+
+# The penalty for two people closer than 50 pixels
+def closeness(p1, p2):
+    (x1,y1),(x2,y2) = p1,p2
+
+    # Find the distance between them
+    dist = math.sqrt(math.pow(x1-x2,2) + math.pow(y1-y2,2))
+    # Penalize any nodes closer than 50 pixels
+    if dist < 50: return 1.0-(dist/50.0)
+    return 0
+
 def crosscount(v):
     # Convert the number list into a dictionary of person:(x,y)
     loc = dict([(people[i],(v[i*2],v[i*2+1])) for i in range(0,len(people))])
     total = 0
 
-    # Loop through every pair of links
+    # Loop through every pair of links. Links from the same person meet
+    # where they start, which isn't a crossing
     for i in range(len(links)):
         for j in range(i+1,len(links)):
+            if len(set(links[i]) & set(links[j])) > 0: continue
+            if linescross(loc[links[i][0]],loc[links[i][1]],loc[links[j][0]],loc[links[j][1]]):
+                total+=1
 
-            # Get the locations
-            (x1,y1),(x2,y2) = loc[links[i][0]],loc[links[i][1]]
-            (x3,y3),(x4,y4) = loc[links[j][0]],loc[links[j][1]]
+    # Loop through every pair of people
+    for i in range(len(people)):
+        for j in range(i+1,len(people)):
+            total+=closeness(loc[people[i]],loc[people[j]])
+    return total
 
-            den=(y4-y3)*(x2-x1)-(x4-x3)*(y2-y1)
+# The cost as single coordinates are changed, for hillclimb and
+# annealingoptimize (see optimization.scheduletracker). Moving a person
+# only changes whether their own links cross the others, and how close
+# they are to everyone else
+class crosstracker:
+    def __init__(self, v):
+        self.sol = list(v)
+        index = dict([(people[i], i) for i in range(len(people))])
+        self.links = [(index[a], index[b]) for (a, b) in links]
+        # The links each person is on
+        self.linksof = [[l for l in range(len(links)) if i in self.links[l]] for i in range(len(people))]
+        self.cost = crosscount(self.sol)
 
-            # den==0 if the lines are parallel
-            if den==0: continue
+    def locations(self, sol):
+        return [(sol[i*2],sol[i*2+1]) for i in range(len(people))]
 
-            # Otherwise ua and ub are the fraction of the line where they cross
-            ua=((x4-x3)*(y1-y3)-(y4-y3)*(x1-x3))/den
-            ub=((x2-x1)*(y1-y3)-(y2-y1)*(x1-x3))/den
+    def crosses(self, loc, l, m):
+        a, b = self.links[l]
+        c, d = self.links[m]
+        if len(set([a, b]) & set([c, d])) > 0: return False
+        return linescross(loc[a],loc[b],loc[c],loc[d])
 
-            # If the fraction is between 0 and 1 for both lines
-            # then they cross each other
-            if ua>0 and ua<1 and ub>0 and ub<1:
-                total+=1
+    def change(self, i, value):
+        person = i/2
+        if person >= len(people): return 0
+        old = self.locations(self.sol)
+        new = old[:]
+        if i % 2 == 0: new[person] = (value, old[person][1])
+        else: new[person] = (old[person][0], value)
 
-        for i in range(len(people)):
-            for j in range(i+1,len(people)):
-                # Get the locations of the two nodes
-                (x1,y1),(x2,y2) = loc[people[i]],loc[people[j]]
+        change = 0
+        mine = self.linksof[person]
+        for l in mine:
+            for m in range(len(self.links)):
+                # Pairs of this person's links are only counted once
+                if m in mine and m <= l: continue
+                change += self.crosses(new, l, m) - self.crosses(old, l, m)
 
-                # Find the distance between them
-                dist = math.sqrt(math.pow(x1-x2,2) + math.pow(y1-y2,2))
-                # Penalize any nodes closer than 50 pixels
-                if dist < 50:
-                    total+=(1.0-(dist/50.0))
-    return total
+        closer = 0
+        for other in range(len(people)):
+            if other == person: continue
+            closer += closeness(new[person], new[other]) - closeness(old[person], old[other])
+        return change + closer
+
+    def move(self, i, value):
+        self.cost += self.change(i, value)
+        self.sol[i] = value
+
+crosscount.tracker = crosstracker
+
+# Split counts into ranges: returns, for every item of every range, the
+# range it is in and its place in the range
+def expand(counts):
+    owner = numpy.repeat(numpy.arange(len(counts)), counts)
+    starts = numpy.cumsum(counts) - counts
+    return owner, numpy.arange(len(owner)) - starts[owner]
+
+# The pairs (i, j), i < j, of boxes that cover a square of a grid with
+# squares of size pixels in common. Boxes that overlap always do. lo and
+# hi are the corners of the boxes, one row each
+def gridpairs(lo, hi, size):
+    if len(lo) == 0:
+        none = numpy.zeros(0, dtype=numpy.int64)
+        return none, none
+    first = numpy.floor(lo / size).astype(numpy.int64)
+    last = numpy.floor(hi / size).astype(numpy.int64)
+    wide = last[:, 0] - first[:, 0] + 1
+    high = last[:, 1] - first[:, 1] + 1
+
+    # Every box in every square it covers, sorted by square and then box
+    box, k = expand(wide * high)
+    cx = first[box, 0] + k % wide[box]
+    cy = first[box, 1] + k / wide[box]
+    square = (cx - cx.min()) * (cy.max() - cy.min() + 1) + (cy - cy.min())
+    order = numpy.lexsort((box, square))
+    box, square = box[order], square[order]
+
+    # Pair each box with the ones after it in the same square. When the
+    # boxes are so big that that is more pairs than there are, which is
+    # what happens when most links go right across a random layout, all
+    # the pairs are quicker
+    after = numpy.searchsorted(square, square, side='right') - numpy.arange(len(square)) - 1
+    if after.sum() >= len(lo)*(len(lo)-1)/2: return numpy.triu_indices(len(lo), 1)
+    i, k = expand(after)
+    pairs = numpy.unique(box[i] * len(lo) + box[i + 1 + k])
+    return pairs / len(lo), pairs % len(lo)
+
+# Whether the lines from p1 to p2 cross the lines from p3 to p4, as in
+# linescross, for arrays with x and y in the last dimension
+def arecrossing(p1, p2, p3, p4):
+    x1, y1, x2, y2 = p1[..., 0], p1[..., 1], p2[..., 0], p2[..., 1]
+    x3, y3, x4, y4 = p3[..., 0], p3[..., 1], p4[..., 0], p4[..., 1]
+    den = (y4-y3)*(x2-x1)-(x4-x3)*(y2-y1)
+    err = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        ua = ((x4-x3)*(y1-y3)-(y4-y3)*(x1-x3))/den
+        ub = ((x2-x1)*(y1-y3)-(y2-y1)*(x1-x3))/den
+    finally:
+        numpy.seterr(**err)
+    return (den != 0) & (ua > 0) & (ua < 1) & (ub > 0) & (ub < 1)
+
+# The closeness penalties of people p1 and p2, for arrays of them
+def arecloseness(p1, p2):
+    dist = numpy.sqrt(((p1 - p2)**2).sum(axis=-1))
+    return numpy.where(dist < 50, 1.0 - dist/50.0, 0.0)
+
+# crosscount for any graph and for many layouts at once, with NumPy. A
+# network is called like crosscount and has a batch version and a
+# tracker, so the optimizers can be given one as the cost function:
+# net = socialnetwork.makenetwork(500, 1000)
+# sol = optimization.annealingoptimize(net.domain, net, step=50, cool=0.99)
+#
+# By default every pair of links is checked, which is quickest for small
+# graphs. With grid set to a size in pixels, links are only checked
+# against the ones whose boxes share a square of a grid of that size, and
+# people against the ones in 50 pixel squares next to theirs. The costs
+# are the same, but for big graphs, where most links are nowhere near each
+# other, that's far fewer pairs
+class network:
+    # Pairs are checked this many at a time, to bound the memory used
+    chunk = 1 << 18
+
+    def __init__(self, people, links, size=370, grid=None):
+        self.people = people
+        index = dict([(people[i], i) for i in range(len(people))])
+        self.links = numpy.array([(index[a], index[b]) for (a, b) in links], dtype=int).reshape(-1, 2)
+        self.domain = [(10, size)] * (len(people)*2)
+        self.grid = grid
+        self.linkpairs = None
+        self.peoplepairs = None
+
+    def __call__(self, v):
+        return self.batch([v])[0]
+
+    # Optimizers that move one person at a time use this
+    def tracker(self, v):
+        return networktracker(self, v)
+
+    def batch(self, layouts):
+        return self.costs(layouts).tolist()
+
+    # Layouts as an array of (x, y) for each person in each layout
+    def locations(self, layouts):
+        layouts = numpy.asarray(layouts, dtype=float)
+        if layouts.ndim == 1: layouts = layouts.reshape(1, -1)
+        return layouts[:, :len(self.people)*2].reshape(len(layouts), len(self.people), 2)
+
+    def costs(self, layouts):
+        loc = self.locations(layouts)
+        return self.crossings(loc) + self.closeness(loc)
+
+    # Links that share a person never cross, so they are left out
+    def apart(self, i, j):
+        a, b = self.links[i], self.links[j]
+        keep = (a[:, 0] != b[:, 0]) & (a[:, 0] != b[:, 1]) & (a[:, 1] != b[:, 0]) & (a[:, 1] != b[:, 1])
+        return i[keep], j[keep]
+
+    def crossings(self, loc):
+        total = numpy.zeros(len(loc))
+        if self.grid != None:
+            for b in range(len(loc)):
+                ends = loc[b][self.links]
+                i, j = gridpairs(ends.min(axis=1), ends.max(axis=1), self.grid)
+                i, j = self.apart(i, j)
+                total[b] = arecrossing(ends[i, 0], ends[i, 1], ends[j, 0], ends[j, 1]).sum()
+            return total
+
+        if self.linkpairs == None:
+            self.linkpairs = self.apart(*numpy.triu_indices(len(self.links), 1))
+        i, j = self.linkpairs
+        for start in range(0, len(i), self.chunk):
+            a = self.links[i[start:start+self.chunk]]
+            b = self.links[j[start:start+self.chunk]]
+            total += arecrossing(loc[:, a[:, 0]], loc[:, a[:, 1]], loc[:, b[:, 0]], loc[:, b[:, 1]]).sum(axis=1)
+        return total
+
+    def closeness(self, loc):
+        total = numpy.zeros(len(loc))
+        if self.grid != None:
+            for b in range(len(loc)):
+                i, j = gridpairs(loc[b] - 25, loc[b] + 25, 50)
+                total[b] = arecloseness(loc[b][i], loc[b][j]).sum()
+            return total
+
+        if self.peoplepairs == None:
+            self.peoplepairs = numpy.triu_indices(len(self.people), 1)
+        i, j = self.peoplepairs
+        for start in range(0, len(i), self.chunk):
+            a, b = i[start:start+self.chunk], j[start:start+self.chunk]
+            total += arecloseness(loc[:, a], loc[:, b]).sum(axis=1)
+        return total
+
+# The cost of a network's layout as single coordinates are changed, like
+# crosstracker: only the moved person's links are checked against the
+# others, and only their closeness to everyone else
+class networktracker:
+    def __init__(self, net, v):
+        self.net = net
+        self.sol = list(v)
+        self.loc = net.locations(v)[0]
+        self.cost = net(v)
+        # The links each person is on
+        self.linksof = [[] for p in net.people]
+        for l in range(len(net.links)):
+            for p in set(net.links[l]): self.linksof[p].append(l)
+        self.linksof = [numpy.array(mine, dtype=int) for mine in self.linksof]
+
+    def change(self, i, value):
+        person = i/2
+        if person >= len(self.net.people): return 0
+        new = self.loc.copy()
+        new[person, i % 2] = value
+
+        # This person's links against every other link, with pairs of
+        # their own links once
+        mine = self.linksof[person]
+        count = len(self.net.links)
+        ismine = numpy.zeros(count, dtype=bool)
+        ismine[mine] = True
+        l = numpy.repeat(mine, count)
+        m = numpy.tile(numpy.arange(count), len(mine))
+        keep = ~ismine[m] | (m > l)
+        l, m = self.net.apart(l[keep], m[keep])
+        a, b = self.net.links[l], self.net.links[m]
+        change = 0
+        for loc, sign in [(new, 1), (self.loc, -1)]:
+            change += sign * arecrossing(loc[a[:, 0]], loc[a[:, 1]], loc[b[:, 0]], loc[b[:, 1]]).sum()
+
+        others = numpy.arange(len(self.net.people)) != person
+        closer = arecloseness(new[person], new[others]).sum() - arecloseness(self.loc[person], self.loc[others]).sum()
+        return float(change + closer)
+
+    def move(self, i, value):
+        self.cost += self.change(i, value)
+        self.sol[i] = value
+        self.loc[i/2, i % 2] = value
+
+# A random graph with the given number of people and links. People are
+# given places on a square lattice and only link to people at most reach
+# places away, the way people mostly know people near them, so putting
+# them at their places (see latticelayout) is a good layout. The square is
+# big enough for people 50 pixels apart
+def makenetwork(nodes, edges, seed=0, grid=100, reach=2):
+    rnd = random.Random(seed)
+    side = int(math.ceil(math.sqrt(nodes)))
+    people = ['p%d' % i for i in range(nodes)]
+    links = []
+    while len(links) < edges:
+        a = rnd.randrange(nodes)
+        x = a % side + rnd.randint(-reach, reach)
+        y = a / side + rnd.randint(-reach, reach)
+        b = y*side + x
+        if 0 <= x < side and 0 <= y and b < nodes and b != a: links.append((people[a], people[b]))
+    return network(people, links, 10 + 50*side, grid)
+
+# The layout with everyone at their place on makenetwork's lattice, moved
+# by up to jitter pixels
+def latticelayout(nodes, jitter=0, seed=0):
+    rnd = random.Random(seed)
+    side = int(math.ceil(math.sqrt(nodes)))
+    v = []
+    for i in range(nodes):
+        v += [10 + 50*(i % side) + rnd.randint(-jitter, jitter), 10 + 50*(i / side) + rnd.randint(-jitter, jitter)]
+    return v
+
+# The network of people and links above
+defaultnetwork = network(people, links)
+
+# Optimizers check for this to cost many layouts in one call
+crosscount.batch = defaultnetwork.batch
 
 domain = [(10,370)] * (len(people)*2)
 
@@ -83,3 +366,36 @@ def drawnetwork(sol):
         draw.text(p, n, (0,0,0))
 
     img.show()
+
+# Time the network costs against crosscount, and the grid against checking
+# every pair, on random graphs:
+# python socialnetwork.py
+if __name__ == '__main__':
+    import time
+    rnd = random.Random(0)
+    layouts = [[rnd.randint(lo, hi) for (lo, hi) in domain] for i in range(1000)]
+    start = time.time()
+    expected = [crosscount(v) for v in layouts]
+    scalar = time.time() - start
+    start = time.time()
+    costs = defaultnetwork.batch(layouts)
+    batch = time.time() - start
+    print '%d layouts: crosscount %.3fs, batch %.3fs, same costs: %s' % (
+        len(layouts), scalar, batch, max([abs(a-b) for (a, b) in zip(expected, costs)]) < 1e-9)
+
+    # The grid only pays off once most links are short, so time both a
+    # good layout and a random one
+    for (nodes, edges) in [(100, 200), (500, 1000), (1000, 2000), (2000, 4000)]:
+        net = makenetwork(nodes, edges)
+        for (name, v) in [('lattice', latticelayout(nodes, 20)),
+                          ('random', [rnd.randint(lo, hi) for (lo, hi) in net.domain])]:
+            net.grid = 100
+            start = time.time()
+            gridcost = net(v)
+            gridtime = time.time() - start
+            net.grid = None
+            start = time.time()
+            densecost = net(v)
+            densetime = time.time() - start
+            print '%5d people %5d links, %-7s layout: every pair %.3fs, grid %.3fs, cost %.2f, same: %s' % (
+                nodes, edges, name, densetime, gridtime, gridcost, abs(gridcost - densecost) < 1e-6)
@@ -0,0 +1,44 @@
+import random
+import unittest
+import optimization
+import dorm
+
+# Tests for the optimizers and the trackers they cost moves with.
+#
+# Usage:
+# python -m unittest test_optimization
+
+def indomain(domain, sol):
+    for i in range(len(domain)):
+        if sol[i] < domain[i][0] or sol[i] > domain[i][1]: return False
+    return True
+
+class hillclimbtest(unittest.TestCase):
+    def testneighbourmovesstayindomain(self):
+        domain = [(0, 2), (0, 0), (3, 5)]
+        moves = optimization.neighbourmoves(domain, [0, 0, 5])
+        self.assertEqual(sorted(moves), [(0, 1), (2, 4)])
+        moves = optimization.neighbourmoves(domain, [1, 0, 4])
+        self.assertEqual(sorted(moves), [(0, 0), (0, 2), (2, 3), (2, 5)])
+
+    # With and without a tracker, hillclimb only goes to solutions in the
+    # domain, so a cost function that indexes with them never fails
+    def testhillclimbstaysindomain(self):
+        domain = [(0, 8)] * (len(optimization.people)*2)
+        plain = lambda sol: optimization.schedulecost(sol)
+        for seed in range(200):
+            for costf in [optimization.schedulecost, plain]:
+                random.seed(seed)
+                sol = optimization.hillclimb(domain, costf)
+                self.assertTrue(indomain(domain, sol))
+
+    # dorm.domain gets narrower along the solution
+    def testhillclimbdorms(self):
+        for seed in range(50):
+            random.seed(seed)
+            sol = optimization.hillclimb(dorm.domain, dorm.dormcost)
+            self.assertTrue(indomain(dorm.domain, sol))
+            self.assertEqual(dorm.dormtracker(sol).cost, dorm.dormcost(sol))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import time
+import sqlite3 as sqlite
+from collections import OrderedDict
+
+# The sqlite connection the classifiers in docclass keep their feature and
+# category counts in. It works like the connection from sqlite3.connect,
+# so docclass still calls con.execute(sql, params) and con.commit(), but
+# it also:
+#   - gives the connection a bigger page cache, and can set the journal to
+#     WAL
+#   - keeps the number of calls and the total time spent for every statement
+#   - counts how often a statement is found in sqlite3's statement cache,
+#     which it can only be when values are passed as parameters (?) rather
+#     than formatted into the SQL, as incf and fcount do
+#
+# This is the same module as the one in 4_searching_and_ranking. Each
+# chapter is run from its own directory, so it keeps its own copy, like
+# the copies of optimization.py in 5_optimization and 8_price_models.
+#
+# Usage:
+# 1. import docclass
+# 2. cl=docclass.naivebayes(docclass.getwords)
+# 3. cl.setdb('test1.db')
+# 4. docclass.sampletrain(cl)
+# 5. cl.con.printstats()
+#
+# Or on its own:
+# 1. import datastore
+# 2. con=datastore.connect('test1.db')
+# 3. con.execute('select count from cc where category=?', ('good',)).fetchone()
+#
+# WAL is stored in the database file, so use it only on a database that
+# isn't checked in, like a copy of python_feed.db being trained on:
+# 2. con=datastore.connect('feeds.db', pragmas=datastore.walpragmas)
+#
+# The time for a select only covers running it up to the first row.
+# Use fetchone/fetchall to time reading all of its rows too.
+
+# Applied to every new connection, in this order. These only last as long
+# as the connection
+defaultpragmas = [# Negative sizes are in KiB, so this is 64MB of page cache
+                  ('cache_size', -64000),
+                  ('mmap_size', 256*1024*1024)]
+
+# Only when asked for, as it stays on in the database file for every
+# connection after
+walpragmas = [('journal_mode', 'wal'),
+              # With WAL, normal only risks the last commits on power loss
+              ('synchronous', 'normal')] + defaultpragmas
+
+class connection:
+  def __init__(self, dbname, pragmas=None, cachedstatements=100):
+    self.con = sqlite.connect(dbname, cached_statements=cachedstatements)
+    if pragmas == None: pragmas = defaultpragmas
+    for (name, value) in pragmas:
+      self.con.execute('pragma %s=%s' % (name, value)).fetchall()
+
+    # sqlite3 keeps the last cachedstatements prepared statements keyed
+    # on their SQL. Keeping the same list here shows what it has cached
+    self.cachedstatements = cachedstatements
+    self.statements = OrderedDict()
+    self.cachehits = 0
+    self.cachemisses = 0
+
+    # sql -> [calls, total seconds]
+    self.timings = {}
+
+  # Count a statement against sqlite3's statement cache and time it
+  def track(self, sql, elapsed):
+    if sql in self.statements:
+      del self.statements[sql]
+      self.cachehits += 1
+    else:
+      self.cachemisses += 1
+      if len(self.statements) >= self.cachedstatements:
+        self.statements.popitem(last=False)
+    self.statements[sql] = True
+    self.time(sql, elapsed)
+
+  def time(self, sql, elapsed):
+    timing = self.timings.setdefault(sql, [0, 0.0])
+    timing[0] += 1
+    timing[1] += elapsed
+
+  def execute(self, sql, params=()):
+    start = time.time()
+    cur = self.con.execute(sql, params)
+    self.track(sql, time.time()-start)
+    return cur
+
+  def executemany(self, sql, seq):
+    start = time.time()
+    cur = self.con.executemany(sql, seq)
+    self.track(sql, time.time()-start)
+    return cur
+
+  def fetchone(self, sql, params=()):
+    start = time.time()
+    row = self.con.execute(sql, params).fetchone()
+    self.track(sql, time.time()-start)
+    return row
+
+  def fetchall(self, sql, params=()):
+    start = time.time()
+    rows = self.con.execute(sql, params).fetchall()
+    self.track(sql, time.time()-start)
+    return rows
+
+  def commit(self):
+    start = time.time()
+    self.con.commit()
+    # Not a statement sqlite3 caches, so only timed
+    self.time('commit', time.time()-start)
+
+  def rollback(self):
+    self.con.rollback()
+
+  def close(self):
+    self.con.close()
+
+  @property
+  def total_changes(self):
+    return self.con.total_changes
+
+  def resetstats(self):
+    self.cachehits = 0
+    self.cachemisses = 0
+    self.timings = {}
+
+  # The statements that took the most time overall
+  def printstats(self, n=10):
+    calls = self.cachehits + self.cachemisses
+    if calls > 0:
+      print 'statement cache: %d hits, %d misses (%.1f%% hits)' % (
+        self.cachehits, self.cachemisses, 100.0*self.cachehits/calls)
+    ranked = sorted([(seconds, count, sql) for (sql, (count, seconds)) in self.timings.items()], reverse=1)
+    for (seconds, count, sql) in ranked[0:n]:
+      print '%8d calls %8.3fs %8.1fus/call  %s' % (count, seconds, 1e6*seconds/count, sql[0:80])
+
+def connect(dbname, pragmas=None, cachedstatements=100):
+  return connection(dbname, pragmas, cachedstatements)
@@ -1,6 +1,6 @@
 import re
 import math
-import sqlite3 as sqlite
+import datastore
 
 # import docclass
 # cl=docclass.fisherclassifier(docclass.getwords)
@@ -45,7 +45,7 @@ class classifier:
         self.getfeatures = getfeatures
 
     def setdb(self, dbfile):
-        self.con = sqlite.connect(dbfile)
+        self.con = datastore.connect(dbfile)
         self.con.execute('create table if not exists fc(feature, category, count)')
         self.con.execute('create table if not exists cc(category, count)')
 
@@ -53,28 +53,28 @@ class classifier:
     def incf(self, f, cat):
         count = self.fcount(f, cat)
         if count == 0:
-            self.con.execute("insert into fc values ('%s', '%s', 1)" % (f, cat))
+            self.con.execute("insert into fc values (?, ?, 1)", (f, cat))
         else:
-            self.con.execute("update fc set count=%d where feature = '%s' and category = '%s'" % (count+1, f, cat))
+            self.con.execute("update fc set count=? where feature = ? and category = ?", (int(count)+1, f, cat))
 
     # Increase the count of a category
     def incc(self, cat):
         count = self.catcount(cat)
         if count == 0:
-            self.con.execute("insert into cc values ('%s', 1)" % (cat))
+            self.con.execute("insert into cc values (?, 1)", (cat,))
         else:
-            self.con.execute("update cc set count=%d where category = '%s'" % (count+1, cat))
+            self.con.execute("update cc set count=? where category = ?", (int(count)+1, cat))
 
 
     # The number of times a feature has appeared in a category
     def fcount(self, f, cat):
-        res = self.con.execute('select count from fc where feature="%s" and category = "%s"' % (f, cat)).fetchone()
+        res = self.con.execute('select count from fc where feature=? and category = ?', (f, cat)).fetchone()
         if res == None: return 0
         else: return float(res[0])
 
     # The number of items in a category
     def catcount(self, cat):
-        res = self.con.execute('select count from cc where category = "%s"' % (cat)).fetchone()
+        res = self.con.execute('select count from cc where category = ?', (cat,)).fetchone()
         if res == None: return 0
         else: return float(res[0])
 
@@ -1,5 +1,77 @@
+import time
 import random
 import math
+import threading
+from collections import OrderedDict
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Wraps a cost function to keep the costs of the last maxsize solutions it
+# was given. numpredict's cost functions cross-validate the whole data set
+# for every set of weights, and annealing keeps coming back to weights it
+# has already tried, so those are only cross-validated once. The GA keeps
+# its own memo for each run, and the cache also carries over between runs
+# on the same data:
+# costf = optimization.costcache(numpredict.createcostfunction(numpredict.knnestimate, data))
+# optimization.annealingoptimize(numpredict.weightdomain, costf, step=4)
+# optimization.geneticoptimize(numpredict.weightdomain, costf, step=4)
+# costf.hits, costf.misses, costf.seconds
+#
+# crossvalidate splits the data at random, so a set of weights keeps the
+# first cost it was given rather than a new guess each time. Each process
+# has its own cache
+class costcache:
+    def __init__(self, costf, maxsize=10000):
+        self.costf = costf
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        # The GA costs solutions from several threads with executor='thread'
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Time spent in costf
+        self.seconds = 0.0
+
+    def lookup(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.cache:
+                self.misses += 1
+                return None
+            # Move it to the end, the least recently used are at the front
+            self.hits += 1
+            cost = self.cache.pop(key)
+            self.cache[key] = cost
+            return cost
+        finally:
+            self.lock.release()
+
+    def store(self, key, cost, elapsed):
+        self.lock.acquire()
+        try:
+            self.seconds += elapsed
+            self.cache[key] = cost
+            if len(self.cache) > self.maxsize: self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def __call__(self, sol):
+        key = tuple(sol)
+        cost = self.lookup(key)
+        if cost == None:
+            start = time.time()
+            cost = self.costf(sol)
+            self.store(key, cost, time.time()-start)
+        return cost
+
+    def hitrate(self):
+        return float(self.hits) / max(self.hits + self.misses, 1)
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
 
 def annealingoptimize(domain, costf, T = 10000.0, cool = 0.95, step = 1):
     # Initialize the values randomly
@@ -32,52 +104,122 @@ def annealingoptimize(domain, costf, T = 10000.0, cool = 0.95, step = 1):
         T = T * cool
     return vec
 
-def geneticoptimize(domain, costf, popsize = 50, step = 1, mutprod=0.2, elite=0.2, maxiter=100):
+# The cost function for the workers of a process pool. It is set before
+# the pool starts, so the workers get it when they are forked and it
+# doesn't have to be picklable, which the cost functions numpredict builds
+# aren't
+poolcostf = None
+
+# Cost one solution. With a seed, the random module is seeded first, so a
+# cost function that uses it, like numpredict's crossvalidate, gives the
+# same answer whichever worker runs it and in whatever order
+def costsolution(task):
+    costf, seed, vec = task
+    if costf == None: costf = poolcostf
+    if seed != None: random.seed(seed)
+    return costf(vec)
+
+# Something with a map method to cost solutions with: None to cost them one
+# at a time here, 'thread' or 'process' for a new pool of that many
+# workers, or a pool that is already running. Returns it and whether it
+# was started here and should be closed
+def getexecutor(executor, workers, costf):
+    global poolcostf
+    if executor == None or executor == 'serial': return None, False
+    if executor == 'thread': return ThreadPool(workers), True
+    if executor == 'process':
+        poolcostf = costf
+        return multiprocessing.Pool(workers), True
+    return executor, False
+
+# The costs of a list of solutions, in order. The seed for each one comes
+# from the solution itself and seed, so the same solution always gets the
+# same seed. Threads share the random module, so a cost function that uses
+# it is only repeatable with no executor or processes
+def costsolutions(costf, sols, executor=None, seed=None, processes=False):
+    tasks = []
+    for v in sols:
+        taskseed = None
+        if seed != None: taskseed = hash((seed,) + tuple(v))
+        tasks.append((not processes and costf or None, taskseed, v))
+    if executor == None: return map(costsolution, tasks)
+    return executor.map(costsolution, tasks)
+
+# The population can be costed in parallel, with executor='thread' or
+# 'process' and workers, or a running pool. Each solution is only costed
+# once, so the elites aren't costed again every generation. With a seed
+# the result only depends on the seed, not on the executor:
+# optimization.geneticoptimize(numpredict.weightdomain, costf, popsize=5, executor='process', seed=1)
+def geneticoptimize(domain, costf, popsize = 50, step = 1, mutprod=0.2, elite=0.2, maxiter=100,
+                    executor=None, workers=None, seed=None):
+    # With a seed, the choices here come from their own generator, so
+    # they don't depend on anything else using the random module
+    if seed == None: rnd = random
+    else: rnd = random.Random(seed)
+
     # Mutation Operation
     def mutate(vec):
-        i = random.randint(0, len(domain)-1)
-        if random.random() < 0.5 and vec[i] >= domain[i][0]:
+        i = rnd.randint(0, len(domain)-1)
+        if rnd.random() < 0.5 and vec[i] >= domain[i][0]:
             return vec[0:i]+[vec[i]-step]+vec[i+1:]
         elif vec[i] <= domain[i][1]:
             return vec[0:i]+[vec[i]+step]+vec[i+1:]
 
     # Crossover Operation
     def crossover(r1,r2):
-        i = random.randint(1, len(domain)-2)
+        i = rnd.randint(1, len(domain)-2)
         return r1[0:i]+r2[i:]
 
     # Build the initial population
     pop = []
     for i in range(popsize):
-        vec = [random.randint(domain[i][0], domain[i][1])
+        vec = [rnd.randint(domain[i][0], domain[i][1])
                 for i in range(len(domain))]
         pop.append(vec)
 
     # How many winners from each generation?
     topelite = int(elite*popsize)
 
-    # Main loop
-    for i in range(maxiter):
-        scores=[(costf(v),v) for v in pop]
-        scores.sort()
-        ranked = [v for (s,v) in scores]
-
-        # Start with the pure winners
-        pop = ranked[0:topelite]
-
-        # Add the mutated and bred forms of the winners
-        while len(pop) < popsize:
-            if random.random() < mutprod:
-                # Mutation
-                c = random.randint(0, topelite)
-                pop.append(mutate(ranked[c]))
-            else:
-                # Crossover
-                c1 = random.randint(0, topelite)
-                c2 = random.randint(0, topelite)
-                pop.append(crossover(ranked[c1], ranked[c2]))
-
-        # Print the current best score
-        print scores[0][0]
+    # Costs of the solutions seen so far
+    memo = {}
+    pool, started = getexecutor(executor, workers, costf)
+
+    try:
+        # Main loop
+        for i in range(maxiter):
+            # Only cost the solutions that haven't been costed yet
+            new = []
+            for v in pop:
+                if tuple(v) not in memo:
+                    memo[tuple(v)] = None
+                    new.append(v)
+            costs = costsolutions(costf, new, pool, seed, executor == 'process')
+            for (v, cost) in zip(new, costs): memo[tuple(v)] = cost
+
+            scores = [(memo[tuple(v)], v) for v in pop]
+            scores.sort()
+            ranked = [v for (s,v) in scores]
+
+            # Start with the pure winners
+            pop = ranked[0:topelite]
+
+            # Add the mutated and bred forms of the winners
+            while len(pop) < popsize:
+                if rnd.random() < mutprod:
+                    # Mutation
+                    c = rnd.randint(0, topelite)
+                    pop.append(mutate(ranked[c]))
+                else:
+                    # Crossover
+                    c1 = rnd.randint(0, topelite)
+                    c2 = rnd.randint(0, topelite)
+                    pop.append(crossover(ranked[c1], ranked[c2]))
+
+            # Print the current best score
+            print scores[0][0]
+    finally:
+        if started:
+            pool.close()
+            pool.join()
 
     return scores[0][1]